@@ -0,0 +1,295 @@
+import os, sys, copy, json, time, shutil, importlib, itertools
+import yaml
+from project_base import production_id
+from scheduler import ACTIVE_STATES, slurm_backend
+
+# Expand a campaign spec into many productions of one project in a single call.
+# The spec (YAML) names the project, a base configuration and the parameters to
+# sweep:
+#
+#   PROJECT: larndsim                      # project_<PROJECT>.py
+#   CONFIG:  production_2x2_larndsim.yaml  # base configuration (relative to the spec)
+#   GRID:                                  # every combination of the values
+#     SEARCH_DET_PROPERTIES: [2x2.yaml, 2x2_lowfield.yaml]
+#     MPVMPR.GeneratorMPV.NumParticle: [[1,10],[1,20]]
+#   LIST:                                  # and/or explicit overrides (each combined with the grid)
+#     - {NUM_EVENTS: 100}
+#   FILES:                                 # YAML files patched by KEY.path grid/list entries
+#     MPVMPR: config/mpvmpr_2x2.yaml       # (the patched copy is passed as SET_KEY)
+#   THROTTLE: 200                          # array tasks running at once over the whole campaign
+#
+# Productions are created as STORAGE_DIR/production_<campaign ID>-NNN, the shared
+# files of all productions are stored once (by content) in the campaign directory,
+# and the campaign submit.sh submits every production. With THROTTLE, submit.sh
+# runs the campaign throttle instead: it submits the productions as slots are
+# available and moves the slots of productions without pending tasks to the
+# others (ArrayTaskThrottle of their arrays), so that the running tasks of the
+# whole campaign never exceed THROTTLE.
+
+CAMPAIGN_RECORD='campaign.yaml'
+THROTTLE_STATE='throttle_state.json'
+
+
+def expand(spec):
+    '''
+    Returns the list of overrides (dictionaries) of the productions of a campaign.
+    '''
+    grid=spec.get('GRID',dict()) or dict()
+    for key,values in grid.items():
+        if not isinstance(values,list) or len(values) < 1:
+            raise ValueError(f'GRID values must be a non-empty list ({key})')
+    points=[dict(zip(grid.keys(),values)) for values in itertools.product(*grid.values())]
+    entries=spec.get('LIST',None) or [dict()]
+    res=[]
+    for entry in entries:
+        for point in points:
+            overrides=copy.deepcopy(entry)
+            overrides.update(copy.deepcopy(point))
+            res.append(overrides)
+    return res
+
+
+def _set_path(data,path,value):
+    keys=[int(k) if k.isdigit() else k for k in path.split('.')]
+    for k in keys[:-1]:
+        data=data[k]
+    data[keys[-1]]=value
+
+
+def apply(base,overrides,files,file_dir):
+    '''
+    Returns the configuration of a production. Entries KEY.path patch a copy of the YAML
+    file FILES[KEY] (written in file_dir) that replaces USE_KEY/SEARCH_KEY as SET_KEY.
+    '''
+    cfg=copy.deepcopy(base)
+    patches=dict()
+    for key,value in overrides.items():
+        if '.' in key:
+            name,path=key.split('.',1)
+            if not name in files:
+                raise KeyError(f'{key} patches {name} which is not listed in FILES')
+            patches.setdefault(name,[]).append((path,value))
+        else:
+            cfg[key]=value
+
+    for name,entries in patches.items():
+        with open(files[name],'r') as f:
+            data=yaml.safe_load(f)
+        for path,value in entries:
+            _set_path(data,path,value)
+        target=os.path.join(file_dir,os.path.basename(files[name]))
+        os.makedirs(file_dir,exist_ok=True)
+        with open(target,'w') as f:
+            yaml.dump(data,f,default_flow_style=False,sort_keys=False)
+        for prefix in ['USE_','SEARCH_']:
+            cfg.pop(prefix+name,None)
+        cfg['SET_'+name]=target
+    return cfg
+
+
+def gen_submit_script(productions):
+    '''
+    Submission script of a campaign: submit.sh of every production with its submit command.
+    '''
+    script='''#!/bin/bash
+FAILED=0
+'''
+    for pid,command,path in productions:
+        script+=f'''
+echo "Submitting production {pid}"
+{command} {path} || {{ echo "Failed to submit {pid}"; FAILED=$((FAILED+1)); }}
+'''
+    script+=f'''
+echo "Submitted $(({len(productions)}-FAILED))/{len(productions)} production(s)"
+exit $FAILED
+'''
+    return script
+
+
+def generate(spec_path):
+    '''
+    Create the productions of a campaign spec. Returns the campaign directory.
+    '''
+    with open(spec_path,'r') as f:
+        spec=yaml.safe_load(f)
+    for key in ['PROJECT','CONFIG']:
+        if not key in spec:
+            raise KeyError(f'{key} must be specified in the campaign spec.')
+    spec_dir=os.path.dirname(os.path.abspath(spec_path))
+    with open(os.path.join(spec_dir,spec['CONFIG']),'r') as f:
+        base=yaml.safe_load(f)
+    files={k:os.path.join(spec_dir,v) for k,v in (spec.get('FILES',dict()) or dict()).items()}
+
+    overrides=expand(spec)
+    throttle=int(spec.get('THROTTLE',0))
+
+    module=importlib.import_module(f'project_{spec["PROJECT"]}')
+    cid=production_id()
+    cdir=os.path.join(os.path.abspath(os.path.expandvars(base['STORAGE_DIR'])),f'campaign_{cid}')
+    print(f'Constructing a campaign {cid} of {len(overrides)} production(s) in {cdir}')
+    os.makedirs(cdir)
+    shutil.copyfile(spec_path,os.path.join(cdir,'spec.yaml'))
+
+    productions=[]
+    record=[]
+    try:
+        for i,entry in enumerate(overrides):
+            pid=f'{cid}-{i:03d}'
+            cfg=apply(base,entry,files,os.path.join(cdir,'files',pid))
+            cfg['PRODUCTION_ID']=pid
+            cfg['ASSET_STORE_DIR']=os.path.join(cdir,'assets')
+            if throttle > 0 and (not cfg.get('SCHEDULER','slurm') == 'slurm' or cfg.get('SLURM_SPLIT_STAGES',False)):
+                raise ValueError('THROTTLE requires SCHEDULER slurm and cannot be used with SLURM_SPLIT_STAGES.')
+            print(f'\n[{i+1}/{len(overrides)}] production {pid}: {entry}')
+            p=getattr(module,f'project_{spec["PROJECT"]}')()
+            p.generate(yaml.dump(cfg,default_flow_style=False))
+            sdir=os.path.join(os.path.abspath(os.path.expandvars(base['STORAGE_DIR'])),f'production_{pid}')
+            productions.append((pid,p.SUBMIT_COMMAND,os.path.join(sdir,'job_source','submit.sh')))
+            record.append(dict(production=pid,storage_dir=sdir,overrides=entry))
+    except Exception as e:
+        print(f'Encountered an error while generating the campaign {cid}. Removing it...')
+        for pid,command,path in productions:
+            shutil.rmtree(os.path.dirname(os.path.dirname(path)))
+        shutil.rmtree(cdir)
+        raise e
+
+    with open(os.path.join(cdir,CAMPAIGN_RECORD),'w') as f:
+        yaml.dump(dict(campaign=cid,project=spec['PROJECT'],throttle=throttle,productions=record),f,
+            default_flow_style=False,sort_keys=False)
+    with open(os.path.join(cdir,'submit.sh'),'w') as f:
+        if throttle > 0:
+            f.write(f'''#!/bin/bash
+# submit the productions within the campaign throttle (runs until all productions are over)
+{sys.executable} {os.path.abspath(__file__)} throttle {cdir} "$@"
+''')
+        else:
+            f.write(gen_submit_script(productions))
+
+    print(f'\nCreated {len(productions)} production(s) of the campaign {cid}')
+    print(f'\nTo submit all of them, type:\n\nbash {os.path.join(cdir,"submit.sh")}\n')
+    print(f'To clean up the campaign, remove {cdir} and its productions {os.path.dirname(cdir)}/production_{cid}-*\n')
+    return cdir
+
+
+class campaign_throttle():
+    '''
+    Keeps the running array tasks of the productions of a campaign within its THROTTLE.
+    A submitted production keeps its slots while it has pending tasks; the slots of the
+    others (no pending task left, or over) are given to productions with pending tasks,
+    or used to submit the next productions. Resubmissions (e.g. by watcher.py) are not counted.
+    '''
+
+    def __init__(self,campaign_dir,backend):
+        self.campaign_dir=os.path.abspath(campaign_dir)
+        self.backend=backend
+        with open(os.path.join(self.campaign_dir,CAMPAIGN_RECORD),'r') as f:
+            record=yaml.safe_load(f)
+        self.throttle=int(record['throttle'])
+        if self.throttle < 1:
+            raise ValueError(f'The campaign {record["campaign"]} has no THROTTLE')
+
+        self.state=dict(productions=dict())
+        path=os.path.join(self.campaign_dir,THROTTLE_STATE)
+        if os.path.isfile(path):
+            with open(path,'r') as f:
+                self.state=json.load(f)
+        for entry in record['productions']:
+            if entry['production'] in self.state['productions']:
+                continue
+            with open(os.path.join(entry['storage_dir'],'job_source','source.yaml'),'r') as f:
+                cfg=yaml.safe_load(f)
+            tasks=int(cfg['WORKER_COUNT'] if cfg.get('WORKER_MODE',False) else cfg['SLURM_NUM_JOBS'])
+            self.state['productions'][entry['production']]=dict(storage_dir=entry['storage_dir'],
+                tasks=tasks,job=None,throttle=0,done=False)
+
+    def save(self):
+        path=os.path.join(self.campaign_dir,THROTTLE_STATE)
+        with open(path+'.tmp','w') as f:
+            json.dump(self.state,f,indent=1)
+        os.replace(path+'.tmp',path)
+
+    def submit(self,pid,throttle):
+        p=self.state['productions'][pid]
+        jsdir=os.path.join(p['storage_dir'],'job_source')
+        script=os.path.join(jsdir,'submit.sh')
+        if os.path.isfile(os.path.join(jsdir,'submit_array.sh')):
+            script=os.path.join(jsdir,'submit_array.sh')
+        p['job']=self.backend.submit(script,list(range(1,p['tasks']+1)),[],throttle)
+        p['throttle']=throttle
+        print(f'Submitted production {pid} as job {p["job"]} ({p["tasks"]} task(s), {throttle} at once)')
+        # the merge job is chained to the array as by the submit.sh of the production
+        if os.path.isfile(os.path.join(jsdir,'submit_merge.sh')):
+            merge=self.backend.submit_after(os.path.join(jsdir,'submit_merge.sh'),p['job'])
+            print(f'Submitted the merge job {merge} of production {pid}')
+
+    def update(self,pid,throttle):
+        p=self.state['productions'][pid]
+        self.backend.set_throttle(p['job'],throttle)
+        print(f'Production {pid}: {p["throttle"]} => {throttle} task(s) at once')
+        p['throttle']=throttle
+
+    def poll(self):
+        '''
+        Update the throttles and submit productions. Returns the number of productions not over.
+        '''
+        reserved=0
+        needs=dict()
+        for pid,p in self.state['productions'].items():
+            if p['done']:
+                continue
+            if p['job'] is None:
+                needs[pid]=p['tasks']
+                continue
+            states=[state for state,node in self.backend.states(p['job']).values()]
+            pending=len([s for s in states if s in ['PENDING','REQUEUED']])
+            running=len([s for s in states if s in ACTIVE_STATES])-pending
+            if states and running+pending < 1:
+                print(f'Production {pid} is over')
+                p['done']=True
+                continue
+            if states and pending < 1 and running < p['throttle']:
+                # no task left to start: release the unused slots
+                self.update(pid,max(running,1))
+            reserved+=p['throttle']
+            if pending > 0:
+                needs[pid]=running+pending-p['throttle']
+
+        # share the free slots one at a time between the productions that can use them
+        free=self.throttle-reserved
+        extra={pid:0 for pid in needs}
+        while free > 0:
+            candidates=[pid for pid in needs if needs[pid] > extra[pid]]
+            if not candidates:
+                break
+            for pid in candidates[:free]:
+                extra[pid]+=1
+                free-=1
+        for pid,n in extra.items():
+            if n < 1:
+                continue
+            if self.state['productions'][pid]['job'] is None:
+                self.submit(pid,n)
+            else:
+                self.update(pid,self.state['productions'][pid]['throttle']+n)
+        self.save()
+        return len([p for p in self.state['productions'].values() if not p['done']])
+
+    def run(self,period=60):
+        while self.poll() > 0:
+            time.sleep(period)
+        print(f'All {len(self.state["productions"])} production(s) of the campaign are over')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) in [3,4] and sys.argv[1] == 'throttle':
+        campaign_throttle(sys.argv[2],slurm_backend()).run(float(sys.argv[3]) if len(sys.argv) == 4 else 60)
+        sys.exit(0)
+
+    if not len(sys.argv) == 2 or not sys.argv[1].endswith('.yaml'):
+        print(f'Invalid arguments {sys.argv[1:]}')
+        print(f'Usage: {os.path.basename(__file__)} $CAMPAIGN_SPEC_YAML')
+        print(f'       {os.path.basename(__file__)} throttle $CAMPAIGN_DIR [$PERIOD]')
+        sys.exit(1)
+
+    generate(sys.argv[1])
+    sys.exit(0)
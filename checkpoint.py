@@ -0,0 +1,87 @@
+import os
+
+# Shell snippets to checkpoint the outputs of finished job stages into the
+# storage directory (one directory per array index, kept across resubmissions),
+# and to restore them instead of rerunning the stage. A checkpoint entry is
+# valid once its .sha256 file exists (written last) and matches the contents.
+# When a task succeeds, its entries are replaced by a marker recording the job
+# directory so that a resubmitted task with verified outputs exits immediately.
+
+
+def parse_config(cfg,res):
+    '''
+    Validate the checkpoint options of cfg and fill the defaults in res
+    (after the staging options).
+    '''
+    res['CHECKPOINT']=bool(cfg.get('CHECKPOINT',False))
+    # seconds before the time limit at which SLURM signals the batch script
+    res['CHECKPOINT_GRACE']=int(cfg.get('CHECKPOINT_GRACE',300))
+    if res['CHECKPOINT_GRACE'] < 1:
+        raise ValueError('CHECKPOINT_GRACE must be positive.')
+    res['CHECKPOINT_DIR']=os.path.join(res['STORAGE_DIR'],'checkpoint')
+    # a finished task is verified against its stage manifest
+    if res['CHECKPOINT'] and not res['STAGE_CHECKSUM']:
+        raise ValueError('CHECKPOINT requires STAGE_CHECKSUM.')
+
+
+def gen_task_dir(cfg):
+    '''
+    Define and export CKPT_DIR, the checkpoint directory of the array index.
+    '''
+    return f'''export CKPT_DIR={cfg['CHECKPOINT_DIR']}/$(printf "task_%04d" $SLURM_ARRAY_TASK_ID)
+mkdir -p $CKPT_DIR
+'''
+
+
+def gen_functions(cfg):
+    '''
+    Define ckpt_commit (NAME FILE), ckpt_restore (NAME FILE) and ckpt_drop (NAME) for job scripts.
+    Without CHECKPOINT, nothing is restored and commits are no-ops.
+    '''
+    if not cfg['CHECKPOINT']:
+        return '''ckpt_commit() { return 0; }
+ckpt_restore() { return 1; }
+ckpt_drop() { return 0; }
+'''
+    return '''ckpt_commit() {
+    echo "Checkpointing $2 as $1"
+    local sum=$(sha256sum "$2" | cut -d' ' -f1)
+    cp "$2" $CKPT_DIR/.$1.partial && mv $CKPT_DIR/.$1.partial $CKPT_DIR/$1 || return 1
+    echo "$sum  $1" > $CKPT_DIR/.$1.sha256 && mv $CKPT_DIR/.$1.sha256 $CKPT_DIR/$1.sha256
+}
+
+ckpt_restore() {
+    [ -f $CKPT_DIR/$1.sha256 ] || return 1
+    if ! (cd $CKPT_DIR && sha256sum -c --status $1.sha256); then
+        echo "Checkpoint $1 is corrupted, discarding"
+        rm -f $CKPT_DIR/$1 $CKPT_DIR/$1.sha256
+        return 1
+    fi
+    echo "Restoring $2 from the checkpoint $1"
+    cp $CKPT_DIR/$1 "$2"
+}
+
+ckpt_drop() {
+    rm -f $CKPT_DIR/$1.sha256 $CKPT_DIR/$1
+}
+'''
+
+
+def gen_task_functions():
+    '''
+    Define ckpt_complete (LABEL), true if the task LABEL finished and its staged outputs
+    match the manifest sizes, and ckpt_finish (LABEL JOB_DIR) to record a finished task.
+    '''
+    return '''ckpt_complete() {
+    local d=$(cat $CKPT_DIR/$1.done 2>/dev/null)
+    [ -n "$d" ] && ls $d/stage_manifest_*.txt &> /dev/null || return 1
+    cat $d/stage_manifest_*.txt | while read SUM SIZE NAME; do
+        [ "$(stat -c %s "$d/$NAME" 2>/dev/null)" == "$SIZE" ] || exit 1
+    done
+}
+
+ckpt_finish() {
+    find $CKPT_DIR -mindepth 1 ! -name '*.done' -delete
+    echo $2 > $CKPT_DIR/$1.done
+}
+'''
@@ -0,0 +1,131 @@
+import os, glob, json, struct
+
+# Persistent record of larnd2supera conversions under a STORAGE_DIR.
+# Each line of the manifest is a JSON object with the input path, the input
+# size and mtime at the time it was scheduled, and the produced output.
+
+MANIFEST_NAME='larnd2supera_manifest.jsonl'
+TASK_META_NAME='flist_meta.jsonl'
+
+
+def root_file_complete(path):
+    '''
+    Check a ROOT file is not truncated: the header records the end of the file (fEND).
+    '''
+    try:
+        size=os.path.getsize(path)
+        with open(path,'rb') as f:
+            header=f.read(20)
+    except OSError:
+        return False
+    if len(header) < 16 or not header[:4] == b'root':
+        return False
+    version=struct.unpack('>i',header[4:8])[0]
+    if version > 1000000:
+        if len(header) < 20:
+            return False
+        end=struct.unpack('>q',header[12:20])[0]
+    else:
+        end=struct.unpack('>i',header[12:16])[0]
+    return size >= end
+
+
+def write_task_meta(jsdir,tasks):
+    '''
+    Record the size and mtime of the inputs of each task (1-indexed) at generation time.
+    '''
+    with open(os.path.join(jsdir,TASK_META_NAME),'w') as f:
+        for i,names in enumerate(tasks):
+            for name in names:
+                st=os.stat(name)
+                f.write(json.dumps(dict(task=i+1,input=name,size=st.st_size,mtime=st.st_mtime))+'\n')
+
+
+def _read_jsonl(path):
+    res=[]
+    if not os.path.isfile(path):
+        return res
+    with open(path,'r') as f:
+        for line in f:
+            line=line.strip()
+            if not line:
+                continue
+            try:
+                res.append(json.loads(line))
+            except ValueError:
+                print(f'Skipping a corrupted line in {path}')
+    return res
+
+
+def completed_outputs(production_dir):
+    '''
+    Returns a dictionary of input path => (task, output path) for complete outputs of a production.
+    '''
+    res=dict()
+    # in the worker mode, the inputs.txt of a unit (task) is in a unit_N sub-directory of the worker outputs
+    paths=glob.glob(os.path.join(production_dir,'job_*','inputs.txt'))
+    paths+=glob.glob(os.path.join(production_dir,'job_*','unit_*','inputs.txt'))
+    for inputs in paths:
+        jdir=os.path.dirname(inputs)
+        task=int(os.path.basename(jdir).split('_')[-1])
+        if os.path.basename(jdir).startswith('unit_'):
+            jdir=os.path.dirname(jdir)
+        with open(inputs,'r') as f:
+            for line in f:
+                words=line.split(None,1)
+                if len(words) < 2:
+                    continue
+                output=os.path.join(jdir,words[0])
+                if root_file_complete(output):
+                    res[words[1].strip()]=(task,output)
+    return res
+
+
+def sync(storage_dir):
+    '''
+    Add complete outputs of all productions under storage_dir to the manifest.
+    Returns the manifest as a dictionary keyed by the input path.
+    '''
+    path=os.path.join(storage_dir,MANIFEST_NAME)
+    manifest={entry['input']:entry for entry in _read_jsonl(path)}
+    new_entries=[]
+    for pdir in sorted(glob.glob(os.path.join(storage_dir,'production_*'))):
+        meta={entry['input']:entry for entry in _read_jsonl(os.path.join(pdir,'job_source',TASK_META_NAME))}
+        if not meta:
+            continue
+        for name,(task,output) in completed_outputs(pdir).items():
+            if not name in meta:
+                continue
+            if name in manifest and manifest[name]['output'] == output:
+                continue
+            entry=dict(input=name,size=meta[name]['size'],mtime=meta[name]['mtime'],output=output)
+            manifest[name]=entry
+            new_entries.append(entry)
+    if new_entries:
+        with open(path,'a') as f:
+            for entry in new_entries:
+                f.write(json.dumps(entry)+'\n')
+        print(f'Recorded {len(new_entries)} new conversion(s) in {path}')
+    return manifest
+
+
+def is_converted(manifest,name):
+    '''
+    True if name was converted and is unchanged since (same size and mtime).
+    '''
+    entry=manifest.get(name)
+    if entry is None or not os.path.isfile(entry['output']):
+        return False
+    st=os.stat(name)
+    return entry['size'] == st.st_size and entry['mtime'] == st.st_mtime
+
+
+def missing_tasks(production_dir):
+    '''
+    Returns the sorted list of task indices (1-indexed) with missing or truncated outputs.
+    '''
+    meta=_read_jsonl(os.path.join(production_dir,'job_source',TASK_META_NAME))
+    if not meta:
+        raise FileNotFoundError(f'{TASK_META_NAME} not found under {production_dir}/job_source')
+    done=completed_outputs(production_dir)
+    return sorted(set(entry['task'] for entry in meta if not entry['input'] in done))
@@ -0,0 +1,147 @@
+import os, json, time, fnmatch, glob
+from concurrent.futures import ThreadPoolExecutor
+
+# Parallel replacement of glob.glob for large patterns on networked filesystems.
+# Each wildcard level is listed with os.scandir over a thread pool. Directory
+# listings can be cached (keyed by the directory mtime) between runs.
+
+HDF5_SIGNATURE=b'\x89HDF\r\n\x1a\n'
+
+
+def is_hdf5(path):
+    '''
+    Check the HDF5 superblock signature, which is at offset 0 or a power of two from 512.
+    '''
+    try:
+        size=os.path.getsize(path)
+        with open(path,'rb') as f:
+            offset=0
+            while offset+len(HDF5_SIGNATURE) <= size:
+                f.seek(offset)
+                if f.read(len(HDF5_SIGNATURE)) == HDF5_SIGNATURE:
+                    return True
+                offset = 512 if offset == 0 else offset*2
+                if offset > 8*1024*1024:
+                    break
+    except OSError:
+        pass
+    return False
+
+
+class fast_glob():
+
+    def __init__(self,num_threads=16,cache_file=None):
+        self.num_threads=int(num_threads)
+        self.cache_file=cache_file
+        self.cache=dict()
+        if cache_file and os.path.isfile(cache_file):
+            try:
+                with open(cache_file,'r') as f:
+                    self.cache=json.load(f)
+            except ValueError:
+                print(f'Ignoring a corrupted directory cache {cache_file}')
+
+    def listdir(self,path):
+        '''
+        Returns a list of (name, is_dir) of a directory, using the cache if the mtime did not change.
+        '''
+        try:
+            mtime=os.stat(path).st_mtime_ns
+        except OSError:
+            return []
+        entry=self.cache.get(path)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        res=[]
+        try:
+            with os.scandir(path) as it:
+                for e in it:
+                    try:
+                        res.append((e.name,e.is_dir()))
+                    except OSError:
+                        continue
+        except OSError:
+            return []
+        if self.cache_file:
+            self.cache[path]=(mtime,res)
+        return res
+
+    def _expand(self,pool,paths,part,last):
+        if not glob.has_magic(part):
+            if last:
+                return [os.path.join(p,part) for p in paths if os.path.lexists(os.path.join(p,part))]
+            return [os.path.join(p,part) for p in paths]
+        res=[]
+        for p,entries in zip(paths,pool.map(self.listdir,paths)):
+            for name,is_dir in entries:
+                if name.startswith('.') and not part.startswith('.'):
+                    continue
+                if not fnmatch.fnmatchcase(name,part):
+                    continue
+                if last or is_dir:
+                    res.append(os.path.join(p,name))
+        return res
+
+    def _stat(self,path,validate):
+        try:
+            size=os.path.getsize(path)
+        except OSError:
+            return path,None,False
+        return path,size,(not validate or is_hdf5(path))
+
+    def glob(self,pattern,validate=False):
+        '''
+        Expand pattern (same semantics as glob.glob, no recursive **) and return a list
+        of (path, size in bytes) sorted by path. With validate, files without a readable
+        HDF5 header are reported and excluded.
+        '''
+        t0=time.time()
+        pattern=os.path.abspath(os.path.expandvars(pattern))
+        parts=pattern.strip(os.sep).split(os.sep)
+        paths=[os.sep]
+        with ThreadPoolExecutor(max_workers=self.num_threads) as pool:
+            for i,part in enumerate(parts):
+                paths=self._expand(pool,paths,part,i == len(parts)-1)
+                if len(paths) < 1:
+                    break
+            stats=list(pool.map(lambda p: self._stat(p,validate),paths))
+
+        res,bad=[],[]
+        for path,size,valid in sorted(stats):
+            if size is None:
+                continue
+            if not valid:
+                bad.append(path)
+                continue
+            res.append((path,size))
+        if bad:
+            print(f'WARNING: excluding {len(bad)} file(s) without a readable HDF5 header')
+            for path in bad:
+                print(f'    {path}')
+
+        dt=time.time()-t0
+        print(f'Scanned {len(stats)} file(s) in {dt:.2f} s ({len(stats)/max(dt,1.e-6):.1f} files/s, {self.num_threads} threads)')
+
+        if self.cache_file:
+            tmp=self.cache_file+f'.{os.getpid()}'
+            with open(tmp,'w') as f:
+                json.dump(self.cache,f)
+            os.replace(tmp,self.cache_file)
+        return res
+
+
+if __name__ == '__main__':
+    import sys
+    if not len(sys.argv) in [2,3]:
+        print(f'Invalid number of the arguments ({len(sys.argv)})')
+        print(f'Usage: {os.path.basename(__file__)} $GLOB_PATTERN [$NUM_THREADS]')
+        sys.exit(1)
+
+    num_threads = int(sys.argv[2]) if len(sys.argv) == 3 else 16
+    t0=time.time()
+    ref=glob.glob(os.path.expandvars(sys.argv[1]))
+    dt=time.time()-t0
+    print(f'glob.glob found {len(ref)} file(s) in {dt:.2f} s ({len(ref)/max(dt,1.e-6):.1f} files/s)')
+    res=fast_glob(num_threads).glob(sys.argv[1])
+    print(f'fast_glob found {len(res)} file(s)')
+    sys.exit(0)
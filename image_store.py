@@ -0,0 +1,254 @@
+import os, glob, json, fcntl, hashlib, shutil
+
+# Content-addressed store of singularity images shared by all productions
+# under one STORAGE_DIR. Each production references an image in the store
+# by a hard link (or a symbolic link when hard links are not possible).
+# Copies into the store go through a .partial file locked by the copying
+# process, so that concurrent generations do not write the same copy.
+# Campaigns store their shared files the same way (store_file) in
+# campaign_*/assets, linked from the job_shared directory of each production.
+
+STORE_NAME='image_store'
+HASH_CACHE='hash_cache.json'
+CHUNK_SIZE=64*1024*1024
+
+
+def store_dir(storage_dir):
+    return os.path.join(os.path.abspath(os.path.expandvars(storage_dir)),STORE_NAME)
+
+
+def _load_cache(sdir):
+    path=os.path.join(sdir,HASH_CACHE)
+    if not os.path.isfile(path):
+        return dict()
+    try:
+        with open(path,'r') as f:
+            return json.load(f)
+    except ValueError:
+        print(f'Ignoring a corrupted hash cache {path}')
+        return dict()
+
+
+def _save_cache(sdir,cache):
+    path=os.path.join(sdir,HASH_CACHE)
+    tmp=path+f'.{os.getpid()}'
+    with open(tmp,'w') as f:
+        json.dump(cache,f,indent=1)
+    os.replace(tmp,path)
+
+
+def _sha256(f):
+    h=hashlib.sha256()
+    f.seek(0)
+    while True:
+        chunk=f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def file_hash(path,sdir=None):
+    '''
+    Returns the sha256 of a file. If sdir is given, the hash is cached there
+    keyed by the real path, size and mtime of the file.
+    '''
+    path=os.path.realpath(path)
+    st=os.stat(path)
+    key=f'{path}:{st.st_size}:{st.st_mtime_ns}'
+
+    cache=None
+    if sdir is not None:
+        cache=_load_cache(sdir)
+        if key in cache:
+            return cache[key]
+
+    with open(path,'rb') as f:
+        digest=_sha256(f)
+
+    if cache is not None:
+        # drop stale entries of the same path
+        for k in [k for k in cache if k.rsplit(':',2)[0] == path]:
+            cache.pop(k)
+        cache[key]=digest
+        _save_cache(sdir,cache)
+    return digest
+
+
+def _lock_partial(partial):
+    '''
+    Open partial for appending and lock it (waits for a copy in progress).
+    Returns None if partial was renamed or removed by that copy while waiting.
+    The lock is released when any descriptor of the file is closed by this
+    process, so the copy is also read back through the returned file.
+    '''
+    fout=open(partial,'a+b')
+    fcntl.lockf(fout,fcntl.LOCK_EX)
+    try:
+        same=os.stat(partial).st_ino == os.fstat(fout.fileno()).st_ino
+    except FileNotFoundError:
+        same=False
+    if not same:
+        fout.close()
+        return None
+    return fout
+
+
+def copy_chunked(src,dst,digest=None):
+    '''
+    Copy src into dst in chunks. The copy goes through dst.partial, locked while
+    it is written, and resumes from its current size if a previous copy was
+    interrupted. If digest is given, the sha256 of the copy is checked before
+    it is renamed to dst.
+    '''
+    partial=dst+'.partial'
+    total=os.path.getsize(src)
+    fout=None
+    while fout is None:
+        fout=_lock_partial(partial)
+    with fout:
+        # another process may have completed the copy while we waited for the lock
+        if os.path.isfile(dst) and os.path.getsize(dst) == total:
+            os.remove(partial)
+            return
+        offset=os.fstat(fout.fileno()).st_size
+        if offset > total:
+            fout.truncate(0)
+            offset=0
+        if offset:
+            print(f'Resuming a copy at {offset}/{total} bytes')
+        with open(src,'rb') as fin:
+            fin.seek(offset)
+            while True:
+                chunk=fin.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                fout.write(chunk)
+        fout.flush()
+        os.fsync(fout.fileno())
+        if not os.path.getsize(partial) == total:
+            raise OSError(f'Incomplete copy of {src} (expected {total} bytes at {partial})')
+        if digest is not None and not _sha256(fout) == digest:
+            os.remove(partial)
+            raise OSError(f'Corrupted copy of {src} (sha256 mismatch at {partial}, removed)')
+        os.replace(partial,dst)
+
+
+def store_image(src,storage_dir):
+    '''
+    Make sure src is present in the image store and return the path to it.
+    '''
+    sdir=store_dir(storage_dir)
+    os.makedirs(sdir,exist_ok=True)
+    digest=file_hash(src,sdir)
+    dst=os.path.join(sdir,f'{digest}.sif')
+    if os.path.isfile(dst) and os.path.getsize(dst) == os.path.getsize(src):
+        print(f'Image found in the store: {dst}')
+        return dst
+    print(f'Copying the image into the store: {dst}')
+    copy_chunked(src,dst,digest)
+    return dst
+
+
+def store_file(src,sdir):
+    '''
+    Make sure src is present in the content-addressed directory sdir and return the path to it.
+    The stored file keeps its name (prefixed by the hash) and is read-only.
+    '''
+    os.makedirs(sdir,exist_ok=True)
+    digest=file_hash(src,sdir)
+    dst=os.path.join(sdir,f'{digest[:16]}-{os.path.basename(src)}')
+    if os.path.isfile(dst) and os.path.getsize(dst) == os.path.getsize(src):
+        return dst
+    print(f'Storing a shared file: {dst}')
+    copy_chunked(src,dst,digest)
+    os.chmod(dst,0o444)
+    return dst
+
+
+def link_image(stored,target):
+    '''
+    Reference a stored image from target with a hard link (symlink as a fallback).
+    '''
+    try:
+        os.link(stored,target)
+    except OSError:
+        os.symlink(stored,target)
+
+
+def _objects(sdir):
+    '''
+    Stored objects of sdir (all files but the hash cache and the copies in progress).
+    '''
+    return [p for p in glob.glob(os.path.join(sdir,'*')) if os.path.isfile(p)
+        and not p.endswith('.partial') and not os.path.basename(p).startswith(HASH_CACHE)]
+
+
+def _clean(sdir,referenced,dry_run):
+    removed=[]
+    for path in _objects(sdir):
+        # hard links from a production keep the link count above 1
+        if os.stat(path).st_nlink > 1 or os.path.realpath(path) in referenced:
+            continue
+        print(f'Removing unreferenced {path}')
+        if not dry_run:
+            os.remove(path)
+        removed.append(path)
+    for partial in glob.glob(os.path.join(sdir,'*.partial')):
+        # a locked partial is a copy in progress
+        try:
+            with open(partial,'ab') as f:
+                fcntl.lockf(f,fcntl.LOCK_EX|fcntl.LOCK_NB)
+                print(f'Removing an incomplete copy {partial}')
+                if not dry_run:
+                    os.remove(partial)
+        except BlockingIOError:
+            print(f'Keeping {partial} (copy in progress)')
+            continue
+        except FileNotFoundError:
+            continue
+        removed.append(partial)
+
+    # forget hashes of objects no longer present (stored names start with the hash)
+    if removed and not dry_run:
+        cache=_load_cache(sdir)
+        present=set(os.path.basename(p)[:16] for p in _objects(sdir))
+        cache={k:v for k,v in cache.items() if v[:16] in present or os.path.exists(k.rsplit(':',2)[0])}
+        _save_cache(sdir,cache)
+    return removed
+
+
+def cleanup(storage_dir,dry_run=False):
+    '''
+    Remove objects in the image store and the campaign asset stores that no production references anymore.
+    '''
+    sdir=store_dir(storage_dir)
+    top=os.path.dirname(sdir)
+    stores=[d for d in [sdir]+glob.glob(os.path.join(top,'campaign_*','assets')) if os.path.isdir(d)]
+    if not stores:
+        print(f'No image store found at {sdir}')
+        return []
+
+    # collect symbolic link targets from all productions
+    referenced=set()
+    for pattern in [('production_*','*'),('production_*','job_shared','*')]:
+        for link in glob.glob(os.path.join(top,*pattern)):
+            if os.path.islink(link):
+                referenced.add(os.path.realpath(link))
+    removed=[]
+    for d in stores:
+        removed+=_clean(d,referenced,dry_run)
+    return removed
+
+
+if __name__ == '__main__':
+    import sys
+    if not len(sys.argv) in [3,4] or not sys.argv[1] == 'cleanup':
+        print(f'Invalid arguments {sys.argv[1:]}')
+        print(f'Usage: {os.path.basename(__file__)} cleanup $STORAGE_DIR [--dry-run]')
+        sys.exit(1)
+
+    dry_run = len(sys.argv) == 4 and sys.argv[3] == '--dry-run'
+    removed = cleanup(sys.argv[2],dry_run)
+    print(f'{"Would remove" if dry_run else "Removed"} {len(removed)} file(s)')
+    sys.exit(0)
@@ -0,0 +1,114 @@
+import os
+import numpy as np
+import h5py
+
+# Compound fields holding an event number. They are shifted when merging so
+# that events from different inputs do not collide.
+EVENT_FIELDS = ['eventID','event_id']
+# Compound fields indexing rows of another dataset, mapped to the dataset name.
+INDEX_FIELDS = dict(track_ids=['segments','tracks'])
+# size of the row blocks read and written at once (bounds the memory of a merge)
+BLOCK_BYTES = 64*1024**2
+
+
+def _block_rows(ds):
+    row_bytes = max(1,ds.dtype.itemsize*int(np.prod(ds.shape[1:])))
+    return max(1,BLOCK_BYTES//row_bytes)
+
+
+def _event_count(f):
+    count = 0
+    for key in f.keys():
+        ds = f[key]
+        if not isinstance(ds,h5py.Dataset) or ds.dtype.names is None or ds.shape[0] < 1:
+            continue
+        for field in EVENT_FIELDS:
+            if not field in ds.dtype.names:
+                continue
+            block = max(1,BLOCK_BYTES//ds.dtype[field].itemsize)
+            for start in range(0,ds.shape[0],block):
+                count = max(count, int(np.max(ds.fields(field)[start:start+block]))+1)
+    return count
+
+
+def _index_offset(f,targets):
+    for name in targets:
+        if name in f and isinstance(f[name],h5py.Dataset):
+            return f[name].shape[0]
+    return 0
+
+
+def merge(inputs,output,counts=None):
+    '''
+    Concatenate all datasets of the input HDF5 files along the first axis into output.
+    Event numbers and row indices (see EVENT_FIELDS and INDEX_FIELDS) are offset per input.
+    The number of events of each input is appended to counts if given.
+    Returns the number of events written.
+    '''
+    if len(inputs) < 1:
+        raise ValueError('No input file to merge')
+
+    event_offset = 0
+    index_offset = {key:0 for key in INDEX_FIELDS}
+    with h5py.File(output,'w') as fout:
+        for i,name in enumerate(inputs):
+            with h5py.File(name,'r') as fin:
+                if i == 0:
+                    for key,val in fin.attrs.items():
+                        fout.attrs[key]=val
+                for key in fin.keys():
+                    ds = fin[key]
+                    if not isinstance(ds,h5py.Dataset):
+                        if i == 0:
+                            fin.copy(ds,fout,name=key)
+                        continue
+                    if ds.ndim < 1:
+                        if i == 0:
+                            fout.create_dataset(key,data=ds[()])
+                        continue
+                    if not key in fout:
+                        fout.create_dataset(key,shape=(0,)+ds.shape[1:],dtype=ds.dtype,maxshape=(None,)+ds.shape[1:],chunks=True)
+                        for akey,aval in ds.attrs.items():
+                            fout[key].attrs[akey]=aval
+                    out = fout[key]
+                    if not out.shape[1:] == ds.shape[1:] or not out.dtype == ds.dtype:
+                        raise ValueError(f'Dataset {key} in {name} does not match the shape/type of the previous inputs')
+                    start = out.shape[0]
+                    out.resize(start+ds.shape[0],axis=0)
+                    # copy in row blocks to bound the memory
+                    block = _block_rows(ds)
+                    for first in range(0,ds.shape[0],block):
+                        data = ds[first:first+block]
+                        if data.dtype.names is not None:
+                            for field in data.dtype.names:
+                                if field in EVENT_FIELDS:
+                                    data[field] += event_offset
+                                elif field in INDEX_FIELDS:
+                                    valid = data[field] >= 0
+                                    data[field][valid] += index_offset[field]
+                        out[start+first:start+first+data.shape[0]] = data
+
+                num_events = _event_count(fin)
+                event_offset += num_events
+                if counts is not None:
+                    counts.append(num_events)
+                for field,targets in INDEX_FIELDS.items():
+                    index_offset[field] += _index_offset(fin,targets)
+
+    return event_offset
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 3:
+        print(f'Invalid number of the arguments ({len(sys.argv)})')
+        print(f'Usage: {os.path.basename(__file__)} $OUTPUT_H5 $INPUT_H5 [$INPUT_H5 ...]')
+        sys.exit(1)
+
+    if os.path.exists(sys.argv[1]):
+        print(f'Output file already exists: {sys.argv[1]}')
+        sys.exit(2)
+
+    num_events = merge(sys.argv[2:],sys.argv[1])
+    print(f'Merged {len(sys.argv)-2} file(s) with {num_events} event(s) into {sys.argv[1]}')
+    sys.exit(0)
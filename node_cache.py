@@ -0,0 +1,52 @@
+import os
+
+# Shell snippets for a node-local cache of immutable job inputs (image, geometry,
+# response files) shared by array tasks landing on the same node. Entries are
+# named by the file hash, filled under an flock, and evicted in LRU order
+# (mtime, refreshed on every use) once the cache exceeds the size cap.
+# Each task hard links the entries it uses into a private directory, so an
+# eviction never removes a file from under a running task.
+
+
+def gen_setup(cache_dir,cap_gb,task_dir):
+    '''
+    Define cache_fetch (HASH SOURCE NAME) which makes SOURCE available as task_dir/NAME.
+    '''
+    cap=int(float(cap_gb)*1024**3)
+    return f'''NODE_CACHE_DIR={cache_dir}
+JOB_CACHE_DIR={task_dir}
+mkdir -p $NODE_CACHE_DIR $JOB_CACHE_DIR
+
+cache_evict() {{
+    local total=$(find $NODE_CACHE_DIR -maxdepth 1 -type f ! -name '.*' -printf '%s\\n' | awk '{{s+=$1}} END {{print s+0}}')
+    find $NODE_CACHE_DIR -maxdepth 1 -type f ! -name '.*' -printf '%T@ %s %p\\n' | sort -n | \\
+    while read MTIME SIZE ENTRY; do
+        [ $total -le {cap} ] && break
+        [ "$ENTRY" == "$1" ] && continue
+        echo "Evicting $ENTRY from the node cache"
+        rm -f $ENTRY
+        total=$((total-SIZE))
+    done
+}}
+
+cache_fetch() {{
+    local entry=$NODE_CACHE_DIR/$1
+    (
+        flock -x 9
+        if [ ! -f $entry ]; then
+            echo "Filling the node cache with $2"
+            cp "$2" $NODE_CACHE_DIR/.$1.$$ && mv $NODE_CACHE_DIR/.$1.$$ $entry
+        else
+            echo "Using the node cache for $2"
+        fi
+        touch $entry
+        ln -f $entry $JOB_CACHE_DIR/$3 2>/dev/null || cp $entry $JOB_CACHE_DIR/$3
+        cache_evict $entry
+    ) 9>$NODE_CACHE_DIR/.lock
+    [ -f $JOB_CACHE_DIR/$3 ] || cp "$2" $JOB_CACHE_DIR/$3
+}}
+'''
+
+
+def gen_fetch(digest,src,name):
+    return f'cache_fetch {digest} {src} {name}\n'
@@ -1,14 +1,37 @@
-import yaml, os, pathlib, shutil
-import numpy as np
+import yaml, os, math, pathlib, shutil, time, secrets
+import image_store
+import staging
+import node_cache
+import stage_metrics
+import resources
+import checkpoint
+import work_queue
+import resolve_cache
+import scheduler
 from yaml import Loader
 from datetime import timedelta
 
+def production_id():
+    '''
+    Collision-free production ID: creation time and a random suffix.
+    '''
+    return f'{time.strftime("%Y%m%d%H%M%S")}-{secrets.token_hex(3)}'
+
+
 class project_base():
 
     def __init__(self):
         self.COPY_FILES=[]
+        self.SHARED_FILES=[]
+        self.FILE_HASHES={}
         self.PROJECT_SCRIPT=''
         self.BIND_PATHS=[]
+        self.JOB_SCRIPTS={}
+        self.SUBMIT_COMMAND='sbatch'
+        # suffixes of the outputs merged into shards (MERGE_SHARD_GB)
+        self.MERGE_OUTPUTS=[]
+        # cache of resolved paths (RESOLVE_CACHE), set by parse
+        self.RESOLVE_CACHE=None
 
     def get_top_dir(self,path):
         p=pathlib.Path(path)
@@ -29,15 +52,21 @@ class project_base():
         Fill the contents of a project script in self.PROJECT_SCRIPT attribute.
         Fill the list of files to be copied to self.COPY_FILES.
         Those files will be available under the job directory with the same name.
+        Files larger than SHARED_FILE_MB are placed read-only in a shared directory
+        and symlinked into the job directory instead of being copied per job.
         '''
         pass
 
+    def resolved(self,key,compute):
+        '''
+        Returns the value of compute() => (value, [paths the value depends on]) through the resolve cache.
+        '''
+        if self.RESOLVE_CACHE is None:
+            return compute()[0]
+        return self.RESOLVE_CACHE.get(key,compute)
+
     def parse(self,data):
-        cfg = yaml.safe_load(data)
-        # SLURM_TIME converted to seconds automatically
-        # convert back to HH:MM:SS format
-        cfg['SLURM_TIME'] = str(timedelta(seconds=cfg['SLURM_TIME']))
-        res = dict(cfg)
+        cfg = resolve_cache.load(data)
 
         # Check the storage directory and create this job's output directory
         if not 'STORAGE_DIR' in cfg:
@@ -45,30 +74,114 @@ class project_base():
         if not os.path.isdir(os.path.expandvars(cfg['STORAGE_DIR'])):
             raise FileNotFoundError(f'Storage path {cfg["STORAGE_DIR"]} is invalid.')
 
-        sdir=os.path.abspath(os.path.join(os.path.expandvars(cfg['STORAGE_DIR']),f'production_{os.getpid()}'))
+        # productions with the same fingerprint are used to choose TOTAL_EVENTS
+        # splitting and to right-size SLURM_AUTO requests
+        fingerprint = resources.fingerprint(cfg)
+        resources.plan(cfg,os.path.expandvars(cfg['STORAGE_DIR']))
+
+        # SLURM_TIME converted to seconds automatically
+        # convert back to HH:MM:SS format
+        time_limit = int(cfg['SLURM_TIME'])
+        cfg['SLURM_TIME'] = str(timedelta(seconds=cfg['SLURM_TIME']))
+        res = dict(cfg)
+        res['CONFIG_FINGERPRINT'] = fingerprint
+
+        # a campaign sets the IDs of its productions
+        res['PRODUCTION_ID']=str(cfg['PRODUCTION_ID']) if 'PRODUCTION_ID' in cfg else production_id()
+        sdir=os.path.abspath(os.path.join(os.path.expandvars(cfg['STORAGE_DIR']),f'production_{res["PRODUCTION_ID"]}'))
         if os.path.isdir(sdir):
             raise OSError(f'Storage directory already have a sub-dir {sdir}')
         res['STORAGE_DIR']=sdir
+        res['STORAGE_TOP_DIR']=os.path.dirname(sdir)
+
+        # resolved asset paths are cached in the storage directory (or a given file)
+        res['RESOLVE_CACHE']=cfg.get('RESOLVE_CACHE',True)
+        if res['RESOLVE_CACHE']:
+            path=res['RESOLVE_CACHE'] if isinstance(res['RESOLVE_CACHE'],str) else os.path.join(res['STORAGE_TOP_DIR'],resolve_cache.CACHE_NAME)
+            self.RESOLVE_CACHE=resolve_cache.resolve_cache(path)
 
         # define a job source directory
         res['JOB_SOURCE_DIR'] = os.path.join(sdir,'job_source')
+        # read-only directory for large immutable inputs shared by all jobs
+        res['JOB_SHARED_DIR'] = os.path.join(sdir,'job_shared')
+        res['SHARED_FILE_MB'] = float(cfg.get('SHARED_FILE_MB',10))
+        # size cap of the node-local cache of the image and shared files (0 to disable)
+        res['NODE_CACHE_GB'] = float(cfg.get('NODE_CACHE_GB',0))
+        # content-addressed store the shared files are linked from (set by a campaign to store them once)
+        res['ASSET_STORE_DIR'] = cfg.get('ASSET_STORE_DIR',None)
+        # maximum number of array tasks running at once (0 for no limit)
+        res['SLURM_ARRAY_THROTTLE'] = int(cfg.get('SLURM_ARRAY_THROTTLE',0))
 
         # add job work directory and output name
         res['JOB_WORK_DIR'  ] = 'job_${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}'
         res['JOB_OUTPUT_ID' ] = 'output_${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}'
         res['JOB_LOG_DIR'   ] = os.path.join(res['STORAGE_DIR'],'slurm_logs')
 
+        # number of independent chains (one GPU each) packed in an allocation;
+        # SLURM_CPU and SLURM_MEM are then per chain
+        res['SLURM_GPU_PACK'] = int(cfg.get('SLURM_GPU_PACK',1))
+        if res['SLURM_GPU_PACK'] < 1:
+            raise ValueError('SLURM_GPU_PACK must be positive.')
+        if res['SLURM_GPU_PACK'] > 1:
+            if not 'SLURM_GPU' in cfg:
+                raise KeyError('SLURM_GPU_PACK requires SLURM_GPU.')
+            res['JOB_OUTPUT_ID'] += '_${DNTP_CHAIN}'
+
+        # output staging options
+        staging.parse_config(cfg,res)
+
+        # checkpoints of finished stages, restored when a task is resubmitted
+        checkpoint.parse_config(cfg,res)
+
+        # persistent workers: WORKER_COUNT array tasks process SLURM_NUM_JOBS units from a queue
+        # until the queue is empty or less than WORKER_RESERVE seconds (for staging out) are left
+        res['WORKER_MODE']=bool(cfg.get('WORKER_MODE',False))
+        if res['WORKER_MODE']:
+            if not 'WORKER_COUNT' in cfg:
+                raise KeyError('WORKER_COUNT must be specified with WORKER_MODE.')
+            if res['CHECKPOINT'] or res['SLURM_GPU_PACK'] > 1:
+                raise ValueError('WORKER_MODE cannot be used with CHECKPOINT or SLURM_GPU_PACK.')
+            res['WORKER_COUNT']=int(cfg['WORKER_COUNT'])
+            res['WORKER_RESERVE']=int(cfg.get('WORKER_RESERVE',600))
+            res['WORKER_TIME_BUDGET']=time_limit-res['WORKER_RESERVE']
+            if res['WORKER_COUNT'] < 1 or res['WORKER_TIME_BUDGET'] < 1:
+                raise ValueError('WORKER_COUNT must be positive and WORKER_RESERVE shorter than SLURM_TIME.')
+            res['WORKER_QUEUE_DIR']=os.path.join(sdir,'queue')
+
+        # backend running the array: slurm (sbatch) or pool (process pool on this machine)
+        res['SCHEDULER']=cfg.get('SCHEDULER','slurm')
+        if not res['SCHEDULER'] in ['slurm','pool']:
+            raise ValueError(f'SCHEDULER must be slurm or pool (given: {res["SCHEDULER"]})')
+
+        # optional job merging the outputs into shards once the array is over
+        res['MERGE_SHARD_GB']=float(cfg.get('MERGE_SHARD_GB',0))
+        if res['MERGE_SHARD_GB'] > 0:
+            res['MERGE_DIR']=os.path.join(sdir,'shards')
+            res['MERGE_PARTITION']=cfg.get('MERGE_PARTITION',cfg['SLURM_PARTITION'])
+            res['MERGE_TIME']=str(timedelta(seconds=cfg['MERGE_TIME'])) if 'MERGE_TIME' in cfg else res['SLURM_TIME']
+            res['MERGE_REMOVE_INPUTS']=bool(cfg.get('MERGE_REMOVE_INPUTS',False))
+            if res['SCHEDULER'] == 'pool':
+                raise ValueError('MERGE_SHARD_GB cannot be used with SCHEDULER pool.')
+
+        # per-stage resource metrics (one file per array job, next to the outputs;
+        # staging out is recorded in a separate file written after the stage manifest)
+        res['METRICS']=bool(cfg.get('METRICS',True))
+        res['JOB_METRICS_NAME']='metrics_${SLURM_ARRAY_JOB_ID}.jsonl'
+
         # ensure singularity image is valid
         if not 'SINGULARITY_IMAGE' in cfg:
             raise KeyError('SINGULARITY_IMAGE must be specified in the config.')
-        if not os.path.isfile(os.path.expandvars(cfg['SINGULARITY_IMAGE'])):
-            raise FileNotFoundError(f'Singularity image invalid in the config:{cfg["SINGULARITY_IMAGE"]}')
-        # resolve symbolic link
-        res['SINGULARITY_IMAGE']=os.path.abspath(os.path.realpath(os.path.expandvars(cfg['SINGULARITY_IMAGE'])))
+        image=os.path.expandvars(cfg['SINGULARITY_IMAGE'])
+        def resolve_image():
+            if not os.path.isfile(image):
+                raise FileNotFoundError(f'Singularity image invalid in the config:{cfg["SINGULARITY_IMAGE"]}')
+            # resolve symbolic link
+            return os.path.abspath(os.path.realpath(image)),[image]
+        res['SINGULARITY_IMAGE']=self.resolved(resolve_cache.cache_key('image',image),resolve_image)
 
         # define a copied image name
         if cfg.get('STORE_IMAGE',True):
-            res['JOB_IMAGE_NAME']=os.path.join(sdir,f'image_{os.getpid()}.sif')
+            res['JOB_IMAGE_NAME']=os.path.join(sdir,f'image_{res["PRODUCTION_ID"]}.sif')
             res['STORE_IMAGE']=True
         else:
             res['JOB_IMAGE_NAME']=res['SINGULARITY_IMAGE']
@@ -82,42 +195,119 @@ class project_base():
         return res
 
 
-    def gen_submission_script(self,cfg):
+    def metered(self,cfg,stage,cmd):
+        '''
+        Wrap a shell command so that stage_metrics.py records the resource usage of the stage.
+        '''
+        if not cfg['METRICS']:
+            return cmd
+        return f'python3 stage_metrics.py {stage} {cfg["JOB_METRICS_NAME"]} -- {cmd}'
 
-        # singularity bind flag
+
+    def bind_flag(self):
+        '''
+        Singularity bind flag for BIND_PATHS.
+        '''
         bflag = None
-        for pt in np.unique(self.BIND_PATHS):
+        for pt in sorted(set(self.BIND_PATHS)):
             if bflag is None:
                 bflag=f'-B {str(pt)}'
             else:
                 bflag += f',{str(pt)}'
+        return bflag
+
+
+    def gen_submission_script(self,cfg,run_script='run.sh',job_name=None,partition=None,time=None,
+        use_gpu=True,array_job_id='$SLURM_ARRAY_JOB_ID'):
+        '''
+        Generate a SLURM array submission script that runs run_script in the singularity session.
+        Keyword arguments override the partition/time/GPU request of the configuration so that
+        a project can generate several stage scripts. array_job_id sets the job ID used to name
+        the work directory (use a shared ID to let chained stages write into the same directory).
+        '''
+        if job_name is None:
+            job_name = f'dntp-{cfg["PRODUCTION_ID"]}'
+        if partition is None:
+            partition = cfg['SLURM_PARTITION']
+        if time is None:
+            time = cfg['SLURM_TIME']
+
+        bflag = self.bind_flag()
 
         script=f'''#!/bin/bash
-#SBATCH --job-name=dntp-{os.getpid()}
+#SBATCH --job-name={job_name}
 #SBATCH --nodes=1
-#SBATCH --partition={cfg['SLURM_PARTITION']}
+#SBATCH --partition={partition}
 #SBATCH --output={cfg['JOB_LOG_DIR']}/slurm-%A-%a.out
 #SBATCH --error={cfg['JOB_LOG_DIR']}/slurm-%A-%a.out
 #SBATCH --ntasks=1
-#SBATCH --cpus-per-task={cfg['SLURM_CPU']}
-#SBATCH --mem-per-cpu={round(cfg['SLURM_MEM']/cfg['SLURM_CPU'])}G
-#SBATCH --time={cfg['SLURM_TIME']}                                                                                                
-#SBATCH --array=1-{cfg['SLURM_NUM_JOBS']}
+#SBATCH --cpus-per-task={cfg['SLURM_CPU']*cfg['SLURM_GPU_PACK']}
+#SBATCH --mem-per-cpu={math.ceil(cfg['SLURM_MEM']/cfg['SLURM_CPU'])}G
+#SBATCH --time={time}                                                                                                
+#SBATCH --array=1-{cfg['WORKER_COUNT'] if cfg['WORKER_MODE'] else cfg['SLURM_NUM_JOBS']}{'%'+str(cfg['SLURM_ARRAY_THROTTLE']) if cfg['SLURM_ARRAY_THROTTLE'] > 0 else ''}
 '''
-        if 'SLURM_GPU' in cfg:
-            script += f'#SBATCH --gpus={cfg["SLURM_GPU"]}:1\n'
+        if use_gpu and 'SLURM_GPU' in cfg:
+            script += f'#SBATCH --gpus={cfg["SLURM_GPU"]}:{cfg["SLURM_GPU_PACK"]}\n'
         if 'SLURM_EXCLUDE' in cfg:
             script += f'#SBATCH --exclude="{cfg["SLURM_EXCLUDE"]}"\n'
         if 'SLURM_NODELIST' in cfg:
             script += f'#SBATCH --nodelist="{cfg["SLURM_EXCLUDE"]}"\n'
+        if cfg['CHECKPOINT']:
+            # signal the batch script (not the job steps) ahead of the time limit
+            script += f'#SBATCH --signal=B:TERM@{cfg["CHECKPOINT_GRACE"]}\n'
+            script += '#SBATCH --requeue\n'
+
+        # resubmitted tasks with verified outputs exit right away
+        checkpoint_setup = ''
+        if cfg['CHECKPOINT']:
+            checkpoint_setup = checkpoint.gen_task_dir(cfg) + checkpoint.gen_task_functions()
+            checkpoint_setup += f'''if ckpt_complete {run_script}; then
+    echo "Task already completed in $(cat $CKPT_DIR/{run_script}.done)"
+    exit 0
+fi
+'''
+
+        # stage in the job source, and the image and shared files through the node cache if enabled
+        image = cfg['JOB_IMAGE_NAME']
+        if cfg['NODE_CACHE_GB'] > 0:
+            stage_in = node_cache.gen_setup(os.path.join(cfg['SLURM_WORK_DIR'],'dntp_cache'),
+                cfg['NODE_CACHE_GB'],
+                os.path.join(cfg['SLURM_WORK_DIR'],'$JOB_WORK_DIR.cache'))
+            stage_in += node_cache.gen_fetch(self.FILE_HASHES[cfg['SINGULARITY_IMAGE']],image,os.path.basename(image))
+            image = '$JOB_CACHE_DIR/'+os.path.basename(image)
+            stage_in += staging.gen_stage_in(cfg,cfg['JOB_SOURCE_DIR'],'$JOB_WORK_DIR')+'\n'
+            for f in self.SHARED_FILES:
+                name = os.path.basename(f)
+                stage_in += node_cache.gen_fetch(self.FILE_HASHES[f],os.path.join(cfg['JOB_SHARED_DIR'],name),name)
+                stage_in += f'ln -s $JOB_CACHE_DIR/{name} $JOB_WORK_DIR/{name}\n'
+        else:
+            stage_in = staging.gen_stage_in(cfg,cfg['JOB_SOURCE_DIR'],'$JOB_WORK_DIR',
+                cfg['JOB_SHARED_DIR'] if self.SHARED_FILES else None)
+
+        payload = f'singularity exec --nv {bflag} {image} ./{run_script}'
+        if use_gpu and cfg['SLURM_GPU_PACK'] > 1:
+            payload = self.gen_packed_payload(cfg,payload)
+        elif cfg['CHECKPOINT']:
+            # run in the background so that the trap fires while waiting, then stage out what exists
+            payload = f'''{payload} &
+PAYLOAD=$!
+trap 'echo "Caught SIGTERM, stopping the job and flushing partial results"; kill -TERM $PAYLOAD; wait $PAYLOAD' TERM
+wait $PAYLOAD
+STATUS=$?
+trap - TERM'''
+        else:
+            payload += '\nSTATUS=$?'
 
         script += f'''
 mkdir -p {cfg['SLURM_WORK_DIR']} 
 cd {cfg['SLURM_WORK_DIR']}
 
-JOB_WORK_DIR=$(printf "job_%d_%04d" $SLURM_ARRAY_JOB_ID $SLURM_ARRAY_TASK_ID)
-
-scp -r {cfg['JOB_SOURCE_DIR']} $JOB_WORK_DIR
+JOB_WORK_DIR=$(printf "job_%d_%04d" {array_job_id} $SLURM_ARRAY_TASK_ID)
+{checkpoint_setup}
+{stage_metrics.gen_record_function() if cfg['METRICS'] else ''}
+STAGE_START=$(date +%s.%N)
+{stage_in}
+STAGE_END=$(date +%s.%N)
 
 cd $JOB_WORK_DIR
 
@@ -125,21 +315,129 @@ export PATH=$HOME/.local/bin:$PATH
 
 printenv &> jobinfo_env.txt
 uname -a &> jobinfo_node.txt
+{'metrics_record stagein $STAGE_START $STAGE_END $(du -sb . | cut -f1) 0 '+cfg['JOB_METRICS_NAME'] if cfg['METRICS'] else ''}
 
-chmod 774 run.sh
+chmod 774 {run_script}
 
-singularity exec --nv {bflag} {cfg['JOB_IMAGE_NAME']} ./run.sh
+{payload}
 
 date
 echo "Copying the output"
 
 cd ..
-scp -r $JOB_WORK_DIR {cfg['STORAGE_DIR']}/
-    
+STAGE_START=$(date +%s.%N)
+{staging.gen_stage_out(cfg,'$JOB_WORK_DIR',cfg['STORAGE_DIR']+'/$JOB_WORK_DIR')}
+{'metrics_record stageout $STAGE_START $(date +%s.%N) $STAGE_BYTES $STATUS '+cfg['STORAGE_DIR']+'/$JOB_WORK_DIR/'+cfg['JOB_METRICS_NAME'].replace('.jsonl','_stageout.jsonl') if cfg['METRICS'] else ''}
+{'[ $STATUS -eq 0 ] && ckpt_finish '+run_script+' '+cfg['STORAGE_DIR']+'/$JOB_WORK_DIR' if cfg['CHECKPOINT'] else ''}
+{'rm -rf $JOB_CACHE_DIR' if cfg['NODE_CACHE_GB'] > 0 else ''}
+# report the job script status (used by dependent arrays)
+exit $STATUS
     '''
         return script
 
 
+    def gen_packed_payload(self,cfg,payload):
+        '''
+        Run SLURM_GPU_PACK copies of payload in the background, each in a chain_N sub-directory
+        of the job work directory (with links to the staged inputs), pinned to one GPU and to
+        an equal share of the allocated CPUs. Outputs and records are moved up when all are done.
+        '''
+        num_chains = cfg['SLURM_GPU_PACK']
+        ckpt = 'CKPT_DIR=$CKPT_DIR/chain_$DNTP_CHAIN ' if cfg['CHECKPOINT'] else ''
+        return f'''GPU_LIST=(${{CUDA_VISIBLE_DEVICES//,/ }})
+CPU_LIST=($(awk '/^Cpus_allowed_list/ {{n=split($2,r,","); for(i=1;i<=n;i++) {{split(r[i],b,"-"); if(b[2]=="") b[2]=b[1]; for(c=b[1];c<=b[2];c++) printf "%d ", c}}}}' /proc/self/status))
+CPUS_PER_CHAIN=$(( ${{#CPU_LIST[@]}} / {num_chains} ))
+PAYLOAD=""
+for DNTP_CHAIN in $(seq 0 {num_chains-1}); do
+    mkdir chain_$DNTP_CHAIN
+    for f in *; do
+        [[ $f == chain_* ]] || ln -s ../$f chain_$DNTP_CHAIN/$f
+    done
+    {'mkdir -p $CKPT_DIR/chain_$DNTP_CHAIN' if cfg['CHECKPOINT'] else ''}
+    PIN=""
+    if [ $CPUS_PER_CHAIN -gt 0 ] && command -v taskset &> /dev/null; then
+        PIN="taskset -c $(echo ${{CPU_LIST[@]:$((DNTP_CHAIN*CPUS_PER_CHAIN)):$CPUS_PER_CHAIN}} | tr ' ' ',')"
+    fi
+    echo "Starting chain $DNTP_CHAIN on GPU ${{GPU_LIST[$DNTP_CHAIN]:-$DNTP_CHAIN}} $PIN"
+    (cd chain_$DNTP_CHAIN && DNTP_CHAIN=$DNTP_CHAIN CUDA_VISIBLE_DEVICES=${{GPU_LIST[$DNTP_CHAIN]:-$DNTP_CHAIN}} {ckpt}exec $PIN {payload}) &> chain_$DNTP_CHAIN/log_chain.txt &
+    PAYLOAD="$PAYLOAD $!"
+done
+trap 'echo "Caught SIGTERM, stopping the chains and flushing partial results"; kill -TERM $PAYLOAD; wait' TERM
+STATUS=0
+for P in $PAYLOAD; do
+    wait $P || STATUS=$?
+done
+trap - TERM
+for DNTP_CHAIN in $(seq 0 {num_chains-1}); do
+    find chain_$DNTP_CHAIN -maxdepth 1 -type l -delete
+    mv chain_$DNTP_CHAIN/output_* . 2> /dev/null
+    # records (metrics, seeds) are appended to the files of the job directory
+    for f in chain_$DNTP_CHAIN/*.jsonl; do
+        [ -f $f ] && cat $f >> $(basename $f) && rm $f
+    done
+done'''
+
+
+    def gen_submit_scripts(self,cfg):
+        '''
+        Returns a dictionary of submission script names and contents to be written in the job source.
+        A project may override this to generate several (chained) submission scripts.
+        The entry point must be named submit.sh and is run with self.SUBMIT_COMMAND.
+        '''
+        if cfg['WORKER_MODE']:
+            return {'submit.sh':self.gen_submission_script(cfg,run_script='worker.sh')}
+        return {'submit.sh':self.gen_submission_script(cfg)}
+
+
+    def gen_merge_scripts(self,cfg,scripts):
+        '''
+        Add submit_merge.sh (shard.py over MERGE_OUTPUTS in a single job) to the submission scripts,
+        and chain it after the production: an sbatch entry point is renamed submit_array.sh and
+        wrapped, a bash entry point must set LAST_JOB_ID to the job the merge depends on.
+        '''
+        outputs = cfg.get('MERGE_OUTPUTS',self.MERGE_OUTPUTS)
+        if not outputs:
+            raise ValueError('MERGE_SHARD_GB requires MERGE_OUTPUTS (suffixes of the outputs to merge).')
+        jsdir = cfg['JOB_SOURCE_DIR']
+        # the merge tools may have been placed in the shared directory (SHARED_FILE_MB)
+        tools = [jsdir]+[cfg['JOB_SHARED_DIR']]*(len(self.SHARED_FILES)>0)
+        shard = [f for f in self.COPY_FILES if os.path.basename(f) == 'shard.py'][0]
+        shard = os.path.join(cfg['JOB_SHARED_DIR'] if shard in self.SHARED_FILES else jsdir,'shard.py')
+        scripts['submit_merge.sh'] = f'''#!/bin/bash
+#SBATCH --job-name=dntp-{cfg['PRODUCTION_ID']}-merge
+#SBATCH --nodes=1
+#SBATCH --partition={cfg['MERGE_PARTITION']}
+#SBATCH --output={cfg['JOB_LOG_DIR']}/slurm-%j-merge.out
+#SBATCH --error={cfg['JOB_LOG_DIR']}/slurm-%j-merge.out
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task=1
+#SBATCH --mem={cfg['SLURM_MEM']}G
+#SBATCH --time={cfg['MERGE_TIME']}
+
+cd {jsdir}
+export PYTHONPATH={':'.join(tools)}:$PYTHONPATH
+singularity exec {self.bind_flag()} {cfg['JOB_IMAGE_NAME']} python3 {shard} {cfg['STORAGE_DIR']} {cfg['MERGE_DIR']} {cfg['MERGE_SHARD_GB']} {' '.join(outputs)} {'--remove-inputs' if cfg['MERGE_REMOVE_INPUTS'] else ''}
+'''
+        if self.SUBMIT_COMMAND == 'sbatch':
+            scripts['submit_array.sh'] = scripts['submit.sh']
+            scripts['submit.sh'] = f'''#!/bin/bash
+LAST_JOB_ID=$(sbatch --parsable {os.path.join(jsdir,'submit_array.sh')})
+LAST_JOB_ID=${{LAST_JOB_ID%%;*}}
+if [ -z "$LAST_JOB_ID" ]; then
+    echo "Failed to submit the array"
+    exit 1
+fi
+echo "Submitted the array $LAST_JOB_ID"
+'''
+            self.SUBMIT_COMMAND = 'bash'
+        scripts['submit.sh'] += f'''
+# merge whatever the production produced once it is over
+MERGE_JOB_ID=$(sbatch --parsable --dependency=afterany:$LAST_JOB_ID {os.path.join(jsdir,'submit_merge.sh')})
+echo "Submitted the merge job ${{MERGE_JOB_ID%%;*}} (depends on $LAST_JOB_ID)"
+'''
+        return scripts
+
+
     def generate(self,cfg):
         
         if cfg.endswith('.yaml'):
@@ -148,7 +446,6 @@ scp -r $JOB_WORK_DIR {cfg['STORAGE_DIR']}/
 
         # parse the configuration            
         cfg = self.parse(cfg)
-        cfg_data = yaml.dump(cfg,default_flow_style=False)
 
         jsdir = cfg['JOB_SOURCE_DIR']
         sdir  = cfg['STORAGE_DIR']
@@ -156,9 +453,11 @@ scp -r $JOB_WORK_DIR {cfg['STORAGE_DIR']}/
 
         try:
             # Report the job top directory and clean-up method
-            print(f'Constructing a new production with ID {os.getpid()}')
+            print(f'Constructing a new production with ID {cfg["PRODUCTION_ID"]}')
             print('\nTo clean up this production, simply execute the master directory:')
-            print(f'\n    rm -r {sdir}\n')
+            print(f'\n    rm -rf {sdir}\n')
+            print('and then release images no longer used by any production:')
+            print(f'\n    python3 image_store.py cleanup {cfg["STORAGE_TOP_DIR"]}\n')
             # Create the job source and the storage directories
             print(f'Creating a dir: {sdir}')
             os.makedirs(sdir)
@@ -168,14 +467,10 @@ scp -r $JOB_WORK_DIR {cfg['STORAGE_DIR']}/
             os.makedirs(ldir)
             print(f'Using a singularity image: {cfg["SINGULARITY_IMAGE"]}')
             if cfg['STORE_IMAGE']:
-                print('Copying the singularity image file.')
-                print(f'Destination: {cfg["JOB_IMAGE_NAME"]}')
-                shutil.copyfile(cfg['SINGULARITY_IMAGE'],cfg['JOB_IMAGE_NAME'])
-
-            # Generate a submission script
-            with open(os.path.join(jsdir,'submit.sh'),'w') as f:
-                f.write(self.gen_submission_script(cfg))
-                f.close()
+                print('Storing the singularity image file.')
+                stored=image_store.store_image(cfg['SINGULARITY_IMAGE'],cfg['STORAGE_TOP_DIR'])
+                print(f'Linking: {cfg["JOB_IMAGE_NAME"]} => {stored}')
+                image_store.link_image(stored,cfg['JOB_IMAGE_NAME'])
 
             #
             # Perform project-specific tasks
@@ -184,27 +479,73 @@ scp -r $JOB_WORK_DIR {cfg['STORAGE_DIR']}/
             self.parse_project_config(cfg)
             # Generate a project script contents
             self.gen_project_script(cfg)
+            if cfg['WORKER_MODE']:
+                self.JOB_SCRIPTS['worker.sh']=work_queue.gen_worker_script(cfg)
+                print(f'Creating a queue of {cfg["SLURM_NUM_JOBS"]} unit(s) for {cfg["WORKER_COUNT"]} worker(s): {cfg["WORKER_QUEUE_DIR"]}')
+                work_queue.create(cfg['WORKER_QUEUE_DIR'],int(cfg['SLURM_NUM_JOBS']))
+            if cfg['METRICS']:
+                self.COPY_FILES.append(os.path.join(pathlib.Path(__file__).parent.resolve(),'stage_metrics.py'))
+            if cfg['MERGE_SHARD_GB'] > 0:
+                for name in ['shard.py','merge_h5.py']:
+                    path = os.path.join(pathlib.Path(__file__).parent.resolve(),name)
+                    if not path in self.COPY_FILES:
+                        self.COPY_FILES.append(path)
+            # Large files go to the shared directory
+            for f in self.COPY_FILES:
+                if os.path.getsize(f) >= cfg['SHARED_FILE_MB']*1024*1024:
+                    self.SHARED_FILES.append(f)
+            # Hash the files going through the node cache (hashes cached with the image store)
+            if cfg['NODE_CACHE_GB'] > 0:
+                hdir=image_store.store_dir(cfg['STORAGE_TOP_DIR'])
+                os.makedirs(hdir,exist_ok=True)
+                for f in self.SHARED_FILES+[cfg['SINGULARITY_IMAGE']]:
+                    self.FILE_HASHES[f]=image_store.file_hash(f,hdir)
             # Generate a job script
             with open(os.path.join(jsdir,'run.sh'),'w') as f:
                 f.write(self.PROJECT_SCRIPT)
                 f.close()
+            for name,contents in self.JOB_SCRIPTS.items():
+                with open(os.path.join(jsdir,name),'w') as f:
+                    f.write(contents)
+                    f.close()
+            # Generate submission scripts (after the project config may have added bind paths)
+            scripts = self.gen_submit_scripts(cfg)
+            if cfg['MERGE_SHARD_GB'] > 0:
+                scripts = self.gen_merge_scripts(cfg,scripts)
+            if self.SUBMIT_COMMAND == 'sbatch':
+                self.SUBMIT_COMMAND = scheduler.submit_command(cfg)
+            for name,contents in scripts.items():
+                with open(os.path.join(jsdir,name),'w') as f:
+                    f.write(contents)
+                    f.close()
             # Copy necessary files
             for f in self.COPY_FILES:
                 src,target=f,os.path.basename(f)
-                shutil.copyfile(src,os.path.join(jsdir,target))
+                if f in self.SHARED_FILES:
+                    os.makedirs(cfg['JOB_SHARED_DIR'],exist_ok=True)
+                    target=os.path.join(cfg['JOB_SHARED_DIR'],target)
+                    if cfg['ASSET_STORE_DIR']:
+                        image_store.link_image(image_store.store_file(src,cfg['ASSET_STORE_DIR']),target)
+                    else:
+                        shutil.copyfile(src,target)
+                        os.chmod(target,0o444)
+                else:
+                    shutil.copyfile(src,os.path.join(jsdir,target))
 
             #
-            # Log the config contents
+            # Log the config contents (including values set by the project, e.g. seeds)
             #
             with open(os.path.join(jsdir,'source.yaml'),'w') as f:
-                f.write(cfg_data)
+                f.write(resolve_cache.dump(cfg))
                 f.close()
+            if self.RESOLVE_CACHE is not None:
+                self.RESOLVE_CACHE.save()
 
 
         except (KeyError, ValueError, OSError, IsADirectoryError) as e:
             if os.path.isdir(jsdir):
                 shutil.rmtree(jsdir)
-            if cfg['STORE_IMAGE'] and os.path.isfile(cfg['JOB_IMAGE_NAME']):
+            if cfg['STORE_IMAGE'] and os.path.lexists(cfg['JOB_IMAGE_NAME']):
                 os.remove(cfg['JOB_IMAGE_NAME'])
             if os.path.isdir(sdir):
                 shutil.rmtree(sdir)
@@ -215,7 +556,7 @@ scp -r $JOB_WORK_DIR {cfg['STORAGE_DIR']}/
 
         print(f'Created job source scripts at {jsdir}')
         print(f'Job output will be sent to {sdir}')
-        print(f'\nTo submit a job, type:\n\nsbatch {os.path.join(jsdir,"submit.sh")}\n')
+        print(f'\nTo submit a job, type:\n\n{self.SUBMIT_COMMAND} {os.path.join(jsdir,"submit.sh")}\n')
         return True
 
 
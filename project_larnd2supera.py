@@ -1,54 +1,128 @@
-import glob, os
-import numpy as np
-import larnd2supera
+import os, re, math, heapq, importlib.util
+import yaml
+import conversion_manifest
+import resolve_cache
+from fast_glob import fast_glob
+from scheduler import array_spec
 from project_base import project_base
 
 
+# size in bytes of a record in flist.idx (job byte offset and file count)
+INDEX_RECORD_SIZE=32
+
 class project_larnd2supera(project_base):
 
+    def __init__(self):
+        super().__init__()
+        self.FILE_SIZES=dict()
+        self.MERGE_OUTPUTS=['-larcv.root']
+
     def parse_project_config(self,cfg):
 
         if not 'SUPERA_CONFIG' in cfg:
             raise KeyError(f'SUPERA_CONFIG key is missing in the configuration data!\n{cfg}')
 
-        # make sure config is valid
-        valid_configs = larnd2supera.config.list_config()
+        # make sure config is valid (larnd2supera is imported only when the cached list is stale)
+        valid_configs = self.resolved(resolve_cache.cache_key('supera_configs',_package_dirs('larnd2supera')),
+            _supera_configs)
         if not cfg['SUPERA_CONFIG'] in valid_configs:
             if not os.path.isfile(cfg['SUPERA_CONFIG']):
                 raise FileNotFoundError(f'SUPERA_CONFIG {cfg["SUPERA_CONFIG"]} not found.')
             self.COPY_FILES.append(cfg['SUPERA_CONFIG'])
             cfg['SUPERA_CONFIG'] = os.path.basename(cfg['SUPERA_CONFIG'])
 
-        filelist = glob.glob(os.path.expandvars(cfg['GLOB']))
-        if len(filelist) < 1:
+        # expand GLOB in parallel and validate HDF5 headers in the same pass
+        cache_file = None
+        if cfg.get('GLOB_CACHE',False):
+            cache_file = os.path.join(cfg['STORAGE_TOP_DIR'],'glob_cache.json')
+        scanner = fast_glob(cfg.get('GLOB_THREADS',16),cache_file)
+        found = scanner.glob(cfg['GLOB'],validate=cfg.get('GLOB_VALIDATE',True))
+        if len(found) < 1:
             raise KeyError(f'GLOB {cfg["GLOB"]} returned no file!')
 
-        # assert the file count matches the requested job count
-        if not len(filelist) == int(cfg['SLURM_NUM_JOBS']):
-            print(f'GLOB {cfg["GLOB"]} returned {len(filelist)} files')
-            print(f'But requested job count is {cfg["SLURM_NUM_JOBS"]} (must match)')
-            raise ValueError(f'GLOB {cfg["GLOB"]} returned unexpected file count')
-
-        # create a filelist
-        with open(os.path.join(cfg['JOB_SOURCE_DIR'],'flist.txt'),'w') as f:
-            for name in filelist:
-                f.write(os.path.abspath(name)+'\n')
-                self.BIND_PATHS.append(self.get_top_dir(name))
-
-        script = '''
-import sys
-jobid = int(sys.argv[1])-1
-print(open('flist.txt','r').read().split()[jobid])
+        filelist = [name for name,_ in found]
+        self.FILE_SIZES = dict(found)
+
+        # skip inputs that were already converted and did not change since
+        if cfg.get('INCREMENTAL',False):
+            manifest = conversion_manifest.sync(cfg['STORAGE_TOP_DIR'])
+            num_files = len(filelist)
+            filelist = [name for name in filelist if not conversion_manifest.is_converted(manifest,name)]
+            print(f'INCREMENTAL: skipping {num_files-len(filelist)} already converted file(s) out of {num_files}')
+            if len(filelist) < 1:
+                raise ValueError(f'GLOB {cfg["GLOB"]} returned no new file to convert')
+
+        # group files into array tasks
+        if 'FILES_PER_JOB' in cfg and 'TARGET_JOB_COUNT' in cfg:
+            raise ValueError('Only one of FILES_PER_JOB and TARGET_JOB_COUNT can be specified.')
+        if 'FILES_PER_JOB' in cfg or 'TARGET_JOB_COUNT' in cfg:
+            if int(cfg.get('FILES_PER_JOB',1)) < 1 or int(cfg.get('TARGET_JOB_COUNT',1)) < 1:
+                raise ValueError('FILES_PER_JOB and TARGET_JOB_COUNT must be positive.')
+            if 'FILES_PER_JOB' in cfg:
+                num_jobs = int(math.ceil(len(filelist)/int(cfg['FILES_PER_JOB'])))
+            else:
+                num_jobs = min(int(cfg['TARGET_JOB_COUNT']),len(filelist))
+            tasks = self.pack_files(filelist,num_jobs)
+            print(f'GLOB {cfg["GLOB"]} returned {len(filelist)} files packed into {len(tasks)} jobs')
+            if not len(tasks) == int(cfg['SLURM_NUM_JOBS']):
+                print(f'Overriding SLURM_NUM_JOBS {cfg["SLURM_NUM_JOBS"]} => {len(tasks)}')
+            cfg['SLURM_NUM_JOBS'] = len(tasks)
+        else:
+            # assert the file count matches the requested job count
+            if not len(filelist) == int(cfg['SLURM_NUM_JOBS']):
+                print(f'GLOB {cfg["GLOB"]} returned {len(filelist)} files')
+                print(f'But requested job count is {cfg["SLURM_NUM_JOBS"]} (must match)')
+                raise ValueError(f'GLOB {cfg["GLOB"]} returned unexpected file count')
+            tasks = [[name] for name in filelist]
+        conversion_manifest.write_task_meta(cfg['JOB_SOURCE_DIR'],tasks)
+
+        # create a filelist and its per-job index
+        self.write_file_index(cfg['JOB_SOURCE_DIR'],tasks)
+        # one file per input directory is enough to find the top directories to bind
+        dirs = {os.path.dirname(name):name for names in tasks for name in names}
+        for name in dirs.values():
+            self.BIND_PATHS.append(self.get_top_dir(name))
+
+
+    def write_file_index(self,jsdir,tasks):
         '''
-        with open(os.path.join(cfg['JOB_SOURCE_DIR'],'input_name.py'),'w') as f:
-            f.write(script)
-
+        Write flist.txt (one input path per line, grouped by job) and flist.idx with a
+        fixed-width record per job holding the byte offset and the file count of the job
+        in flist.txt, so that a job can look up its inputs with a seek.
+        '''
+        offset = 0
+        with open(os.path.join(jsdir,'flist.txt'),'wb') as flist, open(os.path.join(jsdir,'flist.idx'),'wb') as fidx:
+            for names in tasks:
+                record = f'{offset:{INDEX_RECORD_SIZE-12}d} {len(names):10d}\n'.encode()
+                assert len(record) == INDEX_RECORD_SIZE
+                fidx.write(record)
+                for name in names:
+                    if '\n' in name:
+                        raise ValueError(f'Input file name cannot contain a new line: {repr(name)}')
+                    line = (name+'\n').encode()
+                    flist.write(line)
+                    offset += len(line)
+
+
+    def pack_files(self,filelist,num_jobs):
+        '''
+        Distribute files into num_jobs groups with balanced total size in bytes
+        (largest file first into the currently lightest group).
+        '''
+        sizes = [(self.FILE_SIZES.get(name,None) or os.path.getsize(name),name) for name in filelist]
+        sizes.sort(reverse=True)
+        heap = [(0,i) for i in range(num_jobs)]
+        groups = [[] for _ in range(num_jobs)]
+        for size,name in sizes:
+            total,i = heapq.heappop(heap)
+            groups[i].append(name)
+            heapq.heappush(heap,(total+size,i))
+        return [sorted(g) for g in groups if len(g)]
 
 
     def gen_project_script(self,cfg):
 
         cmd_supera = f'''run_larnd2supera.py \
--o {cfg['JOB_OUTPUT_ID']}-larcv.root \
 -c {cfg['SUPERA_CONFIG']}'''
 
         self.PROJECT_SCRIPT = f'''#!/bin/bash
@@ -58,37 +132,117 @@ date
 
 export PATH=$HOME/.local/bin:$PATH
 
-echo "Copying a file"
-SOURCE_FILE_NAME=`python3 input_name.py $SLURM_ARRAY_TASK_ID`
-INPUT_FILE_NAME=`basename $SOURCE_FILE_NAME`
-echo scp $SOURCE_FILE_NAME $INPUT_FILE_NAME
-scp $SOURCE_FILE_NAME $INPUT_FILE_NAME
-date
+# look up this job's inputs: seek to the job record in flist.idx, then to its offset in flist.txt
+read OFFSET COUNT < <(dd if=flist.idx bs={INDEX_RECORD_SIZE} skip=$((SLURM_ARRAY_TASK_ID-1)) count=1 2>/dev/null)
+tail -c +$((OFFSET+1)) flist.txt | head -n $COUNT > task_inputs.txt
+mapfile -t SOURCE_FILE_NAMES < task_inputs.txt
+echo "Processing ${{#SOURCE_FILE_NAMES[@]}} file(s)"
+
+STATUS=0
+for INDEX in ${{!SOURCE_FILE_NAMES[@]}}; do
+    SOURCE_FILE_NAME="${{SOURCE_FILE_NAMES[$INDEX]}}"
+    if [ ${{#SOURCE_FILE_NAMES[@]}} -eq 1 ]; then
+        OUTPUT_FILE_NAME={cfg['JOB_OUTPUT_ID']}-larcv.root
+    else
+        OUTPUT_FILE_NAME=$(printf "%s-%03d-larcv.root" {cfg['JOB_OUTPUT_ID']} $INDEX)
+    fi
+    echo "$OUTPUT_FILE_NAME $SOURCE_FILE_NAME" >> inputs.txt
+
+    echo "Copying a file"
+    INPUT_FILE_NAME="$(basename "$SOURCE_FILE_NAME")"
+    echo scp "$SOURCE_FILE_NAME" "$INPUT_FILE_NAME"
+    {self.metered(cfg,'input_copy:$INDEX','scp')} "$SOURCE_FILE_NAME" "$INPUT_FILE_NAME"
+    date
+
+    echo "Running Supera"
+    echo {cmd_supera} -o $OUTPUT_FILE_NAME "$INPUT_FILE_NAME"
+    {self.metered(cfg,'supera:$INDEX',cmd_supera)} -o $OUTPUT_FILE_NAME "$INPUT_FILE_NAME" || STATUS=1
+    date
+
+    echo "Removing the input"
+    echo rm "$INPUT_FILE_NAME"
+    rm "$INPUT_FILE_NAME"
+    date
+
+    echo "Touching the input filename"
+    echo touch "$INPUT_FILE_NAME"
+    touch "$INPUT_FILE_NAME"
+    date
+done
 
-echo "Running Supera"
-export PATH=$HOME/.local/bin:$PATH
-echo {cmd_supera} $INPUT_FILE_NAME
-{cmd_supera} $INPUT_FILE_NAME
-date
+echo "Exiting"
+exit $STATUS
+        '''
 
-echo "Removing the input"
-echo rm $INPUT_FILE_NAME
-rm $INPUT_FILE_NAME
-date
 
-echo "Touching the input filename"
-echo touch $INPUT_FILE_NAME
-touch $INPUT_FILE_NAME
-date
+def _package_dirs(name):
+    '''
+    Directories of a package (and of its config sub-package) found without importing it.
+    Raises FileNotFoundError (cleaned up by generate like other missing inputs) if not found.
+    '''
+    spec = importlib.util.find_spec(name)
+    if spec is None or not spec.submodule_search_locations:
+        raise FileNotFoundError(f'Package {name} not found')
+    top = list(spec.submodule_search_locations)[0]
+    return [top,os.path.join(top,'config')]
+
+
+def _supera_configs():
+    try:
+        import larnd2supera
+    except ImportError as e:
+        raise FileNotFoundError(f'Failed to import larnd2supera ({e})')
+    return list(larnd2supera.config.list_config()),_package_dirs('larnd2supera')
+
+
+def gen_resume_script(production_dir):
+    '''
+    Write submit_resume.sh in the job source of a production that re-submits
+    only array indices with missing or truncated outputs. Returns the indices.
+    '''
+    jsdir = os.path.join(os.path.abspath(production_dir),'job_source')
+    with open(os.path.join(jsdir,'source.yaml'),'r') as f:
+        cfg = yaml.safe_load(f)
+    # the array indices of these modes are not the file groups
+    if cfg.get('WORKER_MODE',False):
+        raise ValueError('--resume does not support WORKER_MODE productions (requeue the units with work_queue.py).')
+    if cfg.get('SCHEDULER','slurm') == 'pool':
+        raise ValueError('--resume does not support SCHEDULER pool productions (run scheduler.py pool with the indices).')
+
+    tasks = conversion_manifest.missing_tasks(production_dir)
+    if len(tasks) < 1:
+        return tasks
+
+    array = array_spec(tasks)
+
+    # with a merge job, submit.sh is a wrapper and the array is in submit_array.sh
+    name = 'submit_array.sh' if os.path.isfile(os.path.join(jsdir,'submit_array.sh')) else 'submit.sh'
+    with open(os.path.join(jsdir,name),'r') as f:
+        script = f.read()
+    # keep the throttle (%N) of the original array
+    script,count = re.subn(r'#SBATCH --array=[^\s%]+',f'#SBATCH --array={array}',script)
+    if count < 1:
+        raise ValueError(f'No #SBATCH --array found in {os.path.join(jsdir,name)}')
+    with open(os.path.join(jsdir,'submit_resume.sh'),'w') as f:
+        f.write(script)
+    return tasks
 
-echo "Exiting"
-        '''
 
 if __name__ == '__main__':
     import sys
+    if len(sys.argv) == 3 and sys.argv[1] == '--resume':
+        tasks = gen_resume_script(sys.argv[2])
+        if len(tasks) < 1:
+            print(f'All outputs of {sys.argv[2]} are complete. Nothing to resume.')
+            sys.exit(0)
+        print(f'{len(tasks)} job(s) with missing or truncated outputs: {tasks}')
+        print(f'\nTo re-submit them, type:\n\nsbatch {os.path.join(os.path.abspath(sys.argv[2]),"job_source","submit_resume.sh")}\n')
+        sys.exit(0)
+
     if not len(sys.argv) == 2:
         print(f'Invalid number of the arguments ({len(sys.argv)})')
         print(f'Usage: {os.path.basename(__file__)} $JOB_CONFIGURATION_YAML')
+        print(f'       {os.path.basename(__file__)} --resume $PRODUCTION_DIR')
         sys.exit(1)
 
     if not sys.argv[1].endswith('.yaml'):
@@ -1,9 +1,9 @@
-import yaml, os, pathlib, shutil
-import numpy as np
+import yaml, os, pathlib, shutil, random
 from yaml import Loader
-import larndsim
 from datetime import timedelta
 from project_base import project_base
+import checkpoint
+import resolve_cache
 
 
 REQUIRED = dict(GEOMETRY=os.path.join(pathlib.Path(__file__).parent.resolve(),'geometry'),
@@ -19,11 +19,61 @@ REQUIRED = dict(GEOMETRY=os.path.join(pathlib.Path(__file__).parent.resolve(),'g
 
 class project_larndsim(project_base):
 
+    def __init__(self):
+        super().__init__()
+        self.MERGE_OUTPUTS=['-larndsim.h5']
+
     def parse_project_config(self,cfg):
 
         cfg['G4_MACRO_PATH']=os.path.join(cfg['JOB_SOURCE_DIR'],'g4.mac')
 
-        # Check required configuration files
+        # Check required configuration files (cached with the options and the file mtimes)
+        options={k:cfg[k] for k in cfg if k == 'LARNDSIM_REPOSITORY' or any([k.endswith('_'+word) for word in REQUIRED])}
+        cfg.update(self.resolved(resolve_cache.cache_key('larndsim',options),lambda: self.resolve_required(cfg)))
+
+        # per-task seeds are derived from the master seed (drawn once and recorded if not given)
+        if not 'MASTER_SEED' in cfg:
+            cfg['MASTER_SEED']=random.SystemRandom().randrange(1,2**31)
+        cfg['MASTER_SEED']=int(cfg['MASTER_SEED'])
+        print(f'Using MASTER_SEED {cfg["MASTER_SEED"]}')
+
+        # pipelined mode: split NUM_EVENTS into sub-batches
+        cfg['PIPELINE_BATCHES']=int(cfg.get('PIPELINE_BATCHES',1))
+        if cfg['PIPELINE_BATCHES'] < 1 or cfg['PIPELINE_BATCHES'] > int(cfg['NUM_EVENTS']):
+            raise ValueError(f'PIPELINE_BATCHES must be between 1 and NUM_EVENTS ({cfg["NUM_EVENTS"]})')
+
+        # streaming mode: edep-sim writes chunks of STREAM_CHUNK_EVENTS, converted while the next one is simulated
+        cfg['STREAM_CHUNK_EVENTS']=int(cfg.get('STREAM_CHUNK_EVENTS',0))
+        if cfg['STREAM_CHUNK_EVENTS'] > 0 and cfg['PIPELINE_BATCHES'] > 1:
+            raise ValueError('STREAM_CHUNK_EVENTS and PIPELINE_BATCHES cannot be used together (batches are already converted one by one).')
+
+        # storage profile of the HDF5 outputs, applied by repack_h5.py before they are staged out
+        if cfg.get('STORAGE_PROFILE',None):
+            profile=dict(COMPRESSION='gzip',LEVEL=4,SHUFFLE=True,CHUNK_ROWS=65536,CHUNK_KB=1024,DROP=dict(),OUTPUTS=['edepsim','larndsim'])
+            profile.update(cfg['STORAGE_PROFILE'])
+            if not profile['COMPRESSION'] in ['gzip','lzf','none']:
+                raise ValueError(f'STORAGE_PROFILE COMPRESSION must be gzip, lzf or none (given: {profile["COMPRESSION"]})')
+            cfg['STORAGE_PROFILE']=profile
+
+        # split mode: edep-sim/dumpTree and larnd-sim as chained CPU and GPU arrays
+        cfg['SLURM_SPLIT_STAGES']=bool(cfg.get('SLURM_SPLIT_STAGES',False))
+        if cfg['SLURM_SPLIT_STAGES']:
+            if cfg['PIPELINE_BATCHES'] > 1:
+                raise ValueError('SLURM_SPLIT_STAGES and PIPELINE_BATCHES cannot be used together.')
+            if cfg['WORKER_MODE'] or cfg['SLURM_GPU_PACK'] > 1 or cfg['SCHEDULER'] == 'pool':
+                raise ValueError('SLURM_SPLIT_STAGES cannot be used with WORKER_MODE, SLURM_GPU_PACK or SCHEDULER pool.')
+            cfg['SLURM_CPU_PARTITION']=cfg.get('SLURM_CPU_PARTITION',cfg['SLURM_PARTITION'])
+            if 'SLURM_CPU_TIME' in cfg:
+                cfg['SLURM_CPU_TIME']=str(timedelta(seconds=cfg['SLURM_CPU_TIME']))
+            else:
+                cfg['SLURM_CPU_TIME']=cfg['SLURM_TIME']
+
+    def resolve_required(self,cfg):
+        '''
+        Returns ({word: value} of REQUIRED, [paths checked]) from the USE_/SEARCH_/SET_ options.
+        '''
+        res=dict()
+        paths=[]
         for word in REQUIRED.keys():
             opt1 = 'USE_' + word
             opt2 = 'SEARCH_' + word
@@ -36,7 +86,7 @@ class project_larndsim(project_base):
                 print(f'{opt2}: {cfg.get(opt2,None)}')
                 print(f'{opt2}: {cfg.get(opt3,None)}')
                 raise ValueError('Please fix the configuration file.')
-                
+            
             if duplicate == 0:
                 print(f'ERROR: keyword not found (need either USE_{word} or SEARCH_{word} or SET_{word})')
                 print(f'{cfg}')
@@ -44,10 +94,11 @@ class project_larndsim(project_base):
 
             # option 1: take the path specified by the user
             if opt1 in cfg:
-                if not os.path.isfile(opt1):
+                if not os.path.isfile(cfg[opt1]):
                     print(f'ERROR: {word} file not found at the specified location.')
                     raise FileNotFoundError(f'{cfg[opt1]}')
-                cfg[word]=cfg[opt1]
+                res[word]=cfg[opt1]
+                paths.append(cfg[opt1])
 
             # option 2: grab from larnd-sim repository
             if opt2 in cfg:
@@ -63,26 +114,44 @@ class project_larndsim(project_base):
                     print(f'Searched a file {cfg[opt2]} but not found...')
                     raise FileNotFoundError(f'{path}')
 
-                cfg[word]=path
+                res[word]=path
+                paths.append(path)
 
             # option 3: set the option to the specified value w/o check
             if opt3 in cfg:
-                cfg[word]=cfg[opt3]
+                res[word]=cfg[opt3]
+
+        return res,paths
 
     def gen_project_script(self,cfg):
 
-        macro = self.gen_g4macro(os.path.basename(cfg['MPVMPR']))
+        macro = self.gen_g4macro()
         with open(cfg['G4_MACRO_PATH'],'w') as f:
             f.write(macro)
             f.close()
-        self.gen_job_script(cfg)
+        if cfg['PIPELINE_BATCHES'] > 1 or cfg['STREAM_CHUNK_EVENTS'] > 0:
+            self.COPY_FILES.append(os.path.join(pathlib.Path(__file__).parent.resolve(),'merge_h5.py'))
+        if cfg['PIPELINE_BATCHES'] > 1:
+            self.gen_pipeline_job_script(cfg)
+        else:
+            self.gen_job_script(cfg)
+        if cfg['SLURM_SPLIT_STAGES']:
+            self.gen_split_job_scripts(cfg)
+            self.SUBMIT_COMMAND='bash'
+
+        if cfg.get('STORAGE_PROFILE',None):
+            self.COPY_FILES.append(os.path.join(pathlib.Path(__file__).parent.resolve(),'repack_h5.py'))
 
         for key in REQUIRED.keys():
             if type(REQUIRED[key]) == str:
                 self.COPY_FILES.append(cfg[key])
+        self.COPY_FILES.append(os.path.join(pathlib.Path(__file__).parent.resolve(),'seeds.py'))
 
 
-    def gen_g4macro(self, mpv_config):
+    def gen_g4macro(self):
+        '''
+        Macro template, the seed and bomb generator config are filled per output by seeds.py.
+        '''
         macro=f'''
 /edep/hitSeparation TPCActive_shape -1 mm
 /edep/hitSagitta drift 1.0 mm
@@ -90,10 +159,10 @@ class project_larndsim(project_base):
 /edep/db/set/neutronThreshold 0 MeV
 /edep/db/set/lengthThreshold 0 mm
 /edep/db/set/gammaThreshold 0 MeV
-/edep/random/timeRandomSeed
+/edep/random/randomSeed @EDEP_SEED@
 /edep/update
 
-/generator/kinematics/bomb/config {mpv_config}
+/generator/kinematics/bomb/config @BOMB_CONFIG@
 /generator/kinematics/bomb/verbose 0
 /generator/kinematics/set bomb 
 
@@ -105,17 +174,20 @@ class project_larndsim(project_base):
         return macro
 
 
-    def gen_job_script(self, cfg):
-
+    def gen_commands(self, cfg, output_name, num_events):
+        '''
+        Returns edep-sim, dumpTree and larnd-sim commands for one chain.
+        output_name and num_events may be shell expressions.
+        '''
         cmd_edepsim = f'''edep-sim \
 -g {os.path.basename(cfg['GEOMETRY'])} \
--e {int(cfg['NUM_EVENTS'])} \
--o {cfg['JOB_OUTPUT_ID']}-edepsim.root \
-{os.path.basename(cfg['G4_MACRO_PATH'])} \
+-e {num_events} \
+-o {output_name}-edepsim.root \
+{output_name}.mac \
 '''
 
         cmd_dumptree = f'''dumpTree.py \
-    {cfg['JOB_OUTPUT_ID']}-edepsim.root {cfg['JOB_OUTPUT_ID']}-edepsim.h5 \
+    {output_name}-edepsim.root {output_name}-edepsim.h5 \
 '''
 
         cmd_larndsim = f'''{cfg['LARNDSIM_SCRIPT']} \
@@ -126,9 +198,46 @@ class project_larndsim(project_base):
 --light_lut_filename={os.path.basename(cfg['LIGHT_LUT'])} \
 --light_det_noise_filename={os.path.basename(cfg['LIGHT_DET_NOISE'])} \
 --light_simulated={str(cfg['LIGHT_SIMULATION'])} \
---input_filename={cfg['JOB_OUTPUT_ID']}-edepsim.h5 \
---output_filename={cfg['JOB_OUTPUT_ID']}-larndsim.h5 \
+--input_filename={output_name}-edepsim.h5 \
+--output_filename={output_name}-larndsim.h5 \
 '''
+        return cmd_edepsim, cmd_dumptree, cmd_larndsim
+
+
+    def gen_seed_command(self, cfg, output_name, batch=0):
+        '''
+        Command writing the seeded macro output_name.mac (seeds from the master seed, array index,
+        chain and batch) used by the edep-sim command of gen_commands.
+        '''
+        return f'''python3 seeds.py macro {cfg['MASTER_SEED']} $SLURM_ARRAY_TASK_ID ${{DNTP_CHAIN:-0}} {batch} \
+{output_name} {os.path.basename(cfg['G4_MACRO_PATH'])} {os.path.basename(cfg['MPVMPR'])}'''
+
+
+    def gen_repack_commands(self, cfg, outputs):
+        '''
+        Repack the outputs (edepsim, larndsim) of a job script with the STORAGE_PROFILE.
+        An output failing to repack is kept as is.
+        '''
+        profile = cfg.get('STORAGE_PROFILE',None)
+        if not profile:
+            return ''
+        script = '''
+date
+echo "Repacking the outputs"
+'''
+        for name in [name for name in outputs if name in profile['OUTPUTS']]:
+            path = f'${{OUTPUT_NAME}}-{name}.h5'
+            cmd = f'''python3 repack_h5.py {path} --compression={profile['COMPRESSION']} --level={profile['LEVEL']} \
+--chunk-rows={profile['CHUNK_ROWS']} --chunk-kb={profile['CHUNK_KB']} --drop={','.join((profile['DROP'] or dict()).get(name,[]))} \
+--record=repack.jsonl{'' if profile['SHUFFLE'] else ' --no-shuffle'}'''
+            script += f'''[ ! -f {path} ] || {self.metered(cfg,'repack',cmd)} &>> log_repack.txt || echo "Repacking {path} failed, keeping it as is"
+'''
+        return script
+
+
+    def gen_job_script(self, cfg):
+
+        cmd_edepsim, cmd_dumptree, cmd_larndsim = self.gen_commands(cfg, cfg['JOB_OUTPUT_ID'], int(cfg['NUM_EVENTS']))
 
         self.PROJECT_SCRIPT=f'''#!/bin/bash
 date
@@ -140,36 +249,344 @@ nvidia-smi &> jobinfo_gpu.txt
 
 OUTPUT_NAME={cfg['JOB_OUTPUT_ID']}
 
+{checkpoint.gen_functions(cfg)}
+{self.gen_cpu_stages(cfg,cmd_edepsim,cmd_dumptree)}
+
+if ! ckpt_restore larndsim.h5 ${{OUTPUT_NAME}}-larndsim.h5; then
+    date
+    echo "Running larnd-sim"
 
+    echo {cmd_larndsim}
+
+    {self.metered(cfg,'larndsim',cmd_larndsim)} &>> log_larndsim.txt || exit 1
+    ckpt_commit larndsim.h5 ${{OUTPUT_NAME}}-larndsim.h5
+fi
+{self.gen_repack_commands(cfg,['edepsim','larndsim'])}
 date
-echo "Running edep-sim"
+echo "Removing the response file..."
+rm {os.path.basename(cfg['RESPONSE'])}
+
+echo "Exiting"
+    
+'''
+
+    def gen_cpu_stages(self, cfg, cmd_edepsim, cmd_dumptree):
+        '''
+        edep-sim and dumpTree of one chain, each skipped when its output is restored from a checkpoint.
+        '''
+        if cfg['STREAM_CHUNK_EVENTS'] > 0:
+            return self.gen_stream_stages(cfg)
+        return f'''if ! ckpt_restore edepsim.h5 ${{OUTPUT_NAME}}-edepsim.h5; then
+    if ! ckpt_restore edepsim.root ${{OUTPUT_NAME}}-edepsim.root; then
+        {self.gen_seed_command(cfg,'${OUTPUT_NAME}')} || exit 1
+
+        date
+        echo "Running edep-sim"
 
-echo {cmd_edepsim}
+        echo {cmd_edepsim}
 
-{cmd_edepsim} &>> log_edepsim.txt
+        {self.metered(cfg,'edepsim',cmd_edepsim)} &>> log_edepsim.txt || exit 1
+        ckpt_commit edepsim.root ${{OUTPUT_NAME}}-edepsim.root
+    fi
 
+    date
+    echo "Running dumpTree"
+
+    echo {cmd_dumptree}
+
+    {self.metered(cfg,'dumptree',cmd_dumptree)} &>> log_dumptree.txt || exit 1
+    ckpt_commit edepsim.h5 ${{OUTPUT_NAME}}-edepsim.h5 && ckpt_drop edepsim.root
+fi
+'''
 
+    def gen_stream_stages(self, cfg):
+        '''
+        Streaming variant of gen_cpu_stages: edep-sim runs on chunks of STREAM_CHUNK_EVENTS events
+        (seeded per chunk), each chunk is converted by dumpTree in the background while the next one
+        is simulated, and its ROOT file is removed once converted. At most two ROOT chunks are on
+        scratch at a time. The converted chunks are merged into the edep-sim HDF5 output.
+        '''
+        nevents = int(cfg['NUM_EVENTS'])
+        chunk = cfg['STREAM_CHUNK_EVENTS']
+        chunk_events = ' '.join([str(min(chunk,nevents-i)) for i in range(0,nevents,chunk)])
+
+        cmd_edepsim, cmd_dumptree, _ = self.gen_commands(cfg, '${CHUNK_NAME}', '$NEVT')
+
+        return f'''if ! ckpt_restore edepsim.h5 ${{OUTPUT_NAME}}-edepsim.h5; then
+    CHUNK_EVENTS=({chunk_events})
+
+    convert() {{
+        local CHUNK=$1
+        local CHUNK_NAME=$2
+        echo {cmd_dumptree} &>> log_dumptree.txt
+        {self.metered(cfg,'dumptree:$CHUNK',cmd_dumptree)} &>> log_dumptree.txt || return 1
+        rm ${{CHUNK_NAME}}-edepsim.root
+        ckpt_commit $(printf "s%03d" $CHUNK)-edepsim.h5 ${{CHUNK_NAME}}-edepsim.h5
+    }}
+
+    date
+    echo "Running edep-sim and dumpTree on ${{#CHUNK_EVENTS[@]}} chunk(s)"
+    CONVERTER=""
+    for CHUNK in ${{!CHUNK_EVENTS[@]}}; do
+        NEVT=${{CHUNK_EVENTS[$CHUNK]}}
+        CHUNK_NAME=$(printf "%s-s%03d" $OUTPUT_NAME $CHUNK)
+        if ckpt_restore $(printf "s%03d" $CHUNK)-edepsim.h5 ${{CHUNK_NAME}}-edepsim.h5; then
+            continue
+        fi
+
+        {self.gen_seed_command(cfg,'${CHUNK_NAME}','$CHUNK')} || exit 1
+        echo {cmd_edepsim} &>> log_edepsim.txt
+        {self.metered(cfg,'edepsim:$CHUNK',cmd_edepsim)} &>> log_edepsim.txt || exit 1
+
+        # convert the previous chunk before starting on this one
+        if [ -n "$CONVERTER" ]; then
+            wait $CONVERTER || {{ echo "dumpTree failed"; exit 1; }}
+        fi
+        convert $CHUNK $CHUNK_NAME &
+        CONVERTER=$!
+    done
+    if [ -n "$CONVERTER" ]; then
+        wait $CONVERTER || {{ echo "dumpTree failed"; exit 1; }}
+    fi
+
+    date
+    echo "Merging the converted chunks"
+    python3 merge_h5.py ${{OUTPUT_NAME}}-edepsim.h5 ${{OUTPUT_NAME}}-s*-edepsim.h5 &>> log_merge.txt || exit 1
+    rm ${{OUTPUT_NAME}}-s*-edepsim.h5
+    ckpt_commit edepsim.h5 ${{OUTPUT_NAME}}-edepsim.h5
+    for CHUNK in ${{!CHUNK_EVENTS[@]}}; do
+        ckpt_drop $(printf "s%03d" $CHUNK)-edepsim.h5
+    done
+fi
+'''
+
+    def gen_split_job_scripts(self, cfg):
+        '''
+        Generate run_cpu.sh (edep-sim + dumpTree) and run_gpu.sh (larnd-sim) for SLURM_SPLIT_STAGES.
+        The GPU array runs with DNTP_CPU_JOB_ID set to the CPU array job ID, and picks up the
+        edep-sim output from the CPU task with the same array index in the storage directory.
+        '''
+        cmd_edepsim, cmd_dumptree, _ = self.gen_commands(cfg, cfg['JOB_OUTPUT_ID'], int(cfg['NUM_EVENTS']))
+        gpu_output_id = 'output_${DNTP_CPU_JOB_ID}_${SLURM_ARRAY_TASK_ID}'
+        _, _, cmd_larndsim = self.gen_commands(cfg, gpu_output_id, int(cfg['NUM_EVENTS']))
+
+        self.JOB_SCRIPTS['run_cpu.sh']=f'''#!/bin/bash
+date
+echo "starting a CPU stage job"
+
+export PATH=$HOME/.local/bin:$PATH
+
+OUTPUT_NAME={cfg['JOB_OUTPUT_ID']}
+
+echo "Removing the response file (not needed in this stage)..."
+rm {os.path.basename(cfg['RESPONSE'])}
+
+{checkpoint.gen_functions(cfg)}
+{self.gen_cpu_stages(cfg,cmd_edepsim,cmd_dumptree)}
+{self.gen_repack_commands(cfg,['edepsim'])}
+date
+echo "Exiting"
+
+'''
+
+        self.JOB_SCRIPTS['run_gpu.sh']=f'''#!/bin/bash
+date
+echo "starting a GPU stage job"
+
+export PATH=$HOME/.local/bin:$PATH
+
+nvidia-smi &> jobinfo_gpu.txt
+
+OUTPUT_NAME={gpu_output_id}
+STAGE_DIR={cfg['STORAGE_DIR']}/$(printf "job_%d_%04d" $DNTP_CPU_JOB_ID $SLURM_ARRAY_TASK_ID)
+# a resubmitted CPU task skipped as complete leaves its output in the earlier job directory
+if [ ! -d $STAGE_DIR ] && [ -f "$CKPT_DIR/run_cpu.sh.done" ]; then
+    STAGE_DIR=$(cat $CKPT_DIR/run_cpu.sh.done)
+fi
+
+{checkpoint.gen_functions(cfg)}
 date
-echo "Running dumpTree"
+echo "Copying the CPU stage output from $STAGE_DIR"
+cp $STAGE_DIR/output_*-edepsim.h5 ${{OUTPUT_NAME}}-edepsim.h5 || exit 1
 
-echo {cmd_dumptree}
+if ! ckpt_restore larndsim.h5 ${{OUTPUT_NAME}}-larndsim.h5; then
+    date
+    echo "Running larnd-sim"
 
-{cmd_dumptree} &>> log_dumptree.txt
+    echo {cmd_larndsim}
 
+    {self.metered(cfg,'larndsim',cmd_larndsim)} &>> log_larndsim.txt || exit 1
+    ckpt_commit larndsim.h5 ${{OUTPUT_NAME}}-larndsim.h5
+fi
+{self.gen_repack_commands(cfg,['larndsim'])}
+date
+echo "Removing the response file and the CPU stage output..."
+rm {os.path.basename(cfg['RESPONSE'])} ${{OUTPUT_NAME}}-edepsim.h5
+
+echo "Exiting"
+
+'''
+
+    def gen_submit_scripts(self, cfg):
+
+        if not cfg['SLURM_SPLIT_STAGES']:
+            return super().gen_submit_scripts(cfg)
+
+        jsdir = cfg['JOB_SOURCE_DIR']
+        scripts = dict()
+        scripts['submit_cpu.sh'] = self.gen_submission_script(cfg,
+            run_script='run_cpu.sh',
+            job_name=f'dntp-{cfg["PRODUCTION_ID"]}-cpu',
+            partition=cfg['SLURM_CPU_PARTITION'],
+            time=cfg['SLURM_CPU_TIME'],
+            use_gpu=False)
+        # the GPU stage writes into the work directory of the CPU stage with the same index
+        scripts['submit_gpu.sh'] = self.gen_submission_script(cfg,
+            run_script='run_gpu.sh',
+            job_name=f'dntp-{cfg["PRODUCTION_ID"]}-gpu',
+            array_job_id='$DNTP_CPU_JOB_ID')
+        scripts['submit.sh'] = f'''#!/bin/bash
+# Chain the CPU (edep-sim, dumpTree) and GPU (larnd-sim) arrays.
+# Each GPU array task starts as soon as the CPU task with the same index succeeded.
+
+CPU_JOB_ID=$(sbatch --parsable {os.path.join(jsdir,'submit_cpu.sh')})
+CPU_JOB_ID=${{CPU_JOB_ID%%;*}}
+if [ -z "$CPU_JOB_ID" ]; then
+    echo "Failed to submit the CPU stage"
+    exit 1
+fi
+echo "Submitted the CPU stage array $CPU_JOB_ID"
+
+GPU_JOB_ID=$(sbatch --parsable --dependency=aftercorr:$CPU_JOB_ID --export=ALL,DNTP_CPU_JOB_ID=$CPU_JOB_ID {os.path.join(jsdir,'submit_gpu.sh')})
+GPU_JOB_ID=${{GPU_JOB_ID%%;*}}
+if [ -z "$GPU_JOB_ID" ]; then
+    echo "Failed to submit the GPU stage (cancelling $CPU_JOB_ID)"
+    scancel $CPU_JOB_ID
+    exit 1
+fi
+echo "Submitted the GPU stage array $GPU_JOB_ID (depends on $CPU_JOB_ID)"
+LAST_JOB_ID=$GPU_JOB_ID
+'''
+        return scripts
+
+    def gen_pipeline_job_script(self, cfg):
+        '''
+        Same chain as gen_job_script but NUM_EVENTS is split into PIPELINE_BATCHES sub-batches.
+        edep-sim and dumpTree run in the background producing batch N+1 while larnd-sim
+        processes batch N on the GPU. Chunk outputs are merged at the end.
+        Stage start/end times are recorded in log_stages.txt.
+        '''
+        nbatch = cfg['PIPELINE_BATCHES']
+        nevents = int(cfg['NUM_EVENTS'])
+        batch_events = ' '.join([str(nevents//nbatch + int(i < nevents%nbatch)) for i in range(nbatch)])
+
+        cmd_edepsim, cmd_dumptree, cmd_larndsim = self.gen_commands(cfg, '${CHUNK_NAME}', '$NEVT')
 
+        self.PROJECT_SCRIPT=f'''#!/bin/bash
 date
-echo "Running larnd-sim"
+echo "starting a pipelined job ({nbatch} batches)"
+
+export PATH=$HOME/.local/bin:$PATH
 
-echo {cmd_larndsim}
+nvidia-smi &> jobinfo_gpu.txt
 
-{cmd_larndsim} &>> log_larndsim.txt
+OUTPUT_NAME={cfg['JOB_OUTPUT_ID']}
+BATCH_EVENTS=({batch_events})
+JOB_START=$(date +%s.%N)
+
+log_stage() {{
+    echo "$1 $2 $3 $4" >> log_stages.txt
+}}
+
+{checkpoint.gen_functions(cfg)}
+produce() {{
+    for BATCH in ${{!BATCH_EVENTS[@]}}; do
+        NEVT=${{BATCH_EVENTS[$BATCH]}}
+        CHUNK_NAME=$(printf "%s-b%03d" $OUTPUT_NAME $BATCH)
+        CHUNK_ID=$(printf "b%03d" $BATCH)
+
+        if ckpt_restore $CHUNK_ID-edepsim.h5 ${{CHUNK_NAME}}-edepsim.h5; then
+            touch $CHUNK_NAME.ready
+            continue
+        fi
+
+        {self.gen_seed_command(cfg,'${CHUNK_NAME}','$BATCH')} || {{ touch $CHUNK_NAME.failed; return 1; }}
+        T0=$(date +%s.%N)
+        echo {cmd_edepsim} &>> log_edepsim.txt
+        {self.metered(cfg,'edepsim:$BATCH',cmd_edepsim)} &>> log_edepsim.txt
+        STATUS=$?
+        log_stage edepsim $BATCH $T0 $(date +%s.%N)
+        if [ $STATUS -gt 0 ]; then touch $CHUNK_NAME.failed; return 1; fi
+
+        T0=$(date +%s.%N)
+        echo {cmd_dumptree} &>> log_dumptree.txt
+        {self.metered(cfg,'dumptree:$BATCH',cmd_dumptree)} &>> log_dumptree.txt
+        STATUS=$?
+        log_stage dumptree $BATCH $T0 $(date +%s.%N)
+        if [ $STATUS -gt 0 ]; then touch $CHUNK_NAME.failed; return 1; fi
+
+        rm ${{CHUNK_NAME}}-edepsim.root
+        ckpt_commit $CHUNK_ID-edepsim.h5 ${{CHUNK_NAME}}-edepsim.h5
+        touch $CHUNK_NAME.ready
+    done
+}}
+
+date
+echo "Starting edep-sim + dumpTree in the background"
+produce &
+PRODUCER=$!
+
+for BATCH in ${{!BATCH_EVENTS[@]}}; do
+    CHUNK_NAME=$(printf "%s-b%03d" $OUTPUT_NAME $BATCH)
+    while [ ! -f $CHUNK_NAME.ready ] && [ ! -f $CHUNK_NAME.failed ]; do
+        sleep 1
+    done
+    if [ -f $CHUNK_NAME.failed ]; then
+        echo "Batch $BATCH failed in the CPU stage. Aborting..."
+        wait $PRODUCER
+        exit 1
+    fi
+    if ckpt_restore $(printf "b%03d" $BATCH)-larndsim.h5 ${{CHUNK_NAME}}-larndsim.h5; then
+        continue
+    fi
+
+    date
+    echo "Running larnd-sim on batch $BATCH"
+    T0=$(date +%s.%N)
+    echo {cmd_larndsim} &>> log_larndsim.txt
+    {self.metered(cfg,'larndsim:$BATCH',cmd_larndsim)} &>> log_larndsim.txt
+    STATUS=$?
+    log_stage larndsim $BATCH $T0 $(date +%s.%N)
+    if [ $STATUS -gt 0 ]; then
+        echo "larnd-sim failed on batch $BATCH. Aborting..."
+        kill $PRODUCER
+        exit 1
+    fi
+    ckpt_commit $(printf "b%03d" $BATCH)-larndsim.h5 ${{CHUNK_NAME}}-larndsim.h5
+done
+wait $PRODUCER
+
+date
+echo "Merging the batch outputs"
+T0=$(date +%s.%N)
+python3 merge_h5.py ${{OUTPUT_NAME}}-edepsim.h5 ${{OUTPUT_NAME}}-b*-edepsim.h5 &>> log_merge.txt || exit 1
+python3 merge_h5.py ${{OUTPUT_NAME}}-larndsim.h5 ${{OUTPUT_NAME}}-b*-larndsim.h5 &>> log_merge.txt || exit 1
+rm ${{OUTPUT_NAME}}-b*-edepsim.h5 ${{OUTPUT_NAME}}-b*-larndsim.h5 ${{OUTPUT_NAME}}-b*.ready
+log_stage merge all $T0 $(date +%s.%N)
+{self.gen_repack_commands(cfg,['edepsim','larndsim'])}
+# report how much of the CPU stage was hidden behind the GPU stage
+awk -v start=$JOB_START -v end=$(date +%s.%N) '{{ sum[$1] += $4-$3 }} END {{
+    total = 0
+    for (s in sum) {{ printf "stage %-10s %10.1f s\\n", s, sum[s]; total += sum[s] }}
+    printf "serial sum %10.1f s, wall time %10.1f s, overlap %10.1f s\\n", total, end-start, total-(end-start)
+}}' log_stages.txt | tee log_stages_summary.txt
 
 date
 echo "Removing the response file..."
 rm {os.path.basename(cfg['RESPONSE'])}
 
 echo "Exiting"
-    
+
 '''
 
 if __name__ == '__main__':
@@ -0,0 +1,101 @@
+import os, sys, json, math, time, argparse
+import h5py
+
+# Rewrite an HDF5 output with a storage profile (compression filter and level,
+# chunk size, datasets to drop) before it is transferred. The file is replaced
+# only if the repack succeeded. The sizes, compression ratio and time are
+# appended to a record file (repack.jsonl) summarized by report.py.
+
+RECORD_NAME='repack.jsonl'
+COMPRESSIONS=['gzip','lzf','none']
+# rows read and written at once are bounded by this size
+BLOCK_BYTES=64*1024**2
+
+
+def _has_references(ds):
+    dtype=ds.dtype
+    fields=[dtype[name] for name in dtype.names] if dtype.names else [dtype]
+    return any([h5py.check_dtype(ref=t) is not None for t in fields])
+
+
+def _copy(src,dst,drop,compression,level,shuffle,chunk_rows,chunk_bytes):
+    for key,val in src.attrs.items():
+        dst.attrs[key]=val
+    for name,obj in src.items():
+        if name in drop or obj.name.lstrip('/') in drop:
+            continue
+        if isinstance(obj,h5py.Group):
+            _copy(obj,dst.create_group(name),drop,compression,level,shuffle,chunk_rows,chunk_bytes)
+            continue
+        if obj.ndim < 1 or obj.shape[0] < 1:
+            src.copy(obj,dst,name=name)
+            continue
+        # rows per chunk and per copied block from the size of a row (e.g. a waveform is ~400 kB)
+        row_bytes=max(1,obj.dtype.itemsize*int(math.prod(obj.shape[1:])))
+        rows=max(1,min(chunk_rows,chunk_bytes//row_bytes,obj.shape[0]))
+        block=max(1,BLOCK_BYTES//(rows*row_bytes))*rows
+        kwargs=dict(chunks=(rows,)+obj.shape[1:])
+        if not compression == 'none':
+            kwargs.update(compression=compression,shuffle=shuffle)
+            if compression == 'gzip':
+                kwargs['compression_opts']=level
+        out=dst.create_dataset(name,shape=obj.shape,dtype=obj.dtype,**kwargs)
+        # copy in blocks of whole chunks to bound the memory
+        for start in range(0,obj.shape[0],block):
+            out[start:start+block]=obj[start:start+block]
+        for key,val in obj.attrs.items():
+            out.attrs[key]=val
+
+
+def repack(path,compression='gzip',level=4,shuffle=True,chunk_rows=65536,chunk_kb=1024,drop=[],record=None):
+    '''
+    Repack path in place. Returns the record (sizes, ratio, seconds), or None if the file
+    holds object references (which do not survive a copy into another file) and is kept as is.
+    A chunk holds at most chunk_rows rows and chunk_kb kB (at least one row).
+    '''
+    if not compression in COMPRESSIONS:
+        raise ValueError(f'Unknown compression {compression} (choose from {COMPRESSIONS})')
+    t0=time.time()
+    with h5py.File(path,'r') as fin:
+        refs=[]
+        fin.visititems(lambda name,obj: refs.append(name) if isinstance(obj,h5py.Dataset) and _has_references(obj) else None)
+        if refs:
+            print(f'Not repacking {path}: datasets with object references {refs}')
+            return None
+        try:
+            with h5py.File(path+'.repack','w') as fout:
+                _copy(fin,fout,drop,compression,int(level),bool(shuffle),int(chunk_rows),int(chunk_kb)*1024)
+        except Exception as e:
+            # do not leave a partial copy to be staged out with the outputs
+            if os.path.isfile(path+'.repack'):
+                os.remove(path+'.repack')
+            raise e
+    bytes_in=os.path.getsize(path)
+    bytes_out=os.path.getsize(path+'.repack')
+    os.replace(path+'.repack',path)
+
+    res=dict(file=os.path.basename(path),bytes_in=bytes_in,bytes_out=bytes_out,
+        ratio=round(bytes_in/bytes_out,3) if bytes_out else None,repack_s=round(time.time()-t0,3),
+        compression=compression,level=int(level),chunk_rows=int(chunk_rows),chunk_kb=int(chunk_kb),dropped=list(drop))
+    print(f'Repacked {path}: {bytes_in/1024**2:.1f} MB => {bytes_out/1024**2:.1f} MB (ratio {res["ratio"]}) in {res["repack_s"]:.1f} s')
+    if record:
+        with open(record,'a') as f:
+            f.write(json.dumps(res)+'\n')
+    return res
+
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(description='Repack an HDF5 file with a storage profile')
+    parser.add_argument('path')
+    parser.add_argument('--compression',choices=COMPRESSIONS,default='gzip')
+    parser.add_argument('--level',type=int,default=4,help='gzip level (0-9)')
+    parser.add_argument('--no-shuffle',action='store_true',help='disable the byte shuffle filter')
+    parser.add_argument('--chunk-rows',type=int,default=65536,help='maximum rows per chunk along the first axis')
+    parser.add_argument('--chunk-kb',type=int,default=1024,help='maximum size of a chunk in kB (at least one row)')
+    parser.add_argument('--drop',default='',help='comma-separated datasets (or groups) to remove')
+    parser.add_argument('--record',default=None,help=f'append the result to this file (e.g. {RECORD_NAME})')
+    args=parser.parse_args()
+
+    repack(args.path,args.compression,args.level,not args.no_shuffle,args.chunk_rows,args.chunk_kb,
+        [d for d in args.drop.split(',') if d],args.record)
+    sys.exit(0)
@@ -0,0 +1,211 @@
+import os, re, csv, json, argparse
+import work_queue
+import resolve_cache
+from concurrent.futures import ThreadPoolExecutor
+
+# Summarize a production from the small per-task files only (metrics_*.jsonl,
+# slurm logs, directory listings) without opening the physics outputs.
+
+JOB_DIR_PATTERN=re.compile(r'^job_(\d+)_(\d+)$')
+SLURM_LOG_PATTERN=re.compile(r'^slurm-(\d+)-(\d+)\.(out|err)$')
+OUTPUT_PREFIX='output_'
+# records of repack_h5.py (sizes, compression ratio and time of each repacked output)
+REPACK_RECORD='repack.jsonl'
+# message printed by slurmstepd => task state
+SLURM_STATES=[('DUE TO TIME LIMIT','timeout'),
+    ('DUE TO NODE FAILURE','node_fail'),
+    ('DUE TO PREEMPTION','preempted'),
+    ('CANCELLED','cancelled'),
+    ('oom-kill','oom'),
+    ]
+
+
+def _read_jsonl(path):
+    res=[]
+    with open(path,'r') as f:
+        for line in f:
+            try:
+                res.append(json.loads(line))
+            except ValueError:
+                continue
+    return res
+
+
+def scan_job(path):
+    '''
+    Collect the metrics and output size of one job directory.
+    '''
+    m=JOB_DIR_PATTERN.match(os.path.basename(path))
+    row=dict(job_dir=os.path.basename(path),job=int(m.group(1)),task=int(m.group(2)),
+        output_bytes=0,num_outputs=0,records=[],repack=[])
+    with os.scandir(path) as it:
+        for e in it:
+            if e.name.startswith('metrics_') and e.name.endswith('.jsonl'):
+                row['records'].extend(_read_jsonl(e.path))
+            elif e.name == REPACK_RECORD:
+                row['repack']=_read_jsonl(e.path)
+            elif e.name.startswith(OUTPUT_PREFIX) and e.is_file(follow_symlinks=False):
+                row['output_bytes']+=e.stat().st_size
+                row['num_outputs']+=1
+    return row
+
+
+def scan_logs(log_dir):
+    '''
+    Returns a dictionary (array job, task) => state found in the slurm logs.
+    '''
+    res=dict()
+    if not os.path.isdir(log_dir):
+        return res
+    for e in os.scandir(log_dir):
+        m=SLURM_LOG_PATTERN.match(e.name)
+        if not m:
+            continue
+        key=(int(m.group(1)),int(m.group(2)))
+        # slurmstepd messages are at the end of the log
+        with open(e.path,'rb') as f:
+            f.seek(max(0,e.stat().st_size-4096))
+            tail=f.read().decode(errors='replace')
+        for word,state in SLURM_STATES:
+            if word in tail:
+                res[key]=state
+                break
+    return res
+
+
+def task_events(cfg,records):
+    '''
+    Number of events produced by a task (a worker processes one unit of NUM_EVENTS per task ID
+    found in its records, other tasks SLURM_GPU_PACK chains of NUM_EVENTS).
+    '''
+    events=int(cfg.get('NUM_EVENTS',0))
+    if cfg.get('WORKER_MODE',False):
+        return events*len(set([r['task'] for r in records if not r['stage'] in ['stagein','stageout']]))
+    return events*int(cfg.get('SLURM_GPU_PACK',1))
+
+
+def _percentile(values,q):
+    values=sorted(values)
+    if not values:
+        return 0.
+    i=min(len(values)-1,max(0,int(round(q/100.*(len(values)-1)))))
+    return values[i]
+
+
+def summarize(production_dir,num_threads=32):
+    '''
+    Returns (summary dictionary, list of per-task rows) of a production.
+    '''
+    cfg=dict()
+    source=os.path.join(production_dir,'job_source','source.yaml')
+    if os.path.isfile(source):
+        with open(source,'r') as f:
+            cfg=resolve_cache.load(f)
+    num_tasks=int(cfg.get('WORKER_COUNT' if cfg.get('WORKER_MODE',False) else 'SLURM_NUM_JOBS',0))
+    # larndsim_s sums the stage over the chains of a task (one GPU each)
+    num_gpus=1 if 'SLURM_GPU' in cfg else 0
+
+    job_dirs=[e.path for e in os.scandir(production_dir) if e.is_dir() and JOB_DIR_PATTERN.match(e.name)]
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        rows=list(pool.map(scan_job,job_dirs))
+    states=scan_logs(os.path.join(production_dir,'slurm_logs'))
+
+    stages=dict()
+    repacked=[]
+    for row in rows:
+        records=row.pop('records')
+        repacked.extend(row.pop('repack'))
+        row['state']=states.get((row['job'],row['task']),'ok')
+        if row['state'] == 'ok' and any([r.get('exit_code',0) for r in records]):
+            row['state']='failed'
+        row['wall_s']=0.
+        if records:
+            row['wall_s']=round(max([r['end'] for r in records])-min([r['start'] for r in records]),3)
+        row['max_rss_mb']=max([r.get('max_rss_mb') or 0 for r in records],default=0)
+        gpu=[r['gpu_util_mean'] for r in records if r.get('gpu_util_mean') is not None]
+        row['gpu_util_mean']=round(sum(gpu)/len(gpu),1) if gpu else None
+        row['host']=records[0]['host'] if records else None
+        for r in records:
+            key=r['stage']+'_s'
+            row[key]=round(row.get(key,0.)+r['wall_s'],3)
+            if row['state'] == 'ok':
+                stages.setdefault(r['stage'],[]).append(r['wall_s'])
+        row['events']=task_events(cfg,records) if row['state'] == 'ok' else 0
+    rows.sort(key=lambda r: (r['task'],r['job']))
+
+    ok=[r for r in rows if r['state'] == 'ok']
+    total_events=sum([r['events'] for r in ok])
+    total_wall=sum([r['wall_s'] for r in ok])
+    gpu_s=num_gpus*sum([r.get('larndsim_s',0.) for r in ok])
+    summary=dict(production=os.path.abspath(production_dir),
+        expected_tasks=num_tasks,
+        job_dirs=len(rows),
+        ok=len(ok),
+        states={s:len([r for r in rows if r['state'] == s]) for s in set([r['state'] for r in rows])},
+        missing_tasks=sorted(set(range(1,num_tasks+1))-set([r['task'] for r in ok])),
+        events=total_events,
+        events_per_s=total_events/total_wall if total_wall else 0.,
+        gpu_s_per_event=gpu_s/total_events if total_events else 0.,
+        output_bytes=sum([r['output_bytes'] for r in rows]),
+        stages={name:dict(count=len(v),mean_s=sum(v)/len(v),p50_s=_percentile(v,50),p95_s=_percentile(v,95),total_s=sum(v))
+            for name,v in stages.items()},
+        )
+    if repacked:
+        bytes_in=sum([r['bytes_in'] for r in repacked])
+        bytes_out=sum([r['bytes_out'] for r in repacked])
+        summary['repack']=dict(files=len(repacked),bytes_in=bytes_in,bytes_out=bytes_out,
+            ratio=bytes_in/bytes_out if bytes_out else 0.,total_s=sum([r['repack_s'] for r in repacked]))
+    if cfg.get('WORKER_MODE',False):
+        summary['queue']=work_queue.status(os.path.join(production_dir,'queue'))
+    return summary,rows
+
+
+def print_summary(summary):
+    print(f'Production: {summary["production"]}')
+    print(f'Tasks: {summary["ok"]} ok / {summary["expected_tasks"]} expected ({summary["job_dirs"]} job dirs)')
+    for state,count in sorted(summary['states'].items()):
+        if not state == 'ok':
+            print(f'    {state:10s} {count}')
+    if 'queue' in summary:
+        print('Work units: '+', '.join([f'{state} {count}' for state,count in summary['queue'].items()]))
+    if summary['missing_tasks']:
+        print(f'Tasks without a successful job: {summary["missing_tasks"]}')
+    print(f'Events: {summary["events"]}  ({summary["events_per_s"]:.3f} events/s per task, {summary["gpu_s_per_event"]:.2f} GPU-s/event)')
+    print(f'Output size: {summary["output_bytes"]/1024**3:.3f} GB')
+    if 'repack' in summary:
+        r=summary['repack']
+        print(f'Repacked {r["files"]} file(s): {r["bytes_in"]/1024**3:.3f} GB => {r["bytes_out"]/1024**3:.3f} GB (ratio {r["ratio"]:.2f}) in {r["total_s"]:.1f} s')
+    total=sum([s['total_s'] for s in summary['stages'].values()])
+    print(f'\n{"stage":12s} {"count":>7s} {"mean[s]":>10s} {"p50[s]":>10s} {"p95[s]":>10s} {"fraction":>9s}')
+    for name,s in sorted(summary['stages'].items(),key=lambda x: -x[1]['total_s']):
+        frac=s['total_s']/total if total else 0.
+        print(f'{name:12s} {s["count"]:7d} {s["mean_s"]:10.1f} {s["p50_s"]:10.1f} {s["p95_s"]:10.1f} {frac:9.1%}')
+
+
+def write_rows(rows,path):
+    keys=[]
+    for row in rows:
+        keys.extend([k for k in row if not k in keys])
+    if path.endswith('.parquet'):
+        # optional dependency
+        import pandas as pd
+        pd.DataFrame(rows,columns=keys).to_parquet(path)
+        return
+    with open(path,'w',newline='') as f:
+        w=csv.DictWriter(f,fieldnames=keys)
+        w.writeheader()
+        w.writerows(rows)
+
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(description='Summarize throughput and failures of a production')
+    parser.add_argument('production_dir')
+    parser.add_argument('-o','--output',help='per-task table (.csv or .parquet)')
+    parser.add_argument('-j','--threads',type=int,default=32)
+    args=parser.parse_args()
+
+    summary,rows=summarize(args.production_dir,args.threads)
+    print_summary(summary)
+    if args.output:
+        write_rows(rows,args.output)
+        print(f'\nWrote {len(rows)} row(s) to {args.output}')
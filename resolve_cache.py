@@ -0,0 +1,132 @@
+import os, sys, json, time, shutil, hashlib, tempfile, subprocess
+import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader, CDumper as Dumper
+except ImportError:
+    from yaml import SafeLoader, Dumper
+
+# Configuration loading and a cache of resolved asset paths for project generation.
+# YAML goes through libyaml when available. Resolved values (asset paths, the
+# real path of the image, the list of larnd2supera configs) are cached in a JSON
+# file keyed by the configuration entries they come from, and are valid as long
+# as the size and mtime of the files they depend on did not change.
+
+CACHE_NAME='resolve_cache.json'
+
+
+def load(data):
+    '''
+    yaml.safe_load with the libyaml parser if available.
+    '''
+    return yaml.load(data,Loader=SafeLoader)
+
+
+def dump(data):
+    return yaml.dump(data,Dumper=Dumper,default_flow_style=False)
+
+
+def cache_key(name,entries):
+    '''
+    Key of the value name resolved from the configuration entries (JSON serializable).
+    '''
+    data=json.dumps(entries,sort_keys=True,default=str)
+    return f'{name}:{hashlib.sha1(data.encode()).hexdigest()}'
+
+
+def _stamp(path):
+    try:
+        st=os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size,st.st_mtime_ns]
+
+
+class resolve_cache():
+
+    def __init__(self,cache_file=None):
+        self.cache_file=cache_file
+        self.cache=dict()
+        self.modified=False
+        if cache_file and os.path.isfile(cache_file):
+            try:
+                with open(cache_file,'r') as f:
+                    self.cache=json.load(f)
+            except ValueError:
+                print(f'Ignoring a corrupted resolve cache {cache_file}')
+
+    def get(self,key,compute):
+        '''
+        Returns the cached value of key, or the value of compute() => (value, [paths the value depends on]).
+        '''
+        entry=self.cache.get(key)
+        if entry is not None and all([_stamp(p) == s for p,s in entry['files']]):
+            return entry['value']
+        value,paths=compute()
+        self.cache[key]=dict(value=value,files=[[p,_stamp(p)] for p in paths])
+        self.modified=True
+        return value
+
+    def save(self):
+        if not self.cache_file or not self.modified:
+            return
+        tmp=self.cache_file+f'.{os.getpid()}'
+        with open(tmp,'w') as f:
+            json.dump(self.cache,f)
+        os.replace(tmp,self.cache_file)
+        self.modified=False
+
+
+def benchmark(config,project,repeat=5):
+    '''
+    Time the start-up of a generation: importing the project module (fresh interpreter),
+    loading the configuration with the pure python and libyaml loaders, and resolving
+    the configuration without and with the resolve cache.
+    '''
+    with open(config,'r') as f:
+        text=f.read()
+
+    cmd=f'import time; t0=time.time(); import project_{project}; print(time.time()-t0)'
+    times=[float(subprocess.run([sys.executable,'-c',cmd],capture_output=True,text=True,check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))).stdout) for _ in range(repeat)]
+    print(f'import project_{project:12s} {min(times)*1000:9.1f} ms')
+
+    for name,loader in [('yaml.SafeLoader',yaml.SafeLoader),('yaml.CSafeLoader',SafeLoader)]:
+        t0=time.time()
+        for _ in range(repeat*20):
+            yaml.load(text,Loader=loader)
+        print(f'{name:22s} {(time.time()-t0)/(repeat*20)*1000:9.3f} ms')
+
+    # productions are parsed into a temporary STORAGE_DIR (the project writes its file lists there)
+    module=__import__(f'project_{project}')
+    cfg=load(text)
+    tmp=tempfile.mkdtemp()
+    cfg['STORAGE_DIR']=tmp
+    cache_file=os.path.join(tmp,CACHE_NAME)
+    try:
+        for label,enabled in [('resolve (no cache)',False),('resolve (cold cache)',cache_file),('resolve (warm cache)',cache_file)]:
+            cfg['RESOLVE_CACHE']=enabled
+            times=[]
+            for _ in range(1 if label.endswith('(cold cache)') else repeat):
+                p=getattr(module,f'project_{project}')()
+                t0=time.time()
+                res=p.parse(dump(cfg))
+                t1=time.time()
+                os.makedirs(res['JOB_SOURCE_DIR'])
+                t2=time.time()
+                p.parse_project_config(res)
+                times.append(time.time()-t2+t1-t0)
+                if p.RESOLVE_CACHE is not None:
+                    p.RESOLVE_CACHE.save()
+            print(f'{label:22s} {min(times)*1000:9.1f} ms')
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    if not len(sys.argv) in [4,5] or not sys.argv[1] == 'benchmark':
+        print(f'Invalid arguments {sys.argv[1:]}')
+        print(f'Usage: {os.path.basename(__file__)} benchmark $JOB_CONFIGURATION_YAML $PROJECT [$REPEAT]')
+        sys.exit(1)
+
+    benchmark(sys.argv[2],sys.argv[3],int(sys.argv[4]) if len(sys.argv) == 5 else 5)
+    sys.exit(0)
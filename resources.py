@@ -0,0 +1,156 @@
+import os, glob, json, math, hashlib
+import resolve_cache
+from concurrent.futures import ThreadPoolExecutor
+from report import scan_job, task_events, JOB_DIR_PATTERN
+
+# Right-size SLURM_MEM, SLURM_TIME and SLURM_CPU, and choose the number of events
+# per task, from the metrics of earlier productions with the same configuration
+# fingerprint.
+
+# keys that do not change the per-event cost of a job
+FINGERPRINT_IGNORE=['STORAGE_DIR','SLURM_','STORE_IMAGE','STAGE_','METRICS','NODE_CACHE_GB','SHARED_FILE_MB',
+    'NUM_EVENTS','CONFIG_FINGERPRINT','GLOB','INCREMENTAL','FILES_PER_JOB','TARGET_JOB_COUNT',
+    'TOTAL_EVENTS','TARGET_TASK_TIME','CALIBRATION_','CHECKPOINT','MASTER_SEED','WORKER_',
+    'PRODUCTION_ID','ASSET_STORE_DIR','RESOLVE_CACHE','SCHEDULER','POOL_']
+# stages not scaling with the number of events
+FIXED_STAGES=['stagein','stageout','input_copy']
+
+
+def fingerprint(cfg):
+    '''
+    Hash of the configuration entries that determine the cost per event.
+    '''
+    keys=sorted([k for k in cfg if not any([k.startswith(p) for p in FINGERPRINT_IGNORE])])
+    data=json.dumps({k:cfg[k] for k in keys},sort_keys=True,default=str)
+    return hashlib.sha1(data.encode()).hexdigest()[:16]
+
+
+def _percentile(values,q):
+    values=sorted(values)
+    i=min(len(values)-1,max(0,int(math.ceil(q/100.*len(values)))-1))
+    return values[i]
+
+
+def _samples(production_dir):
+    '''
+    Per successful task: (peak RSS in GB, fixed time, time per event, CPUs used).
+    '''
+    with open(os.path.join(production_dir,'job_source','source.yaml'),'r') as f:
+        cfg=resolve_cache.load(f)
+    res=[]
+    for e in os.scandir(production_dir):
+        if not e.is_dir() or not JOB_DIR_PATTERN.match(e.name):
+            continue
+        records=scan_job(e.path)['records']
+        if not records or any([r.get('exit_code',0) for r in records]):
+            continue
+        names=set([r['stage'] for r in records])
+        if not 'stageout' in names:
+            continue
+        wall=max([r['end'] for r in records])-min([r['start'] for r in records])
+        fixed=sum([r['wall_s'] for r in records if r['stage'] in FIXED_STAGES])
+        rss=max([r.get('max_rss_mb') or 0 for r in records])/1024.
+        cpus=max([r['cpu_s']/r['wall_s'] for r in records if r.get('cpu_s') and r['wall_s'] > 0],default=1.)
+        # chains of a packed task run in parallel
+        events=max(1,task_events(cfg,records)//int(cfg.get('SLURM_GPU_PACK',1)))
+        res.append((rss,fixed,max(0.,wall-fixed)/events,cpus))
+    return res
+
+
+def history(storage_dir,fp,num_threads=16):
+    '''
+    Collect samples from all productions under storage_dir with fingerprint fp.
+    '''
+    matches=[]
+    for source in glob.glob(os.path.join(storage_dir,'production_*','job_source','source.yaml')):
+        with open(source,'r') as f:
+            for line in f:
+                if line.startswith('CONFIG_FINGERPRINT:'):
+                    if line.split(':',1)[1].strip().strip('\'"') == fp:
+                        matches.append(os.path.dirname(os.path.dirname(source)))
+                    break
+    res=[]
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        for samples in pool.map(_samples,matches):
+            res.extend(samples)
+    return matches,res
+
+
+def plan(cfg,storage_dir):
+    '''
+    Apply TOTAL_EVENTS (tune_events) and SLURM_AUTO (right_size) to cfg using the history under storage_dir.
+    '''
+    if not cfg.get('SLURM_AUTO',False) and not 'TOTAL_EVENTS' in cfg:
+        return
+    productions,samples=history(storage_dir,fingerprint(cfg))
+    print(f'Found {len(samples)} successful task(s) in {len(productions)} earlier production(s) with the same config')
+    tune_events(cfg,samples)
+    right_size(cfg,samples)
+
+
+def tune_events(cfg,samples):
+    '''
+    With TOTAL_EVENTS, set NUM_EVENTS so that a task takes about TARGET_TASK_TIME (seconds, default
+    SLURM_TIME) and SLURM_NUM_JOBS to reach TOTAL_EVENTS. Without enough samples, set up a calibration
+    production of CALIBRATION_TASKS tasks with CALIBRATION_EVENTS events instead.
+    '''
+    if not 'TOTAL_EVENTS' in cfg:
+        return
+    total=int(cfg['TOTAL_EVENTS'])
+    if total < 1:
+        raise ValueError(f'TOTAL_EVENTS must be positive (given: {total})')
+    target=float(cfg.get('TARGET_TASK_TIME',cfg['SLURM_TIME']))
+    q=float(cfg.get('SLURM_AUTO_PERCENTILE',95))
+    min_samples=int(cfg.get('SLURM_AUTO_MIN_SAMPLES',5))
+
+    if len(samples) < min_samples:
+        cfg['NUM_EVENTS']=min(total,int(cfg.get('CALIBRATION_EVENTS',10)))
+        cfg['SLURM_NUM_JOBS']=int(cfg.get('CALIBRATION_TASKS',min_samples))
+        print(f'TOTAL_EVENTS: need at least {min_samples} task(s) to measure the cost per event')
+        print(f'TOTAL_EVENTS: generating a calibration production ({cfg["SLURM_NUM_JOBS"]} tasks x {cfg["NUM_EVENTS"]} events)')
+        print('TOTAL_EVENTS: run the generator again once it has finished')
+        return
+
+    fixed=_percentile([s[1] for s in samples],q)
+    per_event=_percentile([s[2] for s in samples],q)
+    if target <= fixed:
+        raise ValueError(f'TARGET_TASK_TIME {target}s does not cover the fixed cost per task ({fixed:.0f}s)')
+    events=total
+    if per_event > 0:
+        events=max(1,min(total,int((target-fixed)/per_event)))
+    # each task runs SLURM_GPU_PACK chains of NUM_EVENTS in parallel
+    chains=int(cfg.get('SLURM_GPU_PACK',1))
+    cfg['NUM_EVENTS']=events
+    cfg['SLURM_NUM_JOBS']=int(math.ceil(total/(events*chains)))
+    print(f'TOTAL_EVENTS: {fixed:.0f}s per task + {per_event:.2f}s per event (p{q:g})')
+    print(f'TOTAL_EVENTS: {cfg["SLURM_NUM_JOBS"]} tasks x {chains} chain(s) x {events} events = {cfg["SLURM_NUM_JOBS"]*chains*events} events '+
+        f'(~{fixed+per_event*events:.0f}s per task)')
+
+
+def right_size(cfg,samples):
+    '''
+    With SLURM_AUTO, overwrite SLURM_MEM (GB), SLURM_TIME (seconds) and SLURM_CPU of cfg with
+    the SLURM_AUTO_PERCENTILE of earlier tasks plus SLURM_AUTO_MARGIN (fraction). The time
+    scales with NUM_EVENTS. Values in cfg are kept when there are too few samples.
+    '''
+    if not cfg.get('SLURM_AUTO',False):
+        return
+    q=float(cfg.get('SLURM_AUTO_PERCENTILE',95))
+    margin=1.+float(cfg.get('SLURM_AUTO_MARGIN',0.2))
+    min_samples=int(cfg.get('SLURM_AUTO_MIN_SAMPLES',5))
+
+    if len(samples) < min_samples:
+        print(f'SLURM_AUTO: need at least {min_samples} task(s), using the configured resources')
+        return
+
+    events=max(1,int(cfg.get('NUM_EVENTS',1)))
+    cpu=max(1,int(math.ceil(_percentile([s[3] for s in samples],q))))
+    mem=max(cpu,int(math.ceil(_percentile([s[0] for s in samples],q)*margin)))
+    time=_percentile([s[1] for s in samples],q)+_percentile([s[2] for s in samples],q)*events
+    time=max(60,int(math.ceil(time*margin/60.))*60)
+    print(f'SLURM_AUTO: SLURM_MEM {cfg["SLURM_MEM"]} => {mem} GB')
+    print(f'SLURM_AUTO: SLURM_CPU {cfg["SLURM_CPU"]} => {cpu}')
+    print(f'SLURM_AUTO: SLURM_TIME {cfg["SLURM_TIME"]} => {time} s ({events} events)')
+    cfg['SLURM_MEM']=mem
+    cfg['SLURM_CPU']=cpu
+    cfg['SLURM_TIME']=time
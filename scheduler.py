@@ -0,0 +1,356 @@
+import os, sys, time, signal, socket, random, threading, subprocess
+import yaml
+
+# Scheduler backends used to submit array indices of a production and to poll
+# their state. Each backend implements
+#
+#   submit(script, indices, exclude, throttle) => job ID
+#   states(job_id) => {index: (state, node)}
+#
+# with states PENDING, RUNNING, COMPLETED, FAILED, TIMEOUT, NODE_FAIL,
+# OUT_OF_MEMORY, PREEMPTED or CANCELLED (SLURM names).
+#
+# A production is generated for the SCHEDULER backend of its configuration:
+# slurm (sbatch) or pool, which runs the array tasks of the same job script
+# on this machine with a bounded process pool (see pool_backend).
+
+ACTIVE_STATES=['PENDING','RUNNING','REQUEUED','CONFIGURING','COMPLETING','SUSPENDED']
+
+
+def array_spec(indices):
+    '''
+    Compress sorted array indices into a --array specification (e.g. 1-3,7).
+    '''
+    ranges = []
+    for task in sorted(indices):
+        if ranges and ranges[-1][1] == task-1:
+            ranges[-1][1] = task
+        else:
+            ranges.append([task,task])
+    return ','.join([str(a) if a == b else f'{a}-{b}' for a,b in ranges])
+
+
+def _expand(spec):
+    res = []
+    for part in spec.split('%')[0].split(','):
+        if '-' in part:
+            a,b = part.split('-')
+            res.extend(range(int(a),int(b)+1))
+        elif part:
+            res.append(int(part))
+    return res
+
+
+class slurm_backend():
+
+    def submit(self,script,indices,exclude=[],throttle=0):
+        # throttle: maximum number of tasks running at once (%N, 0 for no limit)
+        cmd = ['sbatch','--parsable',f'--array={array_spec(indices)}'+(f'%{throttle}' if throttle > 0 else '')]
+        if exclude:
+            cmd.append(f'--exclude={",".join(sorted(exclude))}')
+        cmd.append(script)
+        out = subprocess.run(cmd,capture_output=True,text=True)
+        if not out.returncode == 0:
+            print(out.stderr)
+            raise RuntimeError(f'sbatch failed ({" ".join(cmd)})')
+        return out.stdout.strip().split(';')[0]
+
+    def submit_after(self,script,job_id):
+        '''
+        Submit a single job starting once job_id is over (e.g. the merge job of a production).
+        '''
+        cmd = ['sbatch','--parsable',f'--dependency=afterany:{job_id}',script]
+        out = subprocess.run(cmd,capture_output=True,text=True)
+        if not out.returncode == 0:
+            print(out.stderr)
+            raise RuntimeError(f'sbatch failed ({" ".join(cmd)})')
+        return out.stdout.strip().split(';')[0]
+
+    def set_throttle(self,job_id,throttle):
+        '''
+        Change the maximum number of running tasks of an array (tasks already running are not stopped).
+        '''
+        cmd = ['scontrol','update',f'JobId={job_id}',f'ArrayTaskThrottle={throttle}']
+        out = subprocess.run(cmd,capture_output=True,text=True)
+        if not out.returncode == 0:
+            print(out.stderr)
+            raise RuntimeError(f'scontrol failed ({" ".join(cmd)})')
+
+    def states(self,job_id):
+        out = subprocess.run(['sacct','-j',str(job_id),'-X','--noheader','--parsable2',
+            '--format=JobID,State,NodeList'],capture_output=True,text=True)
+        if not out.returncode == 0:
+            print(out.stderr)
+            raise RuntimeError(f'sacct failed for job {job_id}')
+        res = dict()
+        for line in out.stdout.splitlines():
+            words = line.split('|')
+            if len(words) < 3 or not '_' in words[0]:
+                continue
+            task = words[0].split('_',1)[1]
+            # "CANCELLED by 1234" => CANCELLED
+            state = words[1].split()[0] if words[1] else 'PENDING'
+            node = None if words[2] in ['','None assigned'] else words[2]
+            # pending tasks are reported as 1234_[5-10%4]
+            for index in _expand(task.strip('[]')):
+                res[index] = (state,node)
+        return res
+
+
+class local_backend():
+    '''
+    Runs each array index of the submission script with bash on this machine, for testing.
+    Tasks are assigned to fake node names in turn; fail_nodes always report NODE_FAIL
+    and any other task fails as NODE_FAIL with probability fail_rate.
+    '''
+
+    def __init__(self,nodes=['local1','local2'],fail_nodes=[],fail_rate=0.,seed=None):
+        self.nodes = list(nodes)
+        self.fail_nodes = list(fail_nodes)
+        self.fail_rate = float(fail_rate)
+        self.rng = random.Random(seed)
+        self.jobs = dict()
+        self.next_id = 1
+        self.next_node = 0
+
+    def submit(self,script,indices,exclude=[],throttle=0):
+        nodes = [n for n in self.nodes if not n in exclude]
+        if not nodes:
+            raise RuntimeError('all nodes are excluded')
+        job_id = str(self.next_id)
+        self.next_id += 1
+        tasks = dict()
+        for index in indices:
+            node = nodes[self.next_node % len(nodes)]
+            self.next_node += 1
+            if node in self.fail_nodes or self.rng.random() < self.fail_rate:
+                tasks[index] = (None,node)
+                continue
+            env = dict(os.environ,SLURM_ARRAY_JOB_ID=job_id,SLURM_ARRAY_TASK_ID=str(index),SLURMD_NODENAME=node)
+            log = open(os.path.join(os.path.dirname(script),f'local-{job_id}-{index}.out'),'w')
+            tasks[index] = (subprocess.Popen(['bash',script],env=env,stdout=log,stderr=subprocess.STDOUT),node)
+        self.jobs[job_id] = tasks
+        return job_id
+
+    def states(self,job_id):
+        res = dict()
+        for index,(proc,node) in self.jobs.get(job_id,dict()).items():
+            if proc is None:
+                res[index] = ('NODE_FAIL',node)
+            elif proc.poll() is None:
+                res[index] = ('RUNNING',node)
+            elif proc.returncode == 0:
+                res[index] = ('COMPLETED',node)
+            elif proc.returncode in [143,-15]:
+                res[index] = ('TIMEOUT',node)
+            else:
+                res[index] = ('FAILED',node)
+        return res
+
+
+def _seconds(text):
+    '''
+    Seconds of a SLURM_TIME as written in the configuration ([D day[s], ]H:MM:SS).
+    '''
+    days=0
+    if 'day' in str(text):
+        days,text=str(text).split(',')
+        days=int(days.split()[0])
+    h,m,sec=[int(float(v)) for v in str(text).split(':')]
+    return days*86400+h*3600+m*60+sec
+
+
+def _group_rss():
+    '''
+    Returns {process group: resident memory in bytes} of the processes of this machine.
+    '''
+    page=os.sysconf('SC_PAGE_SIZE')
+    res=dict()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat','r') as f:
+                fields=f.read().rsplit(')',1)[1].split()
+        except (OSError,IndexError):
+            continue
+        # fields from the state: pgrp is the 5th and rss the 24th field of stat
+        res[int(fields[2])]=res.get(int(fields[2]),0)+int(fields[21])*page
+    return res
+
+
+class pool_backend():
+    '''
+    Runs the array tasks of a submission script with bash on this machine, at most as many
+    at once as the CPUs and memory allow (and max_workers). Each task is pinned to its own
+    cpus_per_task CPUs (and gpus_per_task GPUs if num_gpus is given), killed when its processes
+    use more than mem_gb (OUT_OF_MEMORY) or run longer than time_limit seconds (TIMEOUT, with
+    SIGTERM sent term_grace seconds earlier to let a checkpointing job flush its outputs).
+    Logs are written as log_dir/slurm-JOB-INDEX.out with the messages slurmstepd would add.
+    '''
+
+    def __init__(self,cpus_per_task,mem_gb,time_limit,log_dir,max_workers=0,num_gpus=0,gpus_per_task=1,
+        term_grace=0,poll=1.):
+        self.cpus_per_task=int(cpus_per_task)
+        self.mem_bytes=float(mem_gb)*1024**3
+        self.time_limit=float(time_limit)
+        self.log_dir=log_dir
+        self.term_grace=float(term_grace)
+        self.poll=float(poll)
+        self.gpus_per_task=int(gpus_per_task)
+
+        cpus=sorted(os.sched_getaffinity(0))
+        total_mem=os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+        slots=min(len(cpus)//self.cpus_per_task,int(total_mem//self.mem_bytes))
+        if num_gpus:
+            slots=min(slots,int(num_gpus)//self.gpus_per_task)
+        if max_workers:
+            slots=min(slots,int(max_workers))
+        if slots < 1:
+            raise ValueError(f'a task needs {self.cpus_per_task} CPU(s), {mem_gb} GB (and {gpus_per_task if num_gpus else 0} GPU(s)): '+
+                f'only {len(cpus)} CPU(s), {total_mem/1024**3:.1f} GB and {num_gpus} GPU(s) on this machine')
+        self.slots=[dict(cpus=cpus[i*self.cpus_per_task:(i+1)*self.cpus_per_task],
+            gpus=list(range(i*self.gpus_per_task,(i+1)*self.gpus_per_task)) if num_gpus else None)
+            for i in range(slots)]
+        print(f'Running up to {slots} task(s) at once ({self.cpus_per_task} CPU(s), {mem_gb} GB each)')
+
+        self.lock=threading.Lock()
+        self.jobs=dict()
+        self.threads=dict()
+        self.last_id=0
+
+    @classmethod
+    def from_config(cls,cfg,max_workers=None):
+        '''
+        Backend with the limits of a production configuration (source.yaml).
+        '''
+        pack=int(cfg.get('SLURM_GPU_PACK',1))
+        grace=int(cfg.get('CHECKPOINT_GRACE',300)) if cfg.get('CHECKPOINT',False) else 0
+        return cls(int(cfg['SLURM_CPU'])*pack,float(cfg['SLURM_MEM'])*pack,_seconds(cfg['SLURM_TIME']),cfg['JOB_LOG_DIR'],
+            cfg.get('POOL_WORKERS',0) if max_workers is None else max_workers,
+            cfg.get('POOL_GPUS',0),pack,grace)
+
+    def submit(self,script,indices,exclude=[],throttle=0):
+        with self.lock:
+            # job IDs name the work directories: keep them unique across runs
+            self.last_id=max(self.last_id+1,int(time.time()) % 1000000000)
+            job_id=str(self.last_id)
+            self.jobs[job_id]={index:dict(state='PENDING',node=None) for index in indices}
+        os.makedirs(self.log_dir,exist_ok=True)
+        self.threads[job_id]=threading.Thread(target=self._run,args=(job_id,script,throttle),daemon=True)
+        self.threads[job_id].start()
+        return job_id
+
+    def _start(self,job_id,script,index,slot):
+        env=dict(os.environ,SLURM_ARRAY_JOB_ID=job_id,SLURM_ARRAY_TASK_ID=str(index),SLURM_JOB_ID=f'{job_id}_{index}',
+            SLURM_CPUS_PER_TASK=str(self.cpus_per_task),SLURMD_NODENAME=socket.gethostname())
+        if slot['gpus'] is not None:
+            env['CUDA_VISIBLE_DEVICES']=','.join([str(g) for g in slot['gpus']])
+        log=open(os.path.join(self.log_dir,f'slurm-{job_id}-{index}.out'),'w')
+        proc=subprocess.Popen(['bash',script],env=env,stdout=log,stderr=subprocess.STDOUT,
+            start_new_session=True,preexec_fn=lambda: os.sched_setaffinity(0,slot['cpus']))
+        log.close()
+        return dict(proc=proc,slot=slot,start=time.time(),termed=False,killed=None)
+
+    def _stop(self,job_id,index,task,reason):
+        with open(os.path.join(self.log_dir,f'slurm-{job_id}-{index}.out'),'a') as f:
+            if reason == 'TIMEOUT':
+                f.write(f'slurmstepd: error: *** JOB {job_id}_{index} CANCELLED AT {time.strftime("%Y-%m-%dT%H:%M:%S")} DUE TO TIME LIMIT ***\n')
+            else:
+                f.write(f'slurmstepd: error: Detected 1 oom-kill event(s) in StepId={job_id}_{index}.batch.\n')
+        try:
+            os.killpg(task['proc'].pid,signal.SIGTERM if reason == 'TIMEOUT' else signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        task['killed']=(reason,time.time())
+
+    def _run(self,job_id,script,throttle=0):
+        pending=sorted(self.jobs[job_id])
+        free=list(self.slots)[:throttle] if throttle > 0 else list(self.slots)
+        running=dict()
+        while pending or running:
+            while pending and free:
+                index=pending.pop(0)
+                running[index]=self._start(job_id,script,index,free.pop(0))
+                with self.lock:
+                    self.jobs[job_id][index]=dict(state='RUNNING',node=socket.gethostname())
+            time.sleep(self.poll)
+
+            rss=_group_rss()
+            for index,task in list(running.items()):
+                proc=task['proc']
+                elapsed=time.time()-task['start']
+                if proc.poll() is None:
+                    if task['killed'] is None and rss.get(proc.pid,0) > self.mem_bytes:
+                        self._stop(job_id,index,task,'OUT_OF_MEMORY')
+                    elif task['killed'] is None and elapsed > self.time_limit:
+                        self._stop(job_id,index,task,'TIMEOUT')
+                    elif task['killed'] is not None and time.time()-task['killed'][1] > 30:
+                        try:
+                            os.killpg(proc.pid,signal.SIGKILL)
+                        except ProcessLookupError:
+                            pass
+                    elif self.term_grace and not task['termed'] and elapsed > self.time_limit-self.term_grace:
+                        # like --signal=B:TERM@GRACE: the batch script only
+                        proc.send_signal(signal.SIGTERM)
+                        task['termed']=True
+                    continue
+                if task['killed'] is not None:
+                    state=task['killed'][0]
+                else:
+                    state='COMPLETED' if proc.returncode == 0 else 'FAILED'
+                with self.lock:
+                    self.jobs[job_id][index]=dict(state=state,node=socket.gethostname(),
+                        exit_code=proc.returncode,elapsed=elapsed)
+                free.append(task['slot'])
+                running.pop(index)
+
+    def states(self,job_id):
+        with self.lock:
+            return {index:(task['state'],task['node']) for index,task in self.jobs.get(job_id,dict()).items()}
+
+    def wait(self,job_id):
+        self.threads[job_id].join()
+        with self.lock:
+            return dict(self.jobs[job_id])
+
+
+def submit_command(cfg):
+    '''
+    Command running the entry point of a production (submit.sh) with its SCHEDULER backend.
+    '''
+    if cfg['SCHEDULER'] == 'pool':
+        return f'{sys.executable} {os.path.abspath(__file__)} pool'
+    return 'sbatch'
+
+
+BACKENDS=dict(slurm=slurm_backend,local=local_backend,pool=pool_backend)
+
+
+if __name__ == '__main__':
+    if not len(sys.argv) in [3,4] or not sys.argv[1] == 'pool':
+        print(f'Invalid arguments {sys.argv[1:]}')
+        print(f'Usage: {os.path.basename(__file__)} pool $SUBMISSION_SCRIPT [$ARRAY_SPEC]')
+        sys.exit(1)
+
+    script=os.path.abspath(sys.argv[2])
+    with open(os.path.join(os.path.dirname(script),'source.yaml'),'r') as f:
+        cfg=yaml.safe_load(f)
+    if len(sys.argv) == 4:
+        indices=_expand(sys.argv[3])
+    else:
+        indices=list(range(1,int(cfg['WORKER_COUNT'] if cfg.get('WORKER_MODE',False) else cfg['SLURM_NUM_JOBS'])+1))
+
+    backend=pool_backend.from_config(cfg)
+    t0=time.time()
+    job_id=backend.submit(script,indices)
+    print(f'Running {len(indices)} task(s) of {script} as job {job_id}')
+    tasks=backend.wait(job_id)
+    elapsed=time.time()-t0
+
+    for index,task in sorted(tasks.items()):
+        print(f'{job_id}_{index:<6d} {task["state"]:14s} exit {task["exit_code"]:4d} {task["elapsed"]:9.1f} s')
+    done=len([t for t in tasks.values() if t['state'] == 'COMPLETED'])
+    print(f'{done}/{len(tasks)} task(s) completed in {elapsed:.1f} s ({done/max(elapsed,1.e-6)*3600:.1f} tasks/h)')
+    sys.exit(0 if done == len(tasks) else 1)
+
@@ -0,0 +1,122 @@
+import os, re, sys, json, glob, hashlib
+
+# Per-task random seeds derived from the production MASTER_SEED, so that array
+# tasks (and chains, pipeline batches, worker units) generate independent events
+# and any task can be reproduced. The macro command runs in the job and writes
+# the seeded edep-sim macro and bomb generator config for one output; the check
+# command looks for duplicated seeds and events across the outputs of a production.
+
+SEED_RECORDS='seeds.jsonl'
+# per-event content compared by check (IDs differ between files by construction)
+ID_FIELDS=['eventID','event_id','trackID','track_id','vertex_id','vertexID','file_traj_id','file_vertex_id']
+
+
+def derive(master,*keys):
+    '''
+    Returns a seed in [1, 2^31-1] from the master seed and keys (task, chain, batch, stream).
+    '''
+    data=':'.join([str(master)]+[str(k) for k in keys]).encode()
+    return int.from_bytes(hashlib.sha256(data).digest()[:8],'little') % (2**31-1) + 1
+
+
+def write_macro(master,task,chain,batch,name,macro,bomb_config):
+    '''
+    Write name.mac and name-bomb.yaml with the seeds of (task,chain,batch) and record them.
+    '''
+    edep_seed=derive(master,task,chain,batch,'edep')
+    bomb_seed=derive(master,task,chain,batch,'bomb')
+
+    with open(bomb_config,'r') as f:
+        contents=f.read()
+    if re.search(r'^SEED:',contents,flags=re.M):
+        contents=re.sub(r'^SEED:.*$',f'SEED: {bomb_seed}',contents,flags=re.M)
+    else:
+        contents+=f'\nSEED: {bomb_seed}\n'
+    with open(f'{name}-bomb.yaml','w') as f:
+        f.write(contents)
+
+    with open(macro,'r') as f:
+        contents=f.read()
+    contents=contents.replace('@EDEP_SEED@',str(edep_seed)).replace('@BOMB_CONFIG@',f'{name}-bomb.yaml')
+    with open(f'{name}.mac','w') as f:
+        f.write(contents)
+
+    record=dict(output=name,task=int(task),chain=int(chain),batch=int(batch),master_seed=int(master),
+        edep_seed=edep_seed,bomb_seed=bomb_seed)
+    with open(SEED_RECORDS,'a') as f:
+        f.write(json.dumps(record)+'\n')
+
+
+def _event_digests(path):
+    import numpy as np
+    import h5py
+    from numpy.lib import recfunctions
+    res=dict()
+    with h5py.File(path,'r') as f:
+        if not 'segments' in f:
+            return res
+        seg=f['segments'][:]
+    key=[k for k in ['eventID','event_id'] if k in seg.dtype.names]
+    if not key:
+        return res
+    seg=seg[np.argsort(seg[key[0]],kind='stable')]
+    events,starts=np.unique(seg[key[0]],return_index=True)
+    rows=recfunctions.repack_fields(seg[[k for k in seg.dtype.names if not k in ID_FIELDS]])
+    bounds=list(starts)+[len(seg)]
+    for i,event in enumerate(events):
+        res[int(event)]=hashlib.sha1(rows[bounds[i]:bounds[i+1]].tobytes()).hexdigest()
+    return res
+
+
+def check(production_dir):
+    '''
+    Returns a list of problems: seeds used by more than one output, and events with identical
+    segments found in several edep-sim outputs.
+    '''
+    import shard
+    problems=[]
+    # a resubmitted task reuses its seeds by design: keep the latest job of each (task, chain, batch)
+    latest=dict()
+    for path in glob.glob(os.path.join(production_dir,'job_*','**',SEED_RECORDS),recursive=True):
+        with open(path,'r') as f:
+            for line in f:
+                r=json.loads(line)
+                m=re.match(r'^output_(\d+)_',r['output'])
+                job=int(m.group(1)) if m else 0
+                key=(r['task'],r['chain'],r['batch'])
+                if not key in latest or latest[key][0] < job:
+                    latest[key]=(job,r)
+    seeds=dict()
+    for job,r in latest.values():
+        for key in ['edep_seed','bomb_seed']:
+            seeds.setdefault((key,r[key]),set()).add(r['output'])
+    for (key,seed),outputs in seeds.items():
+        if len(outputs) > 1:
+            problems.append(f'{key} {seed} used by {sorted(outputs)}')
+
+    # as well as the outputs (partial outputs of failed attempts are staged out too)
+    events=dict()
+    for path,job,task,size in shard.collect(production_dir,'-edepsim.h5'):
+        for event,digest in _event_digests(path).items():
+            events.setdefault(digest,[]).append(f'{os.path.basename(path)}:{event}')
+    for digest,where in events.items():
+        files=set([w.split(':')[0] for w in where])
+        if len(files) > 1:
+            problems.append(f'identical events {where}')
+    return problems
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 9 and sys.argv[1] == 'macro':
+        write_macro(*sys.argv[2:])
+    elif len(sys.argv) == 3 and sys.argv[1] == 'check':
+        problems=check(sys.argv[2])
+        for p in problems:
+            print(p)
+        print(f'Found {len(problems)} duplicate(s)')
+        sys.exit(1 if problems else 0)
+    else:
+        print(f'Invalid arguments {sys.argv[1:]}')
+        print(f'Usage: {os.path.basename(__file__)} macro $MASTER_SEED $TASK $CHAIN $BATCH $NAME $MACRO $BOMB_CONFIG')
+        print(f'       {os.path.basename(__file__)} check $PRODUCTION_DIR')
+        sys.exit(1)
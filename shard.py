@@ -0,0 +1,120 @@
+import os, re, csv, sys, glob, subprocess
+
+# Consolidate the per-task outputs of a production into shards of about a target
+# size, with index.csv mapping the events of each shard (and of the whole
+# production) back to the source file, job and task. HDF5 outputs are merged
+# with merge_h5, ROOT outputs with hadd (event counts need PyROOT).
+
+INDEX_NAME='index.csv'
+# output_JOB_TASK[_CHAIN][-PART]SUFFIX
+OUTPUT_PATTERN=r'^output_(\d+)_(\d+)(_\d+)?(-\d+)?{suffix}$'
+
+
+def collect(production_dir,suffix):
+    '''
+    Returns [(path, job, task, size)] of the outputs ending with suffix, ordered by task.
+    A task found in several jobs (resubmissions) is taken from the latest job.
+    '''
+    pattern=re.compile(OUTPUT_PATTERN.format(suffix=re.escape(suffix)))
+    latest=dict()
+    for path in glob.glob(os.path.join(production_dir,'job_*','output_*'+suffix)):
+        m=pattern.match(os.path.basename(path))
+        if not m:
+            continue
+        job,task=int(m.group(1)),int(m.group(2))
+        key=(task,m.group(3) or '',m.group(4) or '')
+        if not key in latest or latest[key][1] < job:
+            latest[key]=(path,job,task,os.path.getsize(path))
+    return [latest[key] for key in sorted(latest)]
+
+
+def plan(files,target_bytes):
+    '''
+    Split files (in order) into groups of at least target_bytes (except the last).
+    '''
+    groups=[[]]
+    size=0
+    for f in files:
+        groups[-1].append(f)
+        size+=f[3]
+        if size >= target_bytes:
+            groups.append([])
+            size=0
+    return [g for g in groups if g]
+
+
+def _root_entries(path):
+    try:
+        import ROOT
+    except ImportError:
+        return None
+    f=ROOT.TFile.Open(path)
+    entries=None
+    for key in f.GetListOfKeys():
+        obj=key.ReadObj()
+        if obj.InheritsFrom('TTree'):
+            entries=int(obj.GetEntries())
+            break
+    f.Close()
+    return entries
+
+
+def merge_shard(files,output):
+    '''
+    Merge files into output. Returns the number of events of each input (None if unknown).
+    '''
+    paths=[f[0] for f in files]
+    if output.endswith('.h5'):
+        from merge_h5 import merge
+        counts=[]
+        merge(paths,output+'.partial',counts)
+    else:
+        subprocess.run(['hadd','-f',output+'.partial']+paths,check=True,stdout=subprocess.DEVNULL)
+        counts=[_root_entries(p) for p in paths]
+    os.replace(output+'.partial',output)
+    return counts
+
+
+def run(production_dir,shard_dir,target_gb,suffixes,remove_inputs=False):
+    os.makedirs(shard_dir,exist_ok=True)
+    rows=[]
+    for suffix in suffixes:
+        files=collect(production_dir,suffix)
+        groups=plan(files,float(target_gb)*1024**3)
+        print(f'Merging {len(files)} *{suffix} file(s) into {len(groups)} shard(s)')
+        global_event=0
+        for i,group in enumerate(groups):
+            output=os.path.join(shard_dir,'shard_%04d%s' % (i,suffix))
+            counts=merge_shard(group,output)
+            shard_event=0
+            for (path,job,task,size),count in zip(group,counts):
+                rows.append(dict(shard=os.path.basename(output),shard_first_event=shard_event,
+                    global_first_event=global_event if count is not None else None,
+                    num_events=count,source=os.path.relpath(path,production_dir),job=job,task=task))
+                if count is None:
+                    global_event=None
+                else:
+                    shard_event+=count
+                    if global_event is not None:
+                        global_event+=count
+            print(f'    {os.path.basename(output)}: {len(group)} file(s), {os.path.getsize(output)/1024**3:.2f} GB')
+            if remove_inputs:
+                for f in group:
+                    os.remove(f[0])
+
+    with open(os.path.join(shard_dir,INDEX_NAME),'w',newline='') as f:
+        w=csv.DictWriter(f,fieldnames=['shard','shard_first_event','global_first_event','num_events','source','job','task'])
+        w.writeheader()
+        w.writerows(rows)
+    print(f'Wrote {os.path.join(shard_dir,INDEX_NAME)}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5:
+        print(f'Invalid arguments {sys.argv[1:]}')
+        print(f'Usage: {os.path.basename(__file__)} $PRODUCTION_DIR $SHARD_DIR $TARGET_GB $SUFFIX [$SUFFIX ...] [--remove-inputs]')
+        sys.exit(1)
+
+    args=[a for a in sys.argv[1:] if not a == '--remove-inputs']
+    run(args[0],args[1],args[2],args[3:],'--remove-inputs' in sys.argv)
+    sys.exit(0)
@@ -0,0 +1,160 @@
+import os, sys, json, time, socket, shutil, subprocess, threading
+
+# Run a job stage and append its resource usage as one JSON line to a metrics file:
+# wall/CPU time, peak RSS, bytes read/written by the process tree, and GPU
+# utilization/memory sampled while the stage runs. Only the standard library is
+# used so that it runs both on the host and in the singularity session.
+
+SAMPLE_PERIOD=float(os.environ.get('DNTP_METRICS_PERIOD',5))
+
+
+def _children(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children','r') as f:
+            return [int(c) for c in f.read().split()]
+    except (OSError, ValueError):
+        return []
+
+
+def _tree(pid):
+    res,todo=[],[pid]
+    while todo:
+        p=todo.pop()
+        res.append(p)
+        todo.extend(_children(p))
+    return res
+
+
+def _io(pid):
+    res=dict()
+    try:
+        with open(f'/proc/{pid}/io','r') as f:
+            for line in f:
+                key,val=line.split(':')
+                res[key]=int(val)
+    except (OSError, ValueError):
+        pass
+    return res.get('rchar',0),res.get('wchar',0)
+
+
+def _gpu():
+    try:
+        out=subprocess.run(['nvidia-smi','--query-gpu=utilization.gpu,memory.used','--format=csv,noheader,nounits'],
+            capture_output=True,text=True,timeout=10).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    util,mem=[],[]
+    for line in out.strip().splitlines():
+        try:
+            u,m=line.split(',')
+            util.append(float(u))
+            mem.append(float(m))
+        except ValueError:
+            continue
+    if not util:
+        return None
+    return sum(util)/len(util),sum(mem)
+
+
+class sampler(threading.Thread):
+
+    def __init__(self,pid,period):
+        super().__init__(daemon=True)
+        self.pid=pid
+        self.period=period
+        self.io=dict()
+        self.gpu_util=[]
+        self.gpu_mem=[]
+        self.has_gpu=shutil.which('nvidia-smi') is not None
+        self.done=threading.Event()
+
+    def sample(self):
+        # keep the last rchar/wchar of every process seen in the tree
+        for p in _tree(self.pid):
+            self.io[p]=_io(p)
+        if self.has_gpu:
+            gpu=_gpu()
+            if gpu is not None:
+                self.gpu_util.append(gpu[0])
+                self.gpu_mem.append(gpu[1])
+
+    def run(self):
+        while True:
+            self.sample()
+            if self.done.wait(self.period):
+                break
+
+
+def run(stage,metrics_file,cmd):
+    '''
+    Run cmd, append the metrics of stage to metrics_file, and return the exit code of cmd.
+    stage may be "name:batch" to record a sub-batch of a stage.
+    '''
+    name,_,batch=stage.partition(':')
+    start=time.time()
+    proc=subprocess.Popen(cmd)
+    mon=sampler(proc.pid,SAMPLE_PERIOD)
+    mon.start()
+    # wait for the exit without reaping: the process stays readable in /proc and its I/O
+    # counters then include the descendants it reaped, so the last interval is not lost
+    os.waitid(os.P_PID,proc.pid,os.WEXITED|os.WNOWAIT)
+    end=time.time()
+    mon.done.set()
+    mon.join()
+    io=_io(proc.pid)
+    if io == (0,0):
+        # not readable, keep the sum of the last samples of the process tree
+        io=(sum([v[0] for v in mon.io.values()]),sum([v[1] for v in mon.io.values()]))
+    _,status,usage=os.wait4(proc.pid,0)
+    if os.WIFEXITED(status):
+        proc.returncode=os.WEXITSTATUS(status)
+    else:
+        proc.returncode=-os.WTERMSIG(status)
+
+    record=dict(stage=name,
+        batch=int(batch) if batch else None,
+        task=os.environ.get('SLURM_ARRAY_TASK_ID'),
+        job=os.environ.get('SLURM_ARRAY_JOB_ID'),
+        chain=os.environ.get('DNTP_CHAIN'),
+        host=socket.gethostname(),
+        start=round(start,3),
+        end=round(end,3),
+        wall_s=round(end-start,3),
+        user_s=round(usage.ru_utime,3),
+        sys_s=round(usage.ru_stime,3),
+        cpu_s=round(usage.ru_utime+usage.ru_stime,3),
+        max_rss_mb=round(usage.ru_maxrss/1024.,1),
+        read_bytes=io[0],
+        write_bytes=io[1],
+        disk_read_bytes=usage.ru_inblock*512,
+        disk_write_bytes=usage.ru_oublock*512,
+        gpu_util_mean=round(sum(mon.gpu_util)/len(mon.gpu_util),1) if mon.gpu_util else None,
+        gpu_util_max=max(mon.gpu_util) if mon.gpu_util else None,
+        gpu_mem_max_mb=max(mon.gpu_mem) if mon.gpu_mem else None,
+        exit_code=proc.returncode,
+        )
+    with open(metrics_file,'a') as f:
+        f.write(json.dumps(record)+'\n')
+    return proc.returncode
+
+
+def gen_record_function():
+    '''
+    Shell function metrics_record (STAGE START END BYTES EXIT_CODE FILE) appending a
+    record for a stage timed in the job script itself (e.g. staging in/out).
+    '''
+    return '''metrics_record() {
+    awk -v stage=$1 -v start=$2 -v end=$3 -v nbytes=$4 -v code=$5 \\
+        -v task=$SLURM_ARRAY_TASK_ID -v job=$SLURM_ARRAY_JOB_ID -v host=$(hostname) \\
+        'BEGIN {printf "{\\"stage\\": \\"%s\\", \\"batch\\": null, \\"task\\": \\"%s\\", \\"job\\": \\"%s\\", \\"host\\": \\"%s\\", \\"start\\": %.3f, \\"end\\": %.3f, \\"wall_s\\": %.3f, \\"write_bytes\\": %d, \\"exit_code\\": %d}\\n", stage, task, job, host, start, end, end-start, nbytes, code}' >> $6
+}
+'''
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5 or not sys.argv[3] == '--':
+        print(f'Invalid arguments {sys.argv[1:]}')
+        print(f'Usage: {os.path.basename(__file__)} $STAGE[:$BATCH] $METRICS_FILE -- $COMMAND [$ARGS ...]')
+        sys.exit(1)
+
+    sys.exit(run(sys.argv[1],sys.argv[2],sys.argv[4:]))
@@ -0,0 +1,176 @@
+import os, glob, hashlib
+
+# Shell snippets to stage the job source in and the job outputs out of the
+# node-local work directory, and a checker for the checksum manifest written
+# next to the outputs.
+
+BACKENDS=['cp','rsync','parallel']
+# one manifest per array job (chained stages may stage out into the same directory)
+MANIFEST_NAME='stage_manifest_${SLURM_ARRAY_JOB_ID}.txt'
+MANIFEST_GLOB='stage_manifest_*.txt'
+
+
+def parse_config(cfg,res):
+    '''
+    Validate the staging options of cfg and fill the defaults in res.
+    '''
+    res['STAGE_BACKEND']=cfg.get('STAGE_BACKEND','cp')
+    if not res['STAGE_BACKEND'] in BACKENDS:
+        raise ValueError(f'STAGE_BACKEND must be one of {BACKENDS} (given: {res["STAGE_BACKEND"]})')
+    res['STAGE_STREAMS']=int(cfg.get('STAGE_STREAMS',4))
+    if res['STAGE_STREAMS'] < 1:
+        raise ValueError('STAGE_STREAMS must be positive.')
+    # parallel: files of at least STAGE_SPLIT_MB are copied in STAGE_STREAMS byte ranges at once
+    res['STAGE_SPLIT_MB']=int(cfg.get('STAGE_SPLIT_MB',256))
+    if res['STAGE_SPLIT_MB'] < 1:
+        raise ValueError('STAGE_SPLIT_MB must be positive.')
+    for key,default in [('STAGE_INCLUDE',['*']),('STAGE_EXCLUDE',[])]:
+        val=cfg.get(key,default)
+        if val is None:
+            val=[]
+        if isinstance(val,str):
+            val=[val]
+        res[key]=list(val)
+    res['STAGE_CHECKSUM']=bool(cfg.get('STAGE_CHECKSUM',True))
+
+
+def _find_expr(patterns):
+    return ' -o '.join([f"-name '{p}'" for p in patterns])
+
+
+def gen_stage_in(cfg,src,dst,shared=None):
+    '''
+    Copy the directory src into dst (dst must not exist).
+    Files in the shared directory, if given, are symlinked into dst instead.
+    '''
+    if cfg['STAGE_BACKEND'] == 'rsync':
+        script = f'rsync -a {src}/ {dst}/'
+    else:
+        script = f'cp -r {src} {dst}'
+    if shared:
+        script += f'\nln -s {shared}/* {dst}/'
+    return script
+
+
+def gen_split_copy(streams):
+    '''
+    Shell function stage_split_copy (FILE DST) copying FILE into DST/FILE with streams
+    dd processes, each writing its range of 1 MiB blocks in place.
+    '''
+    return f'''stage_split_copy() {{
+    local size=$(stat -c %s "$1") status=0 pids=() i
+    local n=$(( ((size+1048575)/1048576+{streams}-1)/{streams} ))
+    mkdir -p "$2/$(dirname "$1")" && truncate -s $size "$2/$1" || return 1
+    for ((i=0; i<{streams}; i++)); do
+        dd if="$1" of="$2/$1" bs=1M skip=$((i*n)) seek=$((i*n)) count=$n conv=notrunc status=none &
+        pids+=($!)
+    done
+    for i in ${{pids[@]}}; do
+        wait $i || status=1
+    done
+    chmod --reference="$1" "$2/$1" && touch -r "$1" "$2/$1" || status=1
+    return $status
+}}
+'''
+
+
+def gen_stage_out(cfg,src,dst):
+    '''
+    Copy artifacts of the directory src (matching STAGE_INCLUDE and not STAGE_EXCLUDE)
+    into dst, with a manifest of sha256, size and path of each file.
+    Sets STAGE_BYTES to the total size of the selected files, and STATUS=1 if the copy fails.
+    '''
+    select = f"find . -type f \\( {_find_expr(cfg['STAGE_INCLUDE'])} \\)"
+    if cfg['STAGE_EXCLUDE']:
+        select += f" ! \\( {_find_expr(cfg['STAGE_EXCLUDE'])} \\)"
+    select += f" ! -name '{MANIFEST_GLOB}' -printf '%P\\n'"
+
+    script = f'''cd {src}
+STAGE_LIST=$(mktemp)
+{select} > $STAGE_LIST
+STAGE_BYTES=$(xargs -a $STAGE_LIST -d '\\n' -r stat -c %s | awk '{{s+=$1}} END {{print s+0}}')
+echo "Staging out $(wc -l < $STAGE_LIST) file(s) ($STAGE_BYTES bytes) with {cfg['STAGE_BACKEND']}"
+'''
+    if cfg['STAGE_CHECKSUM']:
+        script += f'''while IFS= read -r f; do
+    echo "$(sha256sum "$f" | cut -d' ' -f1) $(stat -c %s "$f") $f"
+done < $STAGE_LIST > {MANIFEST_NAME}
+echo {MANIFEST_NAME} >> $STAGE_LIST
+'''
+    script += f'mkdir -p {dst}\n'
+    if cfg['STAGE_BACKEND'] == 'rsync':
+        script += f'rsync -a --files-from=$STAGE_LIST . {dst}/ || STATUS=1\n'
+    elif cfg['STAGE_BACKEND'] == 'parallel':
+        # large files one at a time in STAGE_STREAMS ranges, the others STAGE_STREAMS files at a time
+        script += gen_split_copy(cfg['STAGE_STREAMS'])
+        script += f'''STAGE_SMALL=$(mktemp)
+while IFS= read -r f; do
+    if [ $(stat -c %s "$f") -ge {cfg['STAGE_SPLIT_MB']*1024*1024} ]; then
+        stage_split_copy "$f" {dst} || STATUS=1
+    else
+        echo "$f"
+    fi
+done < $STAGE_LIST > $STAGE_SMALL
+xargs -a $STAGE_SMALL -d '\\n' -P {cfg["STAGE_STREAMS"]} -n 1 cp -p --parents -t {dst} || STATUS=1
+rm $STAGE_SMALL
+'''
+    else:
+        script += f'xargs -a $STAGE_LIST -d \'\\n\' cp -p --parents -t {dst} || STATUS=1\n'
+    script += 'rm $STAGE_LIST\ncd ..\n'
+    return script
+
+
+def verify(job_dir,full=False):
+    '''
+    Check the files listed in the manifests of job_dir exist with the recorded size
+    (and sha256 if full). Returns a list of problems.
+    '''
+    manifests=sorted(glob.glob(os.path.join(job_dir,MANIFEST_GLOB)),key=os.path.getmtime)
+    if not manifests:
+        return [f'no {MANIFEST_GLOB} found in {job_dir}']
+    # later stages overwrite files of earlier ones
+    entries=dict()
+    for manifest in manifests:
+        with open(manifest,'r') as f:
+            for line in f:
+                words=line.rstrip('\n').split(' ',2)
+                if len(words) < 3:
+                    continue
+                entries[words[2]]=(words[0],int(words[1]))
+
+    problems=[]
+    for name,(digest,size) in entries.items():
+        path=os.path.join(job_dir,name)
+        if not os.path.isfile(path):
+            problems.append(f'{path} missing')
+        elif not os.path.getsize(path) == size:
+            problems.append(f'{path} size {os.path.getsize(path)} != {size}')
+        elif full:
+            h=hashlib.sha256()
+            with open(path,'rb') as fin:
+                for chunk in iter(lambda: fin.read(64*1024*1024),b''):
+                    h.update(chunk)
+            if not h.hexdigest() == digest:
+                problems.append(f'{path} checksum mismatch')
+    return problems
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 3 or not sys.argv[1] == 'verify':
+        print(f'Invalid arguments {sys.argv[1:]}')
+        print(f'Usage: {os.path.basename(__file__)} verify $PRODUCTION_DIR [--full]')
+        sys.exit(1)
+
+    full = '--full' in sys.argv[3:]
+    job_dirs = sorted(glob.glob(os.path.join(sys.argv[2],'job_[0-9]*_[0-9]*')))
+    num_bad = 0
+    for job_dir in job_dirs:
+        problems = verify(job_dir,full)
+        if problems:
+            num_bad += 1
+            print(f'{job_dir}:')
+            for p in problems:
+                print(f'    {p}')
+    print(f'Verified {len(job_dirs)} job dir(s), {num_bad} with problems')
+    sys.exit(1 if num_bad else 0)
@@ -0,0 +1,98 @@
+import os, random
+import yaml
+import campaign
+
+
+class fake_slurm():
+    '''
+    Arrays whose tasks start within their throttle and finish after a random number of ticks.
+    '''
+
+    def __init__(self,seed=1):
+        self.rng=random.Random(seed)
+        self.jobs=dict()
+        self.merges=[]
+
+    def submit(self,script,indices,exclude=[],throttle=0):
+        job_id=str(len(self.jobs)+1)
+        self.jobs[job_id]=dict(throttle=throttle,tasks={i:'PENDING' for i in indices})
+        return job_id
+
+    def submit_after(self,script,job_id):
+        self.merges.append((script,job_id))
+        return 'merge'
+
+    def set_throttle(self,job_id,throttle):
+        assert throttle > 0
+        self.jobs[job_id]['throttle']=throttle
+
+    def states(self,job_id):
+        return {i:(s,'node') for i,s in self.jobs[job_id]['tasks'].items()}
+
+    def running(self):
+        return sum([list(job['tasks'].values()).count('RUNNING') for job in self.jobs.values()])
+
+    def tick(self):
+        for job in self.jobs.values():
+            tasks=job['tasks']
+            for i,s in tasks.items():
+                if s == 'RUNNING' and self.rng.random() < 0.3:
+                    tasks[i]='COMPLETED'
+            for i,s in tasks.items():
+                if s == 'PENDING' and list(tasks.values()).count('RUNNING') < job['throttle']:
+                    tasks[i]='RUNNING'
+
+
+def make_campaign(tmp_path,tasks,throttle,merge=False):
+    record=[]
+    for i,n in enumerate(tasks):
+        jsdir=tmp_path/f'production_c-{i:03d}'/'job_source'
+        jsdir.mkdir(parents=True)
+        (jsdir/'source.yaml').write_text(yaml.dump(dict(SLURM_NUM_JOBS=n)))
+        (jsdir/'submit.sh').write_text('#!/bin/bash\n')
+        if merge:
+            (jsdir/'submit_merge.sh').write_text('#!/bin/bash\n')
+        record.append(dict(production=f'c-{i:03d}',storage_dir=str(jsdir.parent),overrides=dict()))
+    cdir=tmp_path/'campaign_c'
+    cdir.mkdir()
+    (cdir/campaign.CAMPAIGN_RECORD).write_text(yaml.dump(dict(campaign='c',project='larndsim',throttle=throttle,productions=record)))
+    return cdir
+
+
+def run(throttler,backend):
+    peak=0
+    for _ in range(1000):
+        if throttler.poll() < 1:
+            return peak
+        backend.tick()
+        peak=max(peak,backend.running())
+    raise AssertionError('the campaign did not finish')
+
+
+def test_shared_throttle(tmp_path):
+    backend=fake_slurm()
+    throttler=campaign.campaign_throttle(make_campaign(tmp_path,[20,3,8,1],5,merge=True),backend)
+    peak=run(throttler,backend)
+    assert peak == 5
+    assert all([s == 'COMPLETED' for job in backend.jobs.values() for s in job['tasks'].values()])
+    assert len(backend.jobs) == 4 and len(backend.merges) == 4
+
+
+def test_throttle_below_productions(tmp_path):
+    # fewer slots than productions: the others are submitted as slots are freed
+    backend=fake_slurm()
+    throttler=campaign.campaign_throttle(make_campaign(tmp_path,[4,4,4],2),backend)
+    throttler.poll()
+    assert len(backend.jobs) == 2
+    assert run(throttler,backend) <= 2
+    assert len(backend.jobs) == 3
+
+
+def test_state_is_resumed(tmp_path):
+    cdir=make_campaign(tmp_path,[4,4],2)
+    backend=fake_slurm()
+    campaign.campaign_throttle(cdir,backend).poll()
+    throttler=campaign.campaign_throttle(cdir,backend)
+    assert [p['job'] for p in throttler.state['productions'].values()] == ['1','2']
+    run(throttler,backend)
+    assert len(backend.jobs) == 2
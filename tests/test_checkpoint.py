@@ -0,0 +1,56 @@
+import os, subprocess
+import pytest
+import checkpoint
+
+
+def run(tmp_path,commands):
+    '''
+    Run commands with the checkpoint functions of a CHECKPOINT job in tmp_path.
+    '''
+    cfg=dict(CHECKPOINT=True)
+    script=checkpoint.gen_functions(cfg)+checkpoint.gen_task_functions()+commands
+    env=dict(os.environ,CKPT_DIR=str(tmp_path/'ckpt'))
+    (tmp_path/'ckpt').mkdir(exist_ok=True)
+    return subprocess.run(['bash','-c',script],cwd=tmp_path,env=env,capture_output=True,text=True).returncode
+
+
+def test_restore(tmp_path):
+    (tmp_path/'out.h5').write_bytes(b'stage output')
+    assert run(tmp_path,'ckpt_commit larndsim out.h5') == 0
+    (tmp_path/'out.h5').unlink()
+    assert run(tmp_path,'ckpt_restore larndsim out.h5') == 0
+    assert (tmp_path/'out.h5').read_bytes() == b'stage output'
+
+    # a corrupted entry is discarded and not restored
+    (tmp_path/'ckpt'/'larndsim').write_bytes(b'stage outpuX')
+    assert not run(tmp_path,'ckpt_restore larndsim other.h5') == 0
+    assert not (tmp_path/'other.h5').exists()
+    assert not (tmp_path/'ckpt'/'larndsim').exists()
+
+
+def test_restore_missing(tmp_path):
+    assert not run(tmp_path,'ckpt_restore larndsim out.h5') == 0
+    # an entry without its .sha256 (interrupted commit) is not restored
+    (tmp_path/'ckpt'/'larndsim').write_bytes(b'partial')
+    assert not run(tmp_path,'ckpt_restore larndsim out.h5') == 0
+
+
+def test_complete(tmp_path):
+    job=tmp_path/'job_1_0001'
+    job.mkdir()
+    (job/'out.h5').write_bytes(b'12345')
+    (job/'stage_manifest_1.txt').write_text('0 5 out.h5\n')
+    assert not run(tmp_path,'ckpt_complete run.sh') == 0
+    assert run(tmp_path,f'ckpt_finish run.sh {job}') == 0
+    assert run(tmp_path,'ckpt_complete run.sh') == 0
+
+    # a truncated output invalidates the task
+    (job/'out.h5').write_bytes(b'123')
+    assert not run(tmp_path,'ckpt_complete run.sh') == 0
+
+
+def test_requires_checksum():
+    res=dict(STORAGE_DIR='/storage',STAGE_CHECKSUM=False)
+    with pytest.raises(ValueError):
+        checkpoint.parse_config(dict(CHECKPOINT=True),res)
+    checkpoint.parse_config(dict(CHECKPOINT=False),res)
@@ -0,0 +1,89 @@
+import os, sys, subprocess
+import pytest
+import image_store
+
+
+@pytest.fixture
+def storage(tmp_path):
+    (tmp_path/'storage').mkdir()
+    (tmp_path/'image.sif').write_bytes(os.urandom(1000))
+    return tmp_path/'storage'
+
+
+def test_store_image(storage,monkeypatch):
+    monkeypatch.setattr(image_store,'CHUNK_SIZE',64)
+    src=str(storage.parent/'image.sif')
+    stored=image_store.store_image(src,storage)
+    assert os.path.basename(stored) == image_store.file_hash(src)+'.sif'
+    assert open(stored,'rb').read() == open(src,'rb').read()
+    assert image_store.store_image(src,storage) == stored
+    assert not os.path.exists(stored+'.partial')
+
+
+def test_copy_resumes(storage):
+    src=str(storage.parent/'image.sif')
+    dst=str(storage/'copy.sif')
+    data=open(src,'rb').read()
+    with open(dst+'.partial','wb') as f:
+        f.write(data[:300])
+    image_store.copy_chunked(src,dst,image_store.file_hash(src))
+    assert open(dst,'rb').read() == data
+
+
+def test_corrupted_copy(storage):
+    src=str(storage.parent/'image.sif')
+    dst=str(storage/'copy.sif')
+    with open(dst+'.partial','wb') as f:
+        f.write(b'X'*300)
+    with pytest.raises(OSError):
+        image_store.copy_chunked(src,dst,image_store.file_hash(src))
+    assert not os.path.exists(dst) and not os.path.exists(dst+'.partial')
+
+
+def test_cleanup(storage):
+    sdir=image_store.store_dir(storage)
+    images=[]
+    for i in range(3):
+        src=storage.parent/f'image_{i}.sif'
+        src.write_bytes(os.urandom(100))
+        images.append(image_store.store_image(str(src),storage))
+    # referenced by a hard link and by a symbolic link, the last one by nothing
+    (storage/'production_1').mkdir()
+    os.link(images[0],storage/'production_1'/'image_0.sif')
+    (storage/'production_2').mkdir()
+    os.symlink(images[1],storage/'production_2'/'image_1.sif')
+    (storage/'production_2'/'config.yaml').write_text('')
+
+    # an interrupted copy, and a copy in progress (locked by another process)
+    with open(os.path.join(sdir,'stale.sif.partial'),'wb') as f:
+        f.write(b'\0')
+    busy=os.path.join(sdir,'busy.sif.partial')
+    open(busy,'wb').close()
+    lock=subprocess.Popen([sys.executable,'-c',f'import fcntl,sys; f=open({busy!r},"ab"); fcntl.lockf(f,fcntl.LOCK_EX); print(1,flush=True); sys.stdin.read()'],
+        stdin=subprocess.PIPE,stdout=subprocess.PIPE,text=True)
+    try:
+        lock.stdout.readline()
+        assert sorted(image_store.cleanup(storage,dry_run=True)) == sorted([images[2],os.path.join(sdir,'stale.sif.partial')])
+        assert os.path.exists(images[2])
+        image_store.cleanup(storage)
+    finally:
+        lock.communicate('')
+    assert [os.path.exists(p) for p in images] == [True,True,False]
+    assert not os.path.exists(os.path.join(sdir,'stale.sif.partial'))
+    assert os.path.exists(busy)
+    assert os.path.exists(os.path.join(sdir,image_store.HASH_CACHE))
+
+
+def test_cleanup_assets(storage):
+    adir=storage/'campaign_1'/'assets'
+    stored=[]
+    for i in range(3):
+        src=storage.parent/f'asset_{i}.npz'
+        src.write_bytes(os.urandom(100))
+        stored.append(image_store.store_file(str(src),str(adir)))
+    (storage/'production_1'/'job_shared').mkdir(parents=True)
+    image_store.link_image(stored[0],storage/'production_1'/'job_shared'/'asset_0.npz')
+    os.symlink(stored[1],storage/'production_1'/'job_shared'/'asset_1.npz')
+    (adir/'asset.npz.partial').write_bytes(b'\0')
+    assert sorted(image_store.cleanup(storage)) == sorted([stored[2],str(adir/'asset.npz.partial')])
+    assert [os.path.exists(p) for p in stored] == [True,True,False]
@@ -0,0 +1,153 @@
+import os, json, struct, importlib, subprocess
+import pytest
+
+
+@pytest.fixture
+def project(tmp_path,monkeypatch):
+    '''
+    The project_larnd2supera module, imported with a stand-in larnd2supera package.
+    '''
+    pkg=tmp_path/'site'/'larnd2supera'
+    pkg.mkdir(parents=True)
+    (pkg/'__init__.py').write_text('class config:\n    @staticmethod\n    def list_config(): return ["tutorial"]\n')
+    monkeypatch.syspath_prepend(str(tmp_path/'site'))
+    return importlib.import_module('project_larnd2supera')
+
+
+@pytest.fixture
+def make_production(tmp_path,project):
+    '''
+    Generate larnd2supera productions of 3 inputs in 2 jobs.
+    '''
+    inputs=tmp_path/'inputs'
+    inputs.mkdir()
+    # HDF5 signature followed by padding
+    for i,size in enumerate([300,200,100]):
+        (inputs/f'file_{i}-larndsim.h5').write_bytes(b'\x89HDF\r\n\x1a\n'+b'\0'*size)
+    (tmp_path/'image.sif').write_bytes(b'\0')
+    (tmp_path/'storage').mkdir()
+
+    def make(extra=''):
+        cfg=f'''
+STORAGE_DIR: {tmp_path}/storage
+SINGULARITY_IMAGE: {tmp_path}/image.sif
+STORE_IMAGE: False
+SLURM_WORK_DIR: {tmp_path}/work
+SLURM_NUM_JOBS: 2
+TARGET_JOB_COUNT: 2
+SLURM_PARTITION: ampere
+SLURM_TIME: 1:00:00
+SLURM_MEM: 8
+SLURM_CPU: 2
+SLURM_NODELIST: ''
+SLURM_EXCLUDE: ''
+SUPERA_CONFIG: tutorial
+GLOB: "{inputs}/*-larndsim.h5"
+'''+extra
+        before=set((tmp_path/'storage').iterdir())
+        project.project_larnd2supera().generate(cfg)
+        sdir,=[p for p in (tmp_path/'storage').iterdir() if not p in before and p.name.startswith('production_')]
+        return sdir/'job_source'
+    return make
+
+
+@pytest.fixture
+def production(make_production):
+    return make_production()
+
+
+def complete(production,task):
+    '''
+    Write the complete outputs and inputs.txt of a task as its job would.
+    '''
+    jdir=production.parent/f'job_1_{task:04d}'
+    jdir.mkdir()
+    with open(production/'flist_meta.jsonl') as f:
+        inputs=[r['input'] for r in map(json.loads,f) if r['task'] == task]
+    with open(jdir/'inputs.txt','w') as f:
+        for i,name in enumerate(inputs):
+            output=f'output_1_{task}-{i:03d}-larcv.root'
+            (jdir/output).write_bytes(b'root'+struct.pack('>iii',62000,100,100)+b'\0'*84)
+            f.write(f'{output} {name}\n')
+
+
+def test_gen_project_script_is_a_method(project):
+    assert not project.project_larnd2supera.gen_project_script is project.project_base.gen_project_script
+
+
+def test_run_script(production):
+    script=(production/'run.sh').read_text()
+    assert script.startswith('#!/bin/bash')
+    assert 'inputs.txt' in script
+    assert 'run_larnd2supera.py' in script
+
+
+def test_input_lookup(production):
+    # run the seek-based lookup of run.sh for each task and compare with the packed groups
+    script=(production/'run.sh').read_text()
+    assert 'dd if=flist.idx' in script and not 'input_name.py' in script
+    lookup=script[script.index('# look up'):script.index('mapfile')]
+    names=(production/'flist.txt').read_text().splitlines()
+    found=[]
+    for task in [1,2]:
+        subprocess.run(['bash','-c',lookup],cwd=production,env=dict(os.environ,SLURM_ARRAY_TASK_ID=str(task)),check=True)
+        found.append((production/'task_inputs.txt').read_text().splitlines())
+    assert sorted(sum(found,[])) == sorted(names)
+    assert len(found[0]) == 1 and len(found[1]) == 2
+
+
+def test_metered_stages(production):
+    script=(production/'run.sh').read_text()
+    for stage in ['input_copy:$INDEX','supera:$INDEX']:
+        assert f'python3 stage_metrics.py {stage} metrics_${{SLURM_ARRAY_JOB_ID}}.jsonl -- ' in script
+    assert (production/'stage_metrics.py').is_file()
+
+
+def test_resume(project,production):
+    complete(production,1)
+    assert project.gen_resume_script(production.parent) == [2]
+    script=(production/'submit_resume.sh').read_text()
+    assert '#SBATCH --array=2\n' in script
+
+
+def test_resume_worker_mode(project,make_production):
+    production=make_production('WORKER_MODE: True\nWORKER_COUNT: 1\n')
+    with pytest.raises(ValueError):
+        project.gen_resume_script(production.parent)
+
+
+def test_resume_with_merge(project,make_production):
+    production=make_production('MERGE_SHARD_GB: 1\n')
+    complete(production,2)
+    assert project.gen_resume_script(production.parent) == [1]
+    script=(production/'submit_resume.sh').read_text()
+    assert '#SBATCH --array=1\n' in script
+    assert not 'submit_merge.sh' in script
+
+
+def test_resume_pool(project,make_production):
+    production=make_production('SCHEDULER: pool\n')
+    with pytest.raises(ValueError):
+        project.gen_resume_script(production.parent)
+
+
+def test_missing_package_cleans_up(tmp_path,monkeypatch,project):
+    monkeypatch.setattr(project.importlib.util,'find_spec',lambda name: None)
+    (tmp_path/'storage').mkdir()
+    (tmp_path/'image.sif').write_bytes(b'\0')
+    cfg=f'''
+STORAGE_DIR: {tmp_path}/storage
+SINGULARITY_IMAGE: {tmp_path}/image.sif
+STORE_IMAGE: False
+SLURM_WORK_DIR: {tmp_path}/work
+SLURM_NUM_JOBS: 1
+SLURM_PARTITION: ampere
+SLURM_TIME: 1:00:00
+SLURM_MEM: 8
+SLURM_CPU: 2
+SUPERA_CONFIG: tutorial
+GLOB: "{tmp_path}/*.h5"
+'''
+    with pytest.raises(FileNotFoundError):
+        project.project_larnd2supera().generate(cfg)
+    assert not [p for p in (tmp_path/'storage').iterdir() if p.name.startswith('production_')]
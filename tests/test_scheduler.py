@@ -0,0 +1,69 @@
+import os, sys
+import pytest
+import scheduler
+
+
+def test_array_spec():
+    assert scheduler.array_spec([7,1,2,3,5]) == '1-3,5,7'
+    assert scheduler._expand('1-3,5,7%4') == [1,2,3,5,7]
+
+
+def pool(tmp_path,**kwargs):
+    args=dict(cpus_per_task=1,mem_gb=1,time_limit=60,log_dir=str(tmp_path/'log'),poll=0.1)
+    args.update(kwargs)
+    return scheduler.pool_backend(**args)
+
+
+def write_script(tmp_path,body):
+    script=tmp_path/'submit.sh'
+    script.write_text('#!/bin/bash\n'+body)
+    return str(script)
+
+
+@pytest.mark.skipif(len(os.sched_getaffinity(0)) < 2,reason='needs 2 CPUs')
+def test_affinity(tmp_path):
+    backend=pool(tmp_path,max_workers=2)
+    script=write_script(tmp_path,f'grep Cpus_allowed_list /proc/self/status > {tmp_path}/cpus_$SLURM_ARRAY_TASK_ID\nsleep 1\n')
+    tasks=backend.wait(backend.submit(script,[1,2]))
+    assert [t['state'] for t in tasks.values()] == ['COMPLETED']*2
+    cpus=[(tmp_path/f'cpus_{i}').read_text().split()[1] for i in [1,2]]
+    # each task runs alone on its own CPU
+    assert not cpus[0] == cpus[1] and all([c.isdigit() for c in cpus])
+
+
+def test_throttle(tmp_path):
+    backend=pool(tmp_path)
+    # tasks record the number of tasks running alongside them
+    script=write_script(tmp_path,f'''touch {tmp_path}/running_$SLURM_ARRAY_TASK_ID
+ls {tmp_path} | grep -c running_ >> {tmp_path}/counts
+sleep 0.5
+rm {tmp_path}/running_$SLURM_ARRAY_TASK_ID
+''')
+    tasks=backend.wait(backend.submit(script,[1,2,3],throttle=1))
+    assert [t['state'] for t in tasks.values()] == ['COMPLETED']*3
+    assert (tmp_path/'counts').read_text().split() == ['1']*3
+
+
+def test_time_limit(tmp_path):
+    backend=pool(tmp_path,time_limit=2,term_grace=1)
+    # the batch script gets SIGTERM term_grace seconds before the time limit
+    script=write_script(tmp_path,f'''trap "touch {tmp_path}/flushed_$SLURM_ARRAY_TASK_ID" TERM
+[ $SLURM_ARRAY_TASK_ID -eq 2 ] && exit 3
+sleep 30 &
+wait $!
+sleep 30
+''')
+    job_id=backend.submit(script,[1,2])
+    tasks=backend.wait(job_id)
+    assert tasks[1]['state'] == 'TIMEOUT'
+    assert tasks[2]['state'] == 'FAILED' and tasks[2]['exit_code'] == 3
+    assert (tmp_path/'flushed_1').exists()
+    assert 'DUE TO TIME LIMIT' in (tmp_path/'log'/f'slurm-{job_id}-1.out').read_text()
+
+
+def test_out_of_memory(tmp_path):
+    backend=pool(tmp_path,mem_gb=0.05)
+    script=write_script(tmp_path,f'{sys.executable} -c "import time; x=bytearray(200*1024**2); time.sleep(30)"\n')
+    job_id=backend.submit(script,[1])
+    assert backend.wait(job_id)[1]['state'] == 'OUT_OF_MEMORY'
+    assert 'oom-kill' in (tmp_path/'log'/f'slurm-{job_id}-1.out').read_text()
@@ -0,0 +1,67 @@
+import os, json
+import seeds
+
+
+def test_derive_unique():
+    keys=[(task,chain,batch,stream) for task in range(1,201) for chain in range(4) for batch in range(4) for stream in ['edep','bomb']]
+    values=[seeds.derive(12345,*k) for k in keys]
+    assert len(set(values)) == len(values)
+    assert all([1 <= v < 2**31 for v in values])
+    # reproducible, and different for another master seed
+    assert seeds.derive(12345,1,0,0,'edep') == values[0]
+    assert not seeds.derive(54321,1,0,0,'edep') == values[0]
+
+
+def write_task(production,job,task,master=7):
+    jdir=production/f'job_{job}_{task:04d}'
+    jdir.mkdir(parents=True)
+    (production/'macro.mac').write_text('/random/setSeeds @EDEP_SEED@\n/generator/bomb @BOMB_CONFIG@\n')
+    (production/'bomb.yaml').write_text('SEED: 0\nNUM: 1\n')
+    cwd=os.getcwd()
+    os.chdir(jdir)
+    try:
+        seeds.write_macro(master,task,0,0,f'output_{job}_{task}',production/'macro.mac',production/'bomb.yaml')
+    finally:
+        os.chdir(cwd)
+    return jdir
+
+
+def test_write_macro(tmp_path):
+    jdir=write_task(tmp_path,1,3)
+    record=json.loads((jdir/seeds.SEED_RECORDS).read_text())
+    assert record['edep_seed'] == seeds.derive(7,3,0,0,'edep')
+    assert (jdir/'output_1_3.mac').read_text() == f'/random/setSeeds {record["edep_seed"]}\n/generator/bomb output_1_3-bomb.yaml\n'
+    assert (jdir/'output_1_3-bomb.yaml').read_text() == f'SEED: {record["bomb_seed"]}\nNUM: 1\n'
+
+
+def test_check(tmp_path):
+    for task in [1,2]:
+        write_task(tmp_path,1,task)
+    # a resubmission of task 2 reuses its seeds by design
+    write_task(tmp_path,2,2)
+    assert seeds.check(tmp_path) == []
+
+    # a record of task 5 with the seeds of task 1 (e.g. a task offset missing in the derivation)
+    record=json.loads((tmp_path/'job_1_0001'/seeds.SEED_RECORDS).read_text())
+    record.update(output='output_3_5',task=5)
+    (tmp_path/'job_3_0005').mkdir()
+    (tmp_path/'job_3_0005'/seeds.SEED_RECORDS).write_text(json.dumps(record)+'\n')
+    problems=seeds.check(tmp_path)
+    assert len(problems) == 2 and all(['output_1_1' in p and 'output_3_5' in p for p in problems])
+
+
+def test_check_events(tmp_path):
+    import numpy as np
+    import h5py
+    seg=np.zeros(4,dtype=[('eventID','i4'),('dE','f4')])
+    seg['eventID']=[0,0,1,1]
+    seg['dE']=[1,2,3,4]
+    for job,task,offset in [(1,1,0),(1,2,10),(2,2,0)]:
+        (tmp_path/f'job_{job}_{task:04d}').mkdir()
+        with h5py.File(tmp_path/f'job_{job}_{task:04d}'/f'output_{job}_{task}-edepsim.h5','w') as f:
+            data=seg.copy()
+            data['dE']+=offset
+            f.create_dataset('segments',data=data)
+    # the latest output of task 2 has the events of task 1
+    problems=seeds.check(tmp_path)
+    assert len(problems) == 2 and all(['output_1_1-edepsim.h5' in p and 'output_2_2-edepsim.h5' in p for p in problems])
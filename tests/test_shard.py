@@ -0,0 +1,57 @@
+import csv
+import numpy as np
+import h5py
+import merge_h5
+import shard
+
+
+def write_output(path,num_events,num_segments):
+    '''
+    A larnd-sim like output: events, segments per event, and tracks pointing to segments.
+    '''
+    mc_hdr=np.zeros(num_events,dtype=[('event_id','i4'),('x','f4')])
+    mc_hdr['event_id']=np.arange(num_events)
+    segments=np.zeros(num_segments,dtype=[('eventID','i4'),('dE','f4')])
+    segments['eventID']=np.arange(num_segments)%num_events
+    tracks=np.zeros((num_segments,2),dtype=[('track_ids','i8')])
+    tracks['track_ids'][:,0]=np.arange(num_segments)
+    tracks['track_ids'][:,1]=-1
+    with h5py.File(path,'w') as f:
+        f.attrs['version']='1'
+        f.create_dataset('mc_hdr',data=mc_hdr)
+        f.create_dataset('segments',data=segments)
+        f.create_dataset('tracks',data=tracks)
+
+
+def test_merge_remaps_events(tmp_path,monkeypatch):
+    # blocks of a few rows to exercise the block copy
+    monkeypatch.setattr(merge_h5,'BLOCK_BYTES',16)
+    write_output(tmp_path/'a.h5',3,7)
+    write_output(tmp_path/'b.h5',2,5)
+    counts=[]
+    assert merge_h5.merge([tmp_path/'a.h5',tmp_path/'b.h5'],tmp_path/'out.h5',counts) == 5
+    assert counts == [3,2]
+    with h5py.File(tmp_path/'out.h5','r') as f:
+        assert f.attrs['version'] == '1'
+        assert list(f['mc_hdr']['event_id']) == [0,1,2,3,4]
+        assert list(f['segments']['eventID']) == [0,1,2,0,1,2,0]+[3,4,3,4,3]
+        # row indices of the second input point past the segments of the first, -1 is kept
+        assert list(f['tracks']['track_ids'][:,0]) == list(range(12))
+        assert (f['tracks']['track_ids'][:,1] == -1).all()
+
+
+def test_shards(tmp_path):
+    for job,task,num_events in [(1,1,3),(1,2,2),(2,2,4),(1,3,1)]:
+        (tmp_path/f'job_{job}_{task:04d}').mkdir()
+        write_output(tmp_path/f'job_{job}_{task:04d}'/f'output_{job}_{task}-larndsim.h5',num_events,num_events)
+    # task 2 comes from its latest job
+    files=shard.collect(tmp_path,'-larndsim.h5')
+    assert [(job,task) for _,job,task,_ in files] == [(1,1),(2,2),(1,3)]
+
+    shard.run(tmp_path,tmp_path/'shards',1,['-larndsim.h5'])
+    with open(tmp_path/'shards'/shard.INDEX_NAME) as f:
+        rows=list(csv.DictReader(f))
+    assert [(r['task'],r['shard_first_event'],r['global_first_event'],r['num_events']) for r in rows] == \
+        [('1','0','0','3'),('2','3','3','4'),('3','7','7','1')]
+    with h5py.File(tmp_path/'shards'/'shard_0000-larndsim.h5','r') as f:
+        assert list(f['mc_hdr']['event_id']) == list(range(8))
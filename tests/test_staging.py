@@ -0,0 +1,29 @@
+import os, shutil, subprocess
+import pytest
+import staging
+
+
+@pytest.mark.parametrize('backend',staging.BACKENDS)
+def test_stage_out(tmp_path,backend):
+    if backend == 'rsync' and not shutil.which('rsync'):
+        pytest.skip('rsync not found')
+    cfg=dict()
+    staging.parse_config(dict(STAGE_BACKEND=backend,STAGE_STREAMS=3,STAGE_SPLIT_MB=1,STAGE_EXCLUDE='*.tmp'),cfg)
+    work=tmp_path/'job_1_0001'
+    (work/'sub').mkdir(parents=True)
+    # larger than STAGE_SPLIT_MB and not a multiple of the 1 MiB blocks
+    large=os.urandom(3*1024*1024+12345)
+    (work/'output_1_1-larndsim.h5').write_bytes(large)
+    (work/'sub'/'log.txt').write_text('log')
+    (work/'scratch.tmp').write_text('tmp')
+    os.chmod(work/'output_1_1-larndsim.h5',0o640)
+
+    script='STATUS=0\nSLURM_ARRAY_JOB_ID=1\n'+staging.gen_stage_out(cfg,'job_1_0001',str(tmp_path/'out'))+'exit $STATUS\n'
+    assert subprocess.run(['bash','-c',script],cwd=tmp_path).returncode == 0
+
+    out=tmp_path/'out'
+    assert (out/'output_1_1-larndsim.h5').read_bytes() == large
+    assert (out/'sub'/'log.txt').read_text() == 'log'
+    assert not (out/'scratch.tmp').exists()
+    assert os.stat(out/'output_1_1-larndsim.h5').st_mode & 0o777 == 0o640
+    assert staging.verify(out,full=True) == []
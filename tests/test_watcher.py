@@ -0,0 +1,59 @@
+import os, json
+import yaml
+import scheduler
+import watcher
+
+
+class recording_backend(scheduler.local_backend):
+
+    def __init__(self,*args,**kwargs):
+        super().__init__(*args,**kwargs)
+        self.submissions=[]
+
+    def submit(self,script,indices,exclude=[],throttle=0):
+        self.submissions.append((list(indices),list(exclude),throttle))
+        return super().submit(script,indices,exclude,throttle)
+
+
+def make_production(tmp_path):
+    prod=tmp_path/'production_1'
+    (prod/'job_source').mkdir(parents=True)
+    (prod/'job_source'/'source.yaml').write_text(yaml.dump(dict(SLURM_NUM_JOBS=3,SLURM_ARRAY_THROTTLE=2,STAGE_CHECKSUM=False)))
+    # task 3 completes without its output on the first attempt
+    (prod/'job_source'/'submit.sh').write_text(f'''#!/bin/bash
+D={prod}/$(printf "job_%d_%04d" $SLURM_ARRAY_JOB_ID $SLURM_ARRAY_TASK_ID)
+mkdir -p $D
+if [ $SLURM_ARRAY_TASK_ID -eq 3 ] && [ ! -f {prod}/attempted_3 ]; then
+    touch {prod}/attempted_3
+    exit 0
+fi
+touch $D/output_1_$SLURM_ARRAY_TASK_ID.h5
+''')
+    return prod
+
+
+def test_resubmits_failures(tmp_path):
+    prod=make_production(tmp_path)
+    backend=recording_backend(nodes=['good','bad'],fail_nodes=['bad'])
+    w=watcher.watcher(prod,backend,max_retries=3,backoff=0,exclude_after=2)
+    assert w.run(period=0.1) == 0
+
+    tasks=w.state['tasks']
+    assert [tasks[str(i)]['state'] for i in [1,2,3]] == ['DONE']*3
+    assert tasks['1']['attempts'] == 1 and tasks['2']['attempts'] == 3 and tasks['3']['attempts'] == 2
+    assert w.state['excluded'] == ['bad']
+    # resubmissions keep the throttle and leave out the excluded node
+    assert backend.submissions[0] == ([1,2,3],[],2)
+    assert all([throttle == 2 for _,_,throttle in backend.submissions])
+    assert backend.submissions[-1][1] == ['bad']
+    with open(prod/watcher.STATE_NAME) as f:
+        assert json.load(f) == w.state
+
+
+def test_gives_up(tmp_path):
+    prod=make_production(tmp_path)
+    backend=recording_backend(nodes=['bad'],fail_nodes=['bad'])
+    w=watcher.watcher(prod,backend,max_retries=1,backoff=0,exclude_after=100)
+    assert w.run(period=0.1) == 3
+    assert set([t['state'] for t in w.state['tasks'].values()]) == set(['GAVE_UP'])
+    assert len(backend.submissions) == 2
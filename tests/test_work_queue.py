@@ -0,0 +1,35 @@
+import os, subprocess
+import work_queue
+
+
+def test_workers_claim_each_unit_once(tmp_path):
+    queue=tmp_path/'queue'
+    work_queue.create(queue,40)
+    cfg=dict(WORKER_QUEUE_DIR=queue,STORAGE_DIR=tmp_path/'storage',WORKER_TIME_BUDGET=3600,METRICS=False)
+    workers=[]
+    for task in range(1,7):
+        wdir=tmp_path/f'job_1_{task:04d}'
+        wdir.mkdir()
+        (wdir/'worker.sh').write_text(work_queue.gen_worker_script(cfg))
+        (wdir/'run.sh').write_text('#!/bin/bash\necho $SLURM_ARRAY_TASK_ID > inputs.txt\ntouch output_$SLURM_ARRAY_TASK_ID.h5\n')
+        env=dict(os.environ,SLURM_ARRAY_JOB_ID='1',SLURM_ARRAY_TASK_ID=str(task))
+        workers.append(subprocess.Popen(['bash','worker.sh'],cwd=wdir,env=env,stdout=subprocess.DEVNULL))
+    assert [w.wait() for w in workers] == [0]*6
+
+    assert work_queue.status(queue) == dict(todo=0,claimed=0,done=40,failed=0)
+    # every unit ran exactly once, in some worker
+    outputs=[p.name for w in range(1,7) for p in (tmp_path/'storage'/f'job_1_{w:04d}').glob('output_*')]
+    assert sorted(outputs) == sorted([f'output_{u}.h5' for u in range(1,41)])
+    units=[p.parent.name for p in (tmp_path/'storage').glob('job_1_*/unit_*/inputs.txt')]
+    assert sorted(units) == [f'unit_{u:06d}' for u in range(1,41)]
+
+
+def test_requeue(tmp_path):
+    queue=tmp_path/'queue'
+    work_queue.create(queue,3)
+    os.rename(queue/'todo'/'unit_000001',queue/'claimed'/'unit_000001.1_1')
+    os.rename(queue/'todo'/'unit_000002',queue/'failed'/'unit_000002')
+    assert work_queue.requeue(queue) == 1
+    assert work_queue.status(queue) == dict(todo=2,claimed=0,done=0,failed=1)
+    assert work_queue.requeue(queue,failed=True) == 1
+    assert sorted(os.listdir(queue/'todo')) == ['unit_000001','unit_000002','unit_000003']
@@ -0,0 +1,157 @@
+import os, sys, json, time, argparse
+import yaml
+import staging
+from scheduler import BACKENDS, ACTIVE_STATES, array_spec
+
+# Watch the array tasks of a production and resubmit the indices that failed,
+# timed out, hit a node failure or completed without the expected outputs.
+# Retries are delayed with an exponential backoff and capped per index, and
+# nodes with repeated failures are excluded from later submissions.
+# The state is kept in watch_state.json so that a watcher can be restarted.
+
+STATE_NAME='watch_state.json'
+
+
+class watcher():
+
+    def __init__(self,production_dir,backend,max_retries=3,backoff=300,exclude_after=2):
+        self.production_dir=os.path.abspath(production_dir)
+        self.backend=backend
+        self.max_retries=max_retries
+        self.backoff=backoff
+        self.exclude_after=exclude_after
+
+        with open(os.path.join(self.production_dir,'job_source','source.yaml'),'r') as f:
+            self.cfg=yaml.safe_load(f)
+        if self.cfg.get('SLURM_SPLIT_STAGES',False):
+            raise ValueError('productions with SLURM_SPLIT_STAGES are not supported by the watcher.')
+        # submit.sh wraps the array script when a merge job is chained
+        self.script=os.path.join(self.production_dir,'job_source','submit.sh')
+        if os.path.isfile(os.path.join(self.production_dir,'job_source','submit_array.sh')):
+            self.script=os.path.join(self.production_dir,'job_source','submit_array.sh')
+        self.exclude=[n for n in str(self.cfg.get('SLURM_EXCLUDE','') or '').split(',') if n]
+
+        self.state=dict(tasks=dict(),node_failures=dict(),excluded=[])
+        path=os.path.join(self.production_dir,STATE_NAME)
+        if os.path.isfile(path):
+            with open(path,'r') as f:
+                self.state=json.load(f)
+
+    def save(self):
+        path=os.path.join(self.production_dir,STATE_NAME)
+        with open(path+'.tmp','w') as f:
+            json.dump(self.state,f,indent=1)
+        os.replace(path+'.tmp',path)
+
+    def outputs_ok(self,job_id,index):
+        '''
+        Check the job directory of an index has outputs (and a matching stage manifest).
+        '''
+        job_dir=os.path.join(self.production_dir,'job_%s_%04d' % (job_id,index))
+        if not os.path.isdir(job_dir):
+            return False
+        if not any([name.startswith('output_') for name in os.listdir(job_dir)]):
+            return False
+        if self.cfg.get('STAGE_CHECKSUM',True):
+            return len(staging.verify(job_dir)) == 0
+        return True
+
+    def submit(self,indices):
+        exclude=sorted(set(self.exclude+self.state['excluded']))
+        # keep the throttle of the production for the resubmitted indices
+        job_id=self.backend.submit(self.script,indices,exclude,int(self.cfg.get('SLURM_ARRAY_THROTTLE',0) or 0))
+        print(f'Submitted array {array_spec(indices)} as job {job_id}'+(f' (excluding {",".join(exclude)})' if exclude else ''))
+        for index in indices:
+            task=self.state['tasks'].setdefault(str(index),dict(attempts=0))
+            task.update(job=job_id,state='PENDING',attempts=task['attempts']+1,retry_at=None)
+        self.save()
+
+    def failed(self,index,task,state,node):
+        task['state']=state
+        if node:
+            count=self.state['node_failures'].get(node,0)+1
+            self.state['node_failures'][node]=count
+            if count >= self.exclude_after and not node in self.state['excluded']:
+                print(f'Excluding node {node} after {count} failures (add it to SLURM_EXCLUDE)')
+                self.state['excluded'].append(node)
+        if task['attempts'] > self.max_retries:
+            print(f'Task {index} {state} on {node}, giving up after {task["attempts"]} attempts')
+            task['state']='GAVE_UP'
+            return
+        task['retry_at']=time.time()+self.backoff*2**(task['attempts']-1)
+        print(f'Task {index} {state} on {node}, retrying in {task["retry_at"]-time.time():.0f}s')
+
+    def poll(self):
+        '''
+        Update the task states. Returns the number of tasks running or waiting for a retry.
+        '''
+        tasks=self.state['tasks']
+        for job_id in set([t['job'] for t in tasks.values() if t['state'] in ACTIVE_STATES]):
+            states=self.backend.states(job_id)
+            for key,task in tasks.items():
+                if not task['job'] == job_id or not int(key) in states or not task['state'] in ACTIVE_STATES:
+                    continue
+                state,node=states[int(key)]
+                if state in ACTIVE_STATES:
+                    task['state']=state
+                elif state == 'COMPLETED' and self.outputs_ok(job_id,int(key)):
+                    task['state']='DONE'
+                else:
+                    self.failed(int(key),task,'MISSING_OUTPUT' if state == 'COMPLETED' else state,node)
+
+        now=time.time()
+        due=sorted([int(k) for k,t in tasks.items() if t.get('retry_at') and t['retry_at'] <= now])
+        if due:
+            self.submit(due)
+        self.save()
+        return len([t for t in tasks.values() if t['state'] in ACTIVE_STATES or t.get('retry_at')])
+
+    def run(self,job_id=None,period=60):
+        if not self.state['tasks']:
+            # the array of the worker mode runs the workers, not the units
+            indices=list(range(1,int(self.cfg['WORKER_COUNT'] if self.cfg.get('WORKER_MODE',False) else self.cfg['SLURM_NUM_JOBS'])+1))
+            if job_id is None:
+                self.submit(indices)
+            else:
+                for index in indices:
+                    self.state['tasks'][str(index)]=dict(job=str(job_id),state='PENDING',attempts=1,retry_at=None)
+        while True:
+            active=self.poll()
+            if active < 1:
+                break
+            # wake up early for the next retry
+            retry=[t['retry_at'] for t in self.state['tasks'].values() if t.get('retry_at')]
+            time.sleep(max(1,min([period]+[r-time.time() for r in retry])))
+
+        tasks=self.state['tasks'].values()
+        states=sorted(set([t['state'] for t in tasks]))
+        print('Finished watching: '+', '.join([f'{s} {len([t for t in tasks if t["state"] == s])}' for s in states]))
+        return len([t for t in tasks if not t['state'] == 'DONE'])
+
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(description='Watch a production and resubmit failed array indices')
+    parser.add_argument('production_dir')
+    parser.add_argument('--job',help='array job already submitted (default: submit the production)')
+    parser.add_argument('--backend',choices=sorted(BACKENDS.keys()),default='slurm')
+    parser.add_argument('--max-retries',type=int,default=3)
+    parser.add_argument('--backoff',type=float,default=300,help='seconds before the first retry (doubled on each retry)')
+    parser.add_argument('--exclude-after',type=int,default=2,help='exclude nodes with this many failed tasks')
+    parser.add_argument('--period',type=float,default=60,help='polling period in seconds')
+    parser.add_argument('--fake-nodes',default='local1,local2',help='node names of the local backend')
+    parser.add_argument('--fake-fail-nodes',default='',help='nodes of the local backend where tasks always fail')
+    parser.add_argument('--fake-fail-rate',type=float,default=0.,help='probability of a node failure with the local backend')
+    args=parser.parse_args()
+
+    if args.backend == 'pool':
+        with open(os.path.join(args.production_dir,'job_source','source.yaml'),'r') as f:
+            backend=BACKENDS['pool'].from_config(yaml.safe_load(f))
+    elif args.backend == 'local':
+        backend=BACKENDS['local'](nodes=args.fake_nodes.split(','),
+            fail_nodes=[n for n in args.fake_fail_nodes.split(',') if n],
+            fail_rate=args.fake_fail_rate)
+    else:
+        backend=BACKENDS[args.backend]()
+
+    w=watcher(args.production_dir,backend,args.max_retries,args.backoff,args.exclude_after)
+    sys.exit(1 if w.run(args.job,args.period) else 0)
@@ -0,0 +1,129 @@
+import os, sys, glob, shutil
+
+# File-based queue of work units for the persistent worker mode. Each unit is an
+# empty file named unit_NNNNNN, moved between the sub-directories
+#
+#   todo/ => claimed/ (unit_NNNNNN.JOB_TASK) => done/ or failed/
+#
+# A worker claims a unit by renaming it into claimed/, which succeeds for exactly
+# one worker. Units left in claimed/ by killed workers can be put back with requeue.
+
+STATES=['todo','claimed','done','failed']
+
+
+def create(queue_dir,num_units):
+    '''
+    Create the queue with units 1 to num_units in todo.
+    '''
+    for state in STATES:
+        os.makedirs(os.path.join(queue_dir,state))
+    for unit in range(1,num_units+1):
+        open(os.path.join(queue_dir,'todo','unit_%06d' % unit),'w').close()
+
+
+def status(queue_dir):
+    return {state:len(os.listdir(os.path.join(queue_dir,state))) for state in STATES}
+
+
+def requeue(queue_dir,failed=False):
+    '''
+    Move the claimed (and failed if requested) units back to todo. Returns the number of units moved.
+    Only run it when no worker of the production is running.
+    '''
+    paths=glob.glob(os.path.join(queue_dir,'claimed','unit_*'))
+    if failed:
+        paths+=glob.glob(os.path.join(queue_dir,'failed','unit_*'))
+    for path in paths:
+        name=os.path.basename(path).split('.')[0]
+        shutil.move(path,os.path.join(queue_dir,'todo',name))
+    return len(paths)
+
+
+def gen_worker_script(cfg,run_script='run.sh'):
+    '''
+    Job script running run_script once per claimed unit (with SLURM_ARRAY_TASK_ID set to the unit)
+    until the queue is empty or the time left is too short for another unit. Each unit runs in a
+    unit_N sub-directory linked to the staged inputs, and its outputs are copied to the storage
+    directory (its inputs.txt and logs to a unit_N sub-directory) before the unit is marked done.
+    '''
+    return f'''#!/bin/bash
+date
+echo "starting a worker"
+
+QUEUE_DIR={cfg['WORKER_QUEUE_DIR']}
+WORKER_ID=${{SLURM_ARRAY_JOB_ID}}_${{SLURM_ARRAY_TASK_ID}}
+OUTPUT_DIR={cfg['STORAGE_DIR']}/$(basename $PWD)
+DEADLINE=$(( $(date +%s) + {cfg['WORKER_TIME_BUDGET']} ))
+MAX_UNIT_TIME=0
+NUM_UNITS=0
+
+chmod 774 {run_script}
+mkdir -p $OUTPUT_DIR
+
+while true; do
+    NOW=$(date +%s)
+    if [ $(( NOW + MAX_UNIT_TIME + MAX_UNIT_TIME/10 )) -gt $DEADLINE ]; then
+        echo "Not enough time left for another unit (longest so far: ${{MAX_UNIT_TIME}}s)"
+        break
+    fi
+
+    UNIT=""
+    for ENTRY in $(ls $QUEUE_DIR/todo 2> /dev/null | shuf); do
+        if mv $QUEUE_DIR/todo/$ENTRY $QUEUE_DIR/claimed/$ENTRY.$WORKER_ID 2> /dev/null; then
+            UNIT=$ENTRY
+            break
+        fi
+    done
+    if [ -z "$UNIT" ]; then
+        echo "No unit left in the queue"
+        break
+    fi
+
+    INDEX=$((10#${{UNIT#unit_}}))
+    date
+    echo "Processing $UNIT"
+    mkdir $UNIT
+    for f in *; do
+        [[ $f == unit_* ]] || ln -s ../$f $UNIT/$f
+    done
+    (cd $UNIT && SLURM_ARRAY_TASK_ID=$INDEX ./{run_script}) &> $UNIT/log_unit.txt
+    STATUS=$?
+    find $UNIT -maxdepth 1 -type l -delete
+    for f in $UNIT/*.jsonl; do
+        [ -f $f ] && cat $f >> $(basename $f) && rm $f
+    done
+
+    if [ $STATUS -eq 0 ] && cp -p $UNIT/output_* $OUTPUT_DIR/; then
+        rm -f $UNIT/output_*
+        # keep the input manifest and the logs of the unit next to the outputs (read by conversion_manifest)
+        mkdir -p $OUTPUT_DIR/$UNIT
+        for f in $UNIT/inputs.txt $UNIT/log_*; do
+            [ -f $f ] && cp -p $f $OUTPUT_DIR/$UNIT/ && rm $f
+        done
+        mv $QUEUE_DIR/claimed/$UNIT.$WORKER_ID $QUEUE_DIR/done/$UNIT
+    else
+        echo "$UNIT failed (status $STATUS)"
+        mv $QUEUE_DIR/claimed/$UNIT.$WORKER_ID $QUEUE_DIR/failed/$UNIT
+    fi
+
+    UNIT_TIME=$(( $(date +%s) - NOW ))
+    [ $UNIT_TIME -gt $MAX_UNIT_TIME ] && MAX_UNIT_TIME=$UNIT_TIME
+    NUM_UNITS=$((NUM_UNITS+1))
+done
+
+date
+echo "Worker processed $NUM_UNITS unit(s)"
+'''
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or not sys.argv[1] in ['status','requeue']:
+        print(f'Invalid arguments {sys.argv[1:]}')
+        print(f'Usage: {os.path.basename(__file__)} status|requeue $PRODUCTION_DIR [--failed]')
+        sys.exit(1)
+
+    queue_dir = os.path.join(sys.argv[2],'queue')
+    if sys.argv[1] == 'requeue':
+        print(f'Moved {requeue(queue_dir,"--failed" in sys.argv[3:])} unit(s) back to the queue')
+    for state,count in status(queue_dir).items():
+        print(f'{state:8s} {count}')